@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+import pandas as pd
+
+'''
+    Offline pipeline benchmark on a synthetic forcing archive (see synthetic.py): dataset selection,
+    preparation and validation, simulation per model and particle count, and POC grids.
+    Results are written as JSON, a previous results file can be given to compare against.
+    Run from the repository root:
+        python benchmarks/bench_pipeline.py [--days 7] [--nx 100 --ny 80] [--particles 100,1000,10000]
+                                            [--models OceanDrift,Leeway] [--json results.json]
+                                            [--compare previous.json]
+'''
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import make_archive, particle_cloud
+
+START = '2024-06-01'
+RELEASE = [57.5, 20.5]
+TIME_STEP = 900
+
+def _int_list(value):
+    return [int(float(v)) for v in value.split(',') if v]
+
+def time_call(func, repeat, *args, **kwargs):
+    times, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return times, result
+
+def summary(times, **params) -> dict:
+    return {'median': statistics.median(times), 'min': min(times), 'max': max(times), 'repeat': len(times), **params}
+
+# Time one case, a failing case is recorded with its error and returns None
+def run_case(results, name, repeat, func, *args, params = None, **kwargs):
+    try:
+        times, result = time_call(func, repeat, *args, **kwargs)
+    except Exception as e:
+        results[name] = {'error': f'{type(e).__name__}: {e}', **(params or {})}
+        print(f'{name:40s} failed: {results[name]["error"]}')
+        return None
+    results[name] = summary(times, **(params or {}))
+    print(f"{name:40s} median {results[name]['median']:.4f} s  min {results[name]['min']:.4f} s  "
+          f"max {results[name]['max']:.4f} s")
+    return result
+
+def bench_selection(results, archive, flat, start_t, end_t, repeat):
+    from dataset_selection import read_root_directory, filter_files_by_time_interval, symlink_selected_files
+    from file_clusterization import cluster_files
+
+    files = run_case(results, 'read_root_directory', repeat, read_root_directory, archive)
+    selected = run_case(results, 'filter_files_by_time_interval', repeat, filter_files_by_time_interval,
+                        start_t, end_t, files, params={'files': len(files)})
+    flat_files = sorted(Path(flat).iterdir())
+    run_case(results, 'cluster_files', repeat, cluster_files, flat_files, params={'files': len(flat_files)})
+    run_case(results, 'cluster_files/variables', repeat, cluster_files, flat_files, 'variables',
+             params={'files': len(flat_files)})
+    return symlink_selected_files(selected)
+
+def bench_preparation(results, folder, start_t, end_t, repeat):
+    from dataset_preparation import prepare_dataset
+    from dataset_verification import validate_dataset
+
+    datasets = run_case(results, 'prepare_dataset', repeat, prepare_dataset, start_t, end_t,
+                        folder=folder, concatenation=True)
+    if datasets:
+        run_case(results, 'validate_dataset', repeat, validate_dataset, datasets, start_t, end_t)
+    return datasets
+
+def bench_simulation(results, datasets, models, particles, start_t, end_t, repeat):
+    from case_study_tool import simulation
+
+    with open(os.path.join(ROOT, 'DATA', 'VariableMapping.json')) as f:
+        std_names = json.load(f)['Copernicus']
+    params = dict(start_position=RELEASE, start_t=start_t, end_t=end_t, datasets=datasets,
+                  std_names=std_names, rad=1000, time_step=TIME_STEP)
+    for model in models:
+        # untimed run: model import, global landmask and oil database are loaded once per process
+        try:
+            simulation(model=model, num=10, file_name=f'bench_{model}_warmup.nc', **params)
+        except Exception:
+            pass
+        for num in particles:
+            run_case(results, f'simulation/{model}/{num}', repeat, simulation, model=model, num=num,
+                     file_name=f'bench_{model}_{num}.nc', params={'model': model, 'particles': num}, **params)
+
+def bench_poc(results, particles, bins, repeat):
+    from post_processing import _build_poc_grid, _merge_polygons_by_level
+
+    with open(os.path.join(ROOT, 'DATA', 'colorscale.json')) as f:
+        colorscale = json.load(f)['POC']
+    for num in particles:
+        lat, lon = particle_cloud(num)
+        for n_bins in bins:
+            params = {'particles': num, 'bins': n_bins}
+            gdf = run_case(results, f'_build_poc_grid/{num}/{n_bins}', repeat, _build_poc_grid,
+                           lat, lon, n_bins, params=params)
+            if gdf is None:
+                continue
+            run_case(results, f'_merge_polygons_by_level/{num}/{n_bins}', repeat,
+                     _merge_polygons_by_level, gdf, colorscale, params=params)
+            # cell union fallback, used when the grid has no raster
+            cells = gdf.copy()
+            cells.attrs = {}
+            run_case(results, f'_merge_polygons_by_level/union/{num}/{n_bins}', repeat,
+                     _merge_polygons_by_level, cells, colorscale, params=params)
+
+def _commit() -> str:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip() or None
+
+# Median ratio to a previous results file, > 1 is slower
+def compare(results, previous):
+    print(f'compared to {previous}:')
+    with open(previous) as f:
+        before = json.load(f)['cases']
+    for name, case in results.items():
+        old = before.get(name, {})
+        if 'median' in case and old.get('median'):
+            print(f"  {name:40s} {case['median'] / old['median']:.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline pipeline benchmark on synthetic forcing')
+    parser.add_argument('--days', type=int, default=7, help='days in the archive, one file per product and day')
+    parser.add_argument('--nx', type=int, default=100, help='forcing grid longitude points')
+    parser.add_argument('--ny', type=int, default=80, help='forcing grid latitude points')
+    parser.add_argument('--hours', type=float, default=24, help='simulated hours')
+    parser.add_argument('--particles', type=_int_list, default=[100, 1000, 10000])
+    parser.add_argument('--models', default='OceanDrift,Leeway,ShipDrift,OpenOil')
+    parser.add_argument('--poc-particles', type=_int_list, default=[10000, 100000, 1000000])
+    parser.add_argument('--bins', type=_int_list, default=[10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=None, help='archive and output folder, temporary by default')
+    parser.add_argument('--keep', action='store_true', help='keep the working folder')
+    parser.add_argument('--json', default=None, help='write results to this file')
+    parser.add_argument('--compare', default=None, help='previous results file')
+    parser.add_argument('--verbose', action='store_true', help='keep INFO logs of the pipeline')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_pipeline_')
+    os.environ['OUTPUT'] = os.path.join(workdir, 'OUTPUT')
+    os.environ['SELECTED'] = os.path.join(workdir, 'SELECTED')
+    if not args.verbose:
+        logging.disable(logging.INFO)
+
+    start = time.perf_counter()
+    # nested archive for the pipeline, flat one for file name clustering
+    archive = os.path.join(workdir, 'archive')
+    flat = os.path.join(workdir, 'flat')
+    paths = make_archive(archive, START, args.days, args.nx, args.ny, layout='nested')
+    for path in paths:
+        os.makedirs(flat, exist_ok=True)
+        os.link(path, os.path.join(flat, os.path.basename(path)))
+    generated = time.perf_counter() - start
+    print(f'{len(paths)} files ({sum(os.path.getsize(p) for p in paths) / 2**20:.1f} MiB) '
+          f'generated in {generated:.1f} s: {workdir}')
+
+    # simulation window inside the archive, after its first day
+    start_t = f'{START} 06:00'
+    end_t = str(pd.Timestamp(start_t) + pd.Timedelta(hours=args.hours))
+    results = {}
+    try:
+        folder = bench_selection(results, archive, flat, start_t, end_t, args.repeat)
+        datasets = bench_preparation(results, folder, start_t, end_t, args.repeat)
+        if datasets:
+            bench_simulation(results, datasets, [m for m in args.models.split(',') if m],
+                             args.particles, start_t, end_t, args.repeat)
+        bench_poc(results, args.poc_particles, args.bins, args.repeat)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {'meta': {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _commit(),
+                       'python': sys.version.split()[0], 'cpus': os.cpu_count(),
+                       'files': len(paths), 'days': args.days, 'grid': [args.ny, args.nx],
+                       'hours': args.hours, 'time_step': TIME_STEP, 'repeat': args.repeat,
+                       'generated_s': generated},
+              'cases': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    return 0 if all('error' not in case for case in results.values()) else 1
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,95 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+'''
+    CLI startup time of main.py: process start to exit for runs that stop before the simulation,
+    and the slowest imports. Every case must exit with its expected code.
+    Run from the repository root:
+        python benchmarks/bench_startup.py [--repeat 5] [--max-seconds 2]
+'''
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# invalid copy of the test config, written to INPUT for the run
+INVALID_CONFIG = 'bench_startup_invalid.json'
+CASES = {
+    'usage': ([], 1),                                # no config, exits with usage
+    'missing_config': (['does_not_exist.json'], 2),  # exits before validation
+    'invalid_config': ([INVALID_CONFIG], 3),         # exits after validation
+}
+
+# Returns the files to remove afterwards, the run also writes its metrics to OUTPUT
+def write_invalid_config() -> list:
+    with open(os.path.join(ROOT, 'INPUT', 'input_test.json')) as f:
+        config = json.load(f)
+    config['model'] = 'NoSuchModel'
+    path = os.path.join(ROOT, 'INPUT', INVALID_CONFIG)
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return [path, os.path.join(ROOT, 'OUTPUT', INVALID_CONFIG.replace('.json', '_metrics.json'))]
+
+def time_case(args, repeat, code):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, 'main.py', *args], cwd=ROOT,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if result.returncode != code:
+            raise RuntimeError(f"main.py {' '.join(args)} exited with {result.returncode}, expected {code}")
+    return times
+
+# Cumulative import time [s] of the slowest modules imported by main.py
+def slowest_imports(top = 10):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|(\s*)(\S+)', line)
+        # main, its modules and their direct imports
+        if match and len(match.group(2)) <= 5:
+            imports.append((match.group(3).strip(), int(match.group(1)) / 1e6))
+    return sorted(imports, key=lambda i: -i[1])[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='main.py startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='exit with 1 if the median of any case is slower')
+    parser.add_argument('--json', default=None, help='write results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    created = write_invalid_config()
+    try:
+        for name, (case_args, code) in CASES.items():
+            times = time_case(case_args, args.repeat, code)
+            results[name] = {'median': statistics.median(times), 'min': min(times), 'max': max(times)}
+            print(f"{name:16s} median {results[name]['median']:.3f} s  min {results[name]['min']:.3f} s  "
+                  f"max {results[name]['max']:.3f} s")
+    except RuntimeError as e:
+        print(e)
+        return 1
+    finally:
+        for path in created:
+            if os.path.exists(path):
+                os.remove(path)
+    results['imports'] = dict(slowest_imports())
+    print('slowest imports:')
+    for module, seconds in results['imports'].items():
+        print(f'  {module:30s} {seconds:.3f} s')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.max_seconds is not None and any(results[c]['median'] > args.max_seconds for c in CASES):
+        print(f'Startup slower than {args.max_seconds} s')
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
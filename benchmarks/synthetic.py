@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+'''
+    Synthetic forcing archive and trajectory fixtures for benchmarks, no network needed.
+    One file per day and product, named like the Copernicus Baltic and ECMWF downloads:
+        BAL-NEMO_PHY-hourly-<date>.nc   uo, vo, thetao, so
+        BAL-WAM_WAV-hourly-<date>.nc    VSDX, VSDY, VHM0
+        ECMWF_WIND-hourly-<date>.grib   u10, v10 (ECMWF GRIB2, written with eccodes)
+    Currents are a slowly rotating eddy field, so that trajectories move and strand.
+'''
+BORDER = [54, 62, 13, 30]
+PRODUCTS = ['phy', 'wav', 'wind']
+FILE_NAMES = {'phy': 'BAL-NEMO_PHY-hourly-{date}.nc',
+              'wav': 'BAL-WAM_WAV-hourly-{date}.nc',
+              'wind': 'ECMWF_WIND-hourly-{date}.grib'}
+# paramId of 10 m wind components
+GRIB_PARAMS = {'u10': 165, 'v10': 166}
+
+def _grid(nx, ny, border = BORDER):
+    lat = np.linspace(border[0], border[1], ny)
+    lon = np.linspace(border[2], border[3], nx)
+    return lat, lon
+
+def _field(lat, lon, hours, scale, phase = 0.0, seed = 0):
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(np.linspace(0, 2 * np.pi, lat.size), np.linspace(0, 2 * np.pi, lon.size), indexing='ij')
+    t = 2 * np.pi * np.asarray(hours)[:, None, None] / 24
+    field = scale * np.sin(x + t + phase) * np.cos(y - t)
+    return (field + rng.normal(0, scale * 0.05, field.shape)).astype(np.float32)
+
+def _coords(lat, lon):
+    return {'latitude': ('latitude', lat, {'standard_name': 'latitude', 'units': 'degrees_north'}),
+            'longitude': ('longitude', lon, {'standard_name': 'longitude', 'units': 'degrees_east'})}
+
+def write_netcdf(path, day, product, nx, ny, steps = 24):
+    lat, lon = _grid(nx, ny)
+    times = pd.date_range(day, periods=steps, freq=pd.Timedelta(hours=24 / steps))
+    hours = (times - times[0]).total_seconds() / 3600
+    dims = ('time', 'latitude', 'longitude')
+    if product == 'phy':
+        data = {'uo': (dims, _field(lat, lon, hours, 0.3), {'units': 'm s-1'}),
+                'vo': (dims, _field(lat, lon, hours, 0.3, np.pi / 2, 1), {'units': 'm s-1'}),
+                'thetao': (dims, 15 + _field(lat, lon, hours, 2.0, seed=2), {'units': 'degrees_C'}),
+                'so': (dims, 7 + _field(lat, lon, hours, 1.0, seed=3), {'units': '1e-3'})}
+    else:
+        data = {'VSDX': (dims, _field(lat, lon, hours, 0.05, seed=4), {'units': 'm s-1'}),
+                'VSDY': (dims, _field(lat, lon, hours, 0.05, np.pi / 2, 5), {'units': 'm s-1'}),
+                'VHM0': (dims, 1 + np.abs(_field(lat, lon, hours, 1.0, seed=6)), {'units': 'm'})}
+    ds = xr.Dataset(data, coords={'time': times, **_coords(lat, lon)})
+    ds.to_netcdf(path)
+    return path
+
+def write_grib(path, day, nx, ny, steps = 24):
+    import eccodes
+
+    # GRIB rows from north to south
+    lat, lon = _grid(nx, ny)
+    lat = lat[::-1]
+    hours = np.arange(steps) * 24 // steps
+    fields = {'u10': _field(lat, lon, hours, 8.0, seed=7), 'v10': _field(lat, lon, hours, 8.0, np.pi / 2, 8)}
+    date = pd.Timestamp(day)
+    with open(path, 'wb') as f:
+        for i, step in enumerate(hours):
+            for name, param in GRIB_PARAMS.items():
+                handle = eccodes.codes_grib_new_from_samples('regular_ll_sfc_grib2')
+                keys = {'centre': 98, 'dataDate': int(date.strftime('%Y%m%d')), 'dataTime': 0,
+                        'stepUnits': 1, 'endStep': int(step), 'Ni': lon.size, 'Nj': lat.size,
+                        'latitudeOfFirstGridPointInDegrees': lat[0], 'longitudeOfFirstGridPointInDegrees': lon[0],
+                        'latitudeOfLastGridPointInDegrees': lat[-1], 'longitudeOfLastGridPointInDegrees': lon[-1],
+                        'iDirectionIncrementInDegrees': lon[1] - lon[0],
+                        'jDirectionIncrementInDegrees': lat[0] - lat[1], 'paramId': param}
+                for key, value in keys.items():
+                    eccodes.codes_set(handle, key, value)
+                eccodes.codes_set_values(handle, fields[name][i].astype(np.float64).ravel())
+                eccodes.codes_write(handle, f)
+                eccodes.codes_release(handle)
+    return path
+
+# Archive of n_days x products files, returns the file paths.
+# layout 'flat': all files in folder, 'nested': one subfolder per product.
+def make_archive(folder, start = '2024-06-01', n_days = 7, nx = 100, ny = 80, products = PRODUCTS,
+                 layout = 'flat') -> list:
+    paths = []
+    for product in products:
+        sub = folder if layout == 'flat' else os.path.join(folder, product)
+        os.makedirs(sub, exist_ok=True)
+        for day in pd.date_range(start, periods=n_days, freq='D'):
+            name = FILE_NAMES[product].format(date=day.strftime('%Y%m%d'))
+            if product == 'wind':
+                paths.append(write_grib(os.path.join(sub, name), day, nx, ny))
+            else:
+                paths.append(write_netcdf(os.path.join(sub, name), day, product, nx, ny))
+    return paths
+
+# Particle cloud of a finished run: final positions, NaN for deactivated elements
+def particle_cloud(n, center = (57.5, 20.5), spread = 0.3, deactivated = 0.05, seed = 0):
+    rng = np.random.default_rng(seed)
+    lat = center[0] + rng.normal(0, spread, n) * rng.uniform(0.2, 1.0, n)
+    lon = center[1] + rng.normal(0, spread * 1.8, n) * rng.uniform(0.2, 1.0, n)
+    lost = rng.random(n) < deactivated
+    lat[lost], lon[lost] = np.nan, np.nan
+    return lat, lon
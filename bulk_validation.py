@@ -0,0 +1,255 @@
+import os
+import json
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from config_verification import (REQUIRED_KEYS, VOC, SIMULATION_KEYS, DATASET_KEYS, SETTINGS,
+                                 unknown_keys, check_rad)
+from general_tools import resolve_path
+
+'''
+    Bulk config validation for batch submissions. Configs from a JSONL file, a JSON list or a folder of
+    JSON files are checked together: start positions, times and seeding parameters as arrays over all configs.
+    Unlike verify_config_file, every check runs for every config and the report lists all problems:
+        errors   - the config is rejected by verify_config_file or cannot run (e.g. missing required keys)
+        warnings - verify_config_file replaces the value with a default
+        python bulk_validation.py configs.jsonl|folder [--json report.json]
+'''
+MODELS = ['OceanDrift', 'Leeway', 'ShipDrift', 'OpenOil']
+SEED_TYPES = ['elements', 'cone']
+
+# [(name, config, parse error)] from a JSONL file, a JSON file (object or list) or a folder of JSON files
+def load_configs(source) -> list:
+    entries = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(source, name)) as f:
+                    entries.append((name, json.load(f), None))
+            except (OSError, ValueError) as e:
+                entries.append((name, None, f'Unable to read or parse the configuration file: {e}'))
+        return entries
+
+    base = os.path.basename(source)
+    with open(source) as f:
+        text = f.read()
+    if source.endswith('.json'):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            return [(base, None, f'Unable to read or parse the configuration file: {e}')]
+        if isinstance(data, list):
+            return [(f'{base}:{i}', config, None) for i, config in enumerate(data)]
+        return [(base, data, None)]
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            entries.append((f'{base}:{number}', json.loads(line), None))
+        except ValueError as e:
+            entries.append((f'{base}:{number}', None, f'Unable to parse the configuration: {e}'))
+    return entries
+
+def _column(configs, key) -> np.ndarray:
+    return np.fromiter((c.get(key) for c in configs), dtype=object, count=len(configs))
+
+def _flags(values, test) -> np.ndarray:
+    return np.fromiter((test(v) for v in values), dtype=bool, count=len(values))
+
+def _is_int(v) -> bool:
+    return isinstance(v, int) and not isinstance(v, bool)
+
+# Add message to the configs where mask is set, {} is filled with the config's value
+def _add(target, mask, message, values = None):
+    for i in np.flatnonzero(mask):
+        target[i].append(message.format(values[i]) if values is not None else message)
+
+# Start positions: [lat, lon] or [[lats], [lons]]. Returns the number of coordinates per config (0 if invalid).
+def _check_positions(configs, errors):
+    n = len(configs)
+    coords = np.zeros(n, dtype=int)
+    lats, lons, owners = [], [], []
+    for i, c in enumerate(configs):
+        val = c.get('start_position')
+        if val is None:
+            continue
+        if not isinstance(val, list) or len(val) != 2:
+            errors[i].append(f'start_position must be a list of two arrays/lists. Got: {val}')
+            continue
+        try:
+            arr = [np.atleast_1d(np.asarray(v, dtype=float)) for v in val]
+        except (TypeError, ValueError):
+            errors[i].append(f'start_position contains non-numeric values: {val}')
+            continue
+        if any(a.ndim > 1 for a in arr):
+            errors[i].append('Inapropriate array dimension size of start position coordinates.')
+            continue
+        if arr[0].size != arr[1].size:
+            errors[i].append('start_position must contain [latitudes, longitudes].')
+            continue
+        coords[i] = arr[0].size
+        lats.append(arr[0])
+        lons.append(arr[1])
+        owners.append(np.full(arr[0].size, i))
+    if owners:
+        lat, lon, owner = np.concatenate(lats), np.concatenate(lons), np.concatenate(owners)
+        # NaN fails both checks
+        bad_lat = np.bincount(owner[~((-90 <= lat) & (lat <= 90))], minlength=n) > 0
+        bad_lon = np.bincount(owner[~((-180 <= lon) & (lon <= 180))], minlength=n) > 0
+        _add(errors, bad_lat, 'Latitude values must be in [-90, 90].')
+        _add(errors, bad_lon, 'Longitude values must be in [-180, 180].')
+    return coords
+
+def _datetimes(values) -> pd.Series:
+    return pd.to_datetime(pd.Series(values, dtype=object), errors='coerce', format='mixed', utc=True)
+
+def _timedeltas(values) -> pd.Series:
+    return pd.to_timedelta(pd.Series(values, dtype=object), errors='coerce')
+
+def _check_times(configs, errors, warnings):
+    start_col, end_col = _column(configs, 'start_t'), _column(configs, 'end_t')
+    start, end = _datetimes(start_col).to_numpy(), _datetimes(end_col).to_numpy()
+    for key, col, parsed in [('start_t', start_col, start), ('end_t', end_col, end)]:
+        _add(errors, pd.isna(parsed) & (col != None),
+             f'Invalid {key}: {{}}. Must be a valid datetime string.', col)
+
+    both = ~pd.isna(start) & ~pd.isna(end)
+    forward = np.zeros(len(configs), dtype=bool)
+    forward[both] = start[both] < end[both]
+    backtracking = _flags(_column(configs, 'backtracking'), bool)
+    _add(errors, both & backtracking & forward,
+         'If backtracking is turned on, start time must be after end time.')
+    _add(errors, both & ~backtracking & ~forward, 'Start time must be earlier than end time.')
+
+    time_step = _column(configs, 'time_step')
+    step = np.fromiter((v if _is_int(v) else 0 for v in time_step), dtype=np.int64, count=len(configs))
+    valid_step = (time_step == 'auto') | (backtracking & (step < 0)) | (~backtracking & (step > 0))
+    _add(warnings, (time_step != None) & ~valid_step,
+         'Invalid time_step: {}. Must be an integer in the direction of the simulation or "auto". Using default.',
+         time_step)
+
+    duration_col = _column(configs, 'duration')
+    duration = _timedeltas(duration_col).to_numpy()
+    _add(warnings, (duration_col != None) & pd.isna(duration), 'Invalid duration: {}.', duration_col)
+    checkpoint_col = _column(configs, 'checkpoint')
+    checkpoint = _timedeltas(checkpoint_col).to_numpy()
+    valid_checkpoint = ~pd.isna(checkpoint)
+    valid_checkpoint[valid_checkpoint] = checkpoint[valid_checkpoint] > np.timedelta64(0)
+    _add(warnings, (checkpoint_col != None) & ~valid_checkpoint,
+         'Invalid checkpoint interval: {}. Must be a positive duration. Checkpointing disabled.', checkpoint_col)
+
+    # prerun needs a duration and valid forcings
+    forcings = _column(configs, 'forcings')
+    valid_forcings = _flags(forcings, lambda v: isinstance(v, list) and len(v) == 4 and
+                            all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in v) and
+                            abs(v[1]) <= 50 and abs(v[3]) <= 15)
+    prerun = _flags(_column(configs, 'prerun'), bool)
+    _add(errors, prerun & (pd.isna(duration) | ~valid_forcings),
+         'Prerun flag was enabled but no valid forcings or duration was given.')
+
+# Seeding: num, rad and seed_type against the number of start coordinates, model specific parameters
+def _check_seeding(configs, coords, warnings):
+    n = len(configs)
+    num_col = _column(configs, 'num')
+    num = np.fromiter((v if _is_int(v) else 0 for v in num_col), dtype=np.int64, count=n)
+    valid = coords > 0
+    _add(warnings, valid & (num <= 0), 'Invalid num: {}. Using 100 per start coordinate.', num_col)
+    _add(warnings, valid & (num > 0) & (num % np.maximum(coords, 1) != 0),
+         'num={} is not divisible by the number of start coordinates. Using num times coordinates.', num_col)
+
+    rad = _column(configs, 'rad')
+    rad_size = np.fromiter((len(v) if isinstance(v, list) else 1 for v in rad), dtype=int, count=n)
+    rad_list = _flags(rad, lambda v: isinstance(v, list))
+    _add(warnings, ~_flags(rad, check_rad), 'Incorrect rad: {}. Using rad=0.', rad)
+
+    seed_type = _column(configs, 'seed_type').astype(str)
+    cone = seed_type == 'cone'
+    _add(warnings, ~np.isin(seed_type, SEED_TYPES), 'Incorrect seed_type: {}. Using elements.', seed_type)
+    _add(warnings, valid & cone & (coords != 2),
+         'cone seed type requires exactly 2 coordinates (start and end). Using rad=0.')
+    _add(warnings, valid & rad_list & ~cone & (rad_size != coords),
+         'rad list must have one value per start coordinate. Using rad=0.')
+    _add(warnings, valid & rad_list & cone & (coords == 2) & (rad_size != 2),
+         'rad list must have two values for seed_type=cone. Using rad=0.')
+
+    model = _column(configs, 'model').astype(str)
+    wdf = _column(configs, 'wdf')
+    wdf_value = np.fromiter((v if isinstance(v, float) else np.nan for v in wdf), dtype=float, count=n)
+    wdf_size = np.fromiter((len(v) if isinstance(v, list) else -1 for v in wdf), dtype=int, count=n)
+    valid_wdf = ((0 <= wdf_value) & (wdf_value <= 1)) | (wdf_size == num)
+    _add(warnings, (model == 'OceanDrift') & ~valid_wdf,
+         'Invalid wind drift factor: {}. Must be float in [0, 1]. Using default value 0.02', wdf)
+    lw_obj = _column(configs, 'lw_obj')
+    lw = np.fromiter((v if _is_int(v) else 0 for v in lw_obj), dtype=np.int64, count=n)
+    _add(warnings, (model == 'Leeway') & ((lw < 1) | (lw > 85)),
+         'Invalid leeway object: {}. Must be integer in [1, 85]. Using default value 1', lw_obj)
+
+def _extend_exists(path) -> bool:
+    return os.path.isfile(path) or os.path.isfile(os.path.join(resolve_path("OUTPUT"), path))
+
+# Report {config, valid, errors, warnings} for each config, in the given order
+def validate_configs(configs, names = None) -> list:
+    n = len(configs)
+    names = names if names is not None else [str(i) for i in range(n)]
+    errors = [[] for _ in range(n)]
+    warnings = [[] for _ in range(n)]
+    is_dict = np.fromiter((isinstance(c, dict) for c in configs), dtype=bool, count=n)
+    _add(errors, ~is_dict, 'Config must be a JSON object.')
+    configs = [c if isinstance(c, dict) else {} for c in configs]
+
+    for key in REQUIRED_KEYS:
+        _add(errors, is_dict & (_column(configs, key) == None), f'Missing required key: {key}')
+    model = _column(configs, 'model')
+    _add(errors, (model != None) & ~np.isin(model.astype(str), MODELS), 'Unknown model type: {}', model)
+    vocabulary = _column(configs, 'vocabulary')
+    _add(errors, is_dict & ~np.isin(vocabulary.astype(str), VOC),
+         'Unknown variable mapping vocabulary: {}', vocabulary)
+    extend = _column(configs, 'extend')
+    _add(errors, (extend != None) & ~_flags(extend, lambda v: isinstance(v, str) and _extend_exists(v)),
+         'Invalid extend: {}. Must be a path to an existing output file.', extend)
+
+    coords = _check_positions(configs, errors)
+    _check_times(configs, errors, warnings)
+    _check_seeding(configs, coords, warnings)
+
+    for i, c in enumerate(configs):
+        residuals = unknown_keys(c, SIMULATION_KEYS, DATASET_KEYS, SETTINGS)
+        if residuals:
+            warnings[i].append(f'Unknown keys: {sorted(residuals)}')
+        if not is_dict[i]:
+            warnings[i] = []
+    return [{'config': names[i], 'valid': not errors[i], 'errors': errors[i], 'warnings': warnings[i]}
+            for i in range(n)]
+
+def validate_bulk(source) -> list:
+    entries = load_configs(source)
+    reports = validate_configs([config for _, config, _ in entries], [name for name, _, _ in entries])
+    for report, (_, _, error) in zip(reports, entries):
+        if error:
+            report.update(valid=False, errors=[error], warnings=[])
+    return reports
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Validate a batch of configs')
+    parser.add_argument('source', help='JSONL file, JSON file or folder of JSON configs')
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    args = parser.parse_args()
+
+    reports = validate_bulk(args.source)
+    for report in reports:
+        if report['errors']:
+            logging.error(f"{report['config']}: {'; '.join(report['errors'])}")
+        if report['warnings']:
+            logging.warning(f"{report['config']}: {'; '.join(report['warnings'])}")
+    invalid = sum(not report['valid'] for report in reports)
+    logging.info(f'{len(reports) - invalid} of {len(reports)} configs valid')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+    return 1 if invalid else 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,23 +1,59 @@
-from opendrift.models.oceandrift import OceanDrift
-from opendrift.models.leeway import Leeway
-from opendrift.models.shipdrift import ShipDrift
-from opendrift.models.openoil import OpenOil
 import datetime as dt
 import pandas as pd
 import numpy as np
+import xarray as xr
 import os
-from opendrift.readers.reader_netCDF_CF_generic import Reader
+import json
+import hashlib
 import logging
+import importlib
+from collections.abc import Mapping
 from general_tools import prepare_time, resolve_path
+from output_tools import set_output_encoding, COMPLEVEL
+from instrumentation import stage
+from progress import attach_progress, INTERVAL as PROGRESS_INTERVAL
+from simulation_state import (checkpoint_folder, extract_state, state_from_result, restore_state,
+                              restored_trajectories, save_checkpoint, latest_checkpoint,
+                              clear_checkpoints, append_output)
 
 
 logger_cop = logging.getLogger('copernicusmarine') 
 logger_cop.setLevel(logging.INFO)
 
-MODEL_DICT = {'OceanDrift':OceanDrift,
-              'Leeway':Leeway,
-              'ShipDrift':ShipDrift,
-              'OpenOil': OpenOil}
+MODEL_MODULES = {'OceanDrift': 'opendrift.models.oceandrift',
+                 'Leeway': 'opendrift.models.leeway',
+                 'ShipDrift': 'opendrift.models.shipdrift',
+                 'OpenOil': 'opendrift.models.openoil'}
+
+# Model classes by name. OpenDrift takes seconds to import, so only the requested model is imported, on first use.
+class ModelRegistry(Mapping):
+    def __init__(self, modules):
+        self._modules = modules
+        self._classes = {}
+
+    def __getitem__(self, name):
+        if name not in self._classes:
+            self._classes[name] = getattr(importlib.import_module(self._modules[name]), name)
+        return self._classes[name]
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+MODEL_DICT = ModelRegistry(MODEL_MODULES)
+
+# Automatic time step: particles move at most COURANT grid cells per step
+COURANT = 1.0
+OUTPUT_INTERVAL = 3600
+SPEED_COMPONENTS = [('x_sea_water_velocity', 'y_sea_water_velocity', 'current'),
+                    ('sea_surface_wave_stokes_drift_x_velocity', 'sea_surface_wave_stokes_drift_y_velocity', 'stokes'),
+                    ('x_wind', 'y_wind', 'wind')]
+# Share of wind speed in drift. OceanDrift uses wdf, others are conservative upper bounds.
+WIND_FACTORS = {'Leeway': 0.1, 'ShipDrift': 0.1, 'OpenOil': 0.035}
+# time steps of a forcing read at once for its maximum speed
+SPEED_BLOCK = 24
  
 def seed(o, model, lw_obj, start_position, start_t, num, rad, ship, wdf, seed_type, orientation, oil_type, shpfile=None):
     params = dict(
@@ -28,15 +64,15 @@ def seed(o, model, lw_obj, start_position, start_t, num, rad, ship, wdf, seed_ty
         time = start_t
     )
             
-    if model == OceanDrift:
+    if model.__name__ == 'OceanDrift':
         params.update(wind_drift_factor = wdf)
-    elif model == Leeway:
+    elif model.__name__ == 'Leeway':
         params.update(object_type = lw_obj)
-    elif model == ShipDrift:
+    elif model.__name__ == 'ShipDrift':
         length, beam, height, draft = ship
         o.set_config('seed:orientation', orientation)
         params.update(length = length, beam = beam, height = height, draft = draft)
-    elif model == OpenOil:
+    elif model.__name__ == 'OpenOil':
         params.update( oil_type=oil_type)
     else:
         logging.error(f'Model {model} is not implemented yet.')
@@ -67,36 +103,136 @@ def _transform_forcings(configurations, windir=0, windspeed=0, currentdir=0, cur
     logging.info('Forcings transformed: [winddir, windspeed] - > [x_wind, y_wind] \n [currentdir, currentspeed] - > [x_sea_water_velocity, y_sea_water_velocity]')
     return configurations
 
+# Finest horizontal grid spacing [m] of readers that provide velocities
+def _reader_resolution(readers):
+    velocities = [v for comp in SPEED_COMPONENTS for v in comp[:2]]
+    sizes = []
+    for r in readers:
+        if not any(v in r.variables for v in velocities):
+            continue
+        dx, dy = getattr(r, 'delta_x', None), getattr(r, 'delta_y', None)
+        if dx is None:
+            continue
+        dy = dy if dy is not None else dx
+        if r.proj.crs.is_geographic or 'latlong' in r.proj4 or 'longlat' in r.proj4:
+            # narrowest cells at the pole-most latitude of the domain
+            lat = np.radians(min(89, max(abs(r.ymin), abs(r.ymax))))
+            dx, dy = dx * 111320 * np.cos(lat), dy * 110574
+        sizes.append(min(abs(dx), abs(dy)))
+    return min(sizes) if sizes else None
+
+# Maximum of sqrt(u^2 + v^2) over the time steps covering [start_t, end_t], NaN skipped.
+# Dask-backed forcing is reduced lazily, lazily opened files are read SPEED_BLOCK time steps at a time.
+def _max_magnitude(u, v, start_t = None, end_t = None) -> float:
+    if 'time' in u.dims and start_t is not None and end_t is not None:
+        lo, hi = sorted([np.datetime64(pd.Timestamp(start_t)), np.datetime64(pd.Timestamp(end_t))])
+        times = u.time.values
+        first = max(0, np.searchsorted(times, lo, 'right') - 1)
+        last = np.searchsorted(times, hi, 'left') + 1
+        u, v = u.isel(time=slice(first, last)), v.isel(time=slice(first, last))
+    if u.size == 0:
+        return 0.0
+    if u.chunks is not None or 'time' not in u.dims:
+        speed = float(np.hypot(u, v).max())
+    else:
+        speed = max(float(np.hypot(u.isel(time=slice(i, i + SPEED_BLOCK)), v.isel(time=slice(i, i + SPEED_BLOCK))).max())
+                    for i in range(0, u.sizes['time'], SPEED_BLOCK))
+    return 0.0 if np.isnan(speed) else speed
+
+# Maximum current, Stokes drift and wind speed in prepared datasets (or fallback values)
+def _max_speeds(datasets, std_names, configurations, start_t = None, end_t = None):
+    speeds = {kind: 0.0 for _, _, kind in SPEED_COMPONENTS}
+    for ds in datasets:
+        names = {(std_names or {}).get(v, ds[v].attrs.get('standard_name')): v for v in ds.data_vars}
+        for x, y, kind in SPEED_COMPONENTS:
+            if x in names and y in names:
+                speed = _max_magnitude(ds[names[x]], ds[names[y]], start_t, end_t)
+                speeds[kind] = max(speeds[kind], speed)
+    for x, y, kind in SPEED_COMPONENTS:
+        fx = (configurations or {}).get(f'environment:fallback:{x}', 0)
+        fy = (configurations or {}).get(f'environment:fallback:{y}', 0)
+        speeds[kind] = max(speeds[kind], float(np.hypot(fx, fy)))
+    return speeds
+
+# CFL-style time step rounded down to a divisor of the output interval
+def auto_time_step(readers, datasets, std_names, model, wdf, configurations, output_interval,
+                   start_t = None, end_t = None):
+    resolution = _reader_resolution(readers)
+    speeds = _max_speeds(datasets, std_names, configurations, start_t, end_t)
+    factor = np.max(wdf) if model == 'OceanDrift' else WIND_FACTORS.get(model, 0.1)
+    max_speed = speeds['current'] + speeds['stokes'] + factor * speeds['wind']
+    
+    if resolution is None or max_speed == 0:
+        logging.warning(f'Unable to derive time step (resolution {resolution} m, speed {max_speed} m/s). '
+                        f'Using output interval {output_interval} s.')
+        return output_interval
+    
+    cfl = COURANT * resolution / max_speed
+    candidates = np.arange(1, output_interval + 1)
+    divisors = candidates[output_interval % candidates == 0]
+    time_step = int(divisors[divisors <= cfl].max()) if cfl >= 1 else 1
+    logging.info(f'Automatic time step {time_step} s: resolution {resolution:.0f} m, '
+                 f'max speed {max_speed:.2f} m/s {speeds}, CFL limit {cfl:.0f} s')
+    return time_step
+
 def update_start(o):
-    if o.result != None:
-        res = o.result.sel(time = o.result.time[-1])
+    if o.result is not None:
+        state = state_from_result(o.result, active_only=False)
         
-        start_position = [res.lat.values, res.lon.values]
-        start_t = prepare_time(str(res.time.values))
+        start_position = [state.lat.values, state.lon.values]
+        start_t = prepare_time(state.attrs['time'])
         logging.info('Start conditions updated!')
         return start_position, start_t
     else:
         logging.error('No result of prerun were provided. Fallback to original values.')
         return None, None
 
+# Final state of an existing output file, as start of its extension
+# Element properties (all but ID) a run must export to be extended, the elements are restored from them
+def element_variables(model) -> list:
+    return [var for var in model.ElementType.variables if var != 'ID']
+
+def extend_start(file_name, model):
+    with xr.open_dataset(file_name) as ds:
+        missing = [var for var in element_variables(model) if var not in ds.data_vars]
+        if missing:
+            raise ValueError(f'Unable to extend {file_name}: element properties {missing} were not exported '
+                             '(export_variables), the elements can not be restored.')
+        state = state_from_result(ds)
+    logging.info(f"Extending {file_name}: {state.sizes['trajectory']} active elements at {state.attrs['time']}")
+    return state
+
 def run_sim(model, configurations, start_position, start_t, num, rad, 
            seed_type, ship, wdf, orientation, oil_type, lw_obj, shpfile, time_step,
-           duration = None, reader = [], file_name = None, end_t=None):
+           duration = None, reader = [], file_name = None, end_t=None, state = None,
+           time_step_output = None, export_variables = None, complevel = COMPLEVEL, chunksizes = None,
+           landmask = None, progress_interval = PROGRESS_INTERVAL):
     
-    o = model(loglevel = 20)
+    with stage('model'):
+        o = model(loglevel = 20)
+    o = set_output_encoding(o, complevel, chunksizes)
+    o = attach_progress(o, progress_interval, os.path.basename(file_name) if file_name else 'prerun')
         
     if configurations is not None:
         for key, value in configurations.items():
             o.set_config(key, value)
             logging.info(f'Configuration used: {key} with value = {value}')
+    
+    if landmask is not None:
+        from landmask_cache import attach_landmask
+        with stage('landmask'):
+            o = attach_landmask(o, **landmask)
             
     o.add_reader(reader)        
     logging.info(f'Reader used : {reader}')
     
-    o = seed(o=o, model=model, lw_obj=lw_obj, num = num, rad = rad, start_t = start_t, 
-            start_position=start_position, ship=ship, wdf = wdf, seed_type=seed_type,
-            orientation=orientation, oil_type=oil_type, shpfile=shpfile)
-    logging.info(f'Seeding {model} {num} particles at {start_t} ')
+    if state is None:
+        o = seed(o=o, model=model, lw_obj=lw_obj, num = num, rad = rad, start_t = start_t, 
+                start_position=start_position, ship=ship, wdf = wdf, seed_type=seed_type,
+                orientation=orientation, oil_type=oil_type, shpfile=shpfile)
+        logging.info(f'Seeding {model} {num} particles at {start_t} ')
+    else:
+        o = restore_state(o, state, oil_type)
     
     # duration OR end_time is given
     if duration is None and end_t is not None:
@@ -107,15 +243,98 @@ def run_sim(model, configurations, start_position, start_t, num, rad,
     if duration < pd.Timedelta(seconds = time_step):
             time_step = 60
             
+    # output interval is independent of the model time step, by default every step is stored
+    if time_step_output is None:
+        time_step_output = time_step
+    
     if duration:  
         logging.info('Run started.')      
-        o.run(duration = duration, time_step=time_step, time_step_output=time_step, outfile = file_name) 
+        with stage('run', file_name):
+            o.run(duration = duration, time_step=time_step, time_step_output=time_step_output,
+                  export_variables=export_variables, outfile = file_name) 
         logging.info('Run ended.')      
     else:
         logging.error(f'Unable to run simulation with duration: {duration}')
     
     return o    
 
+# Split the run into segments of `checkpoint` length, saving model state after each one.
+# A run started from release writes the output file, runs restored from a state 
+# (checkpoint or existing output in extend mode) are appended to it.
+def run_checkpointed(checkpoint, resume, run_key, start_t, end_t, file_name, state = None, **params):
+    # the checkpoint folder is only used when checkpoints are saved or read
+    folder = checkpoint_folder(run_key) if checkpoint is not None or resume else None
+    checkpointed = latest_checkpoint(folder) if resume else None
+    
+    if checkpointed is not None and checkpointed.attrs.get('run_key') != run_key:
+        logging.warning(f'Checkpoints in {folder} belong to another run. Starting over.')
+        checkpointed = None
+    if checkpointed is not None:
+        state = checkpointed
+        file_name = state.attrs['file_name']
+        segment = int(state.attrs['segment']) + 1
+        logging.info(f'Resuming {file_name} from checkpoint {segment - 1} at {state.attrs["time"]}')
+    else:
+        if resume:
+            logging.warning(f'No checkpoint found in {folder}. Starting over.')
+        if folder is not None:
+            clear_checkpoints(folder)
+        segment = 0
+    t = start_t if state is None else prepare_time(state.attrs['time'])
+    
+    backwards = params['time_step'] < 0
+    sign = -1 if backwards else 1
+    # segments end on model time steps, last one takes the remainder
+    step = None
+    if checkpoint is not None:
+        step_s = abs(params['time_step'])
+        step = pd.Timedelta(seconds = max(1, round(pd.Timedelta(checkpoint).total_seconds() / step_s)) * step_s)
+    
+    o = None
+    while (end_t - t) * sign > pd.Timedelta(0):
+        remaining = abs(end_t - t)
+        seg_end = end_t if step is None or remaining < 2 * step else t + sign * step
+        if state is None:
+            seg_file = file_name
+        elif folder is not None:
+            seg_file = os.path.join(folder, f'segment_{segment:04d}.nc')
+        else:
+            seg_file = f'{os.path.splitext(file_name)[0]}_segment_{segment:04d}.nc'
+        logging.info(f'Segment {segment}: {t} -> {seg_end}')
+        
+        o = run_sim(start_t=t, end_t=seg_end, file_name=seg_file, state=state, **params)
+        
+        trajectories = None
+        if state is not None:
+            trajectories = restored_trajectories(state, backwards)
+            append_output(file_name, seg_file, trajectories, params['complevel'], params['chunksizes'])
+            os.remove(seg_file)
+        state = extract_state(o, trajectories)
+        # the output file is appended next, the lazily opened result must not keep it open
+        if o.result is not None:
+            o.result.close()
+        if checkpoint is not None:
+            save_checkpoint(state, folder, segment, file_name, run_key)
+        
+        if state.sizes['trajectory'] == 0:
+            logging.warning('No active elements left, stopping.')
+            break
+        t = prepare_time(state.attrs['time'])
+        segment += 1
+    
+    if o is None:
+        logging.warning(f'{file_name} already reaches {end_t}. Nothing to run.')
+        return None, file_name
+    
+    # the full trajectory lives in the output file, opened lazily like after a single run
+    o.result = xr.open_dataset(file_name)
+    return o, file_name
+
+# Short digest of run settings, used as checkpoint folder key
+def run_hash(settings) -> str:
+    raw = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:12]
+
 # Check main requirments
 def _check_requirments(start_position, datasets, model):
     flag = True
@@ -137,29 +356,57 @@ def simulation(lw_obj=1, model='OceanDrift', start_position=None, start_t=None,
                end_t=None, datasets=None, std_names=None, num=100, prerun = False,
                rad=0, ship=[62, 8, 10, 5], wdf=0.02, orientation = 'random', forcings = [0,0,0,0],
                seed_type='elements', time_step = 3600, duration = None,
-               configurations = None, file_name = None, oil_type='GENERIC BUNKER C', shpfile=None):
+               configurations = None, file_name = None, oil_type='GENERIC BUNKER C', shpfile=None,
+               checkpoint = None, resume = False, extend = None, time_step_output = None,
+               export_variables = None, complevel = COMPLEVEL, chunksizes = None, landmask = None,
+               progress_interval = PROGRESS_INTERVAL):
     
     if not _check_requirments(start_position, datasets, model):
         raise Exception('Required parametrs missing. ') 
        
     model = MODEL_DICT[model]   
+    from opendrift.readers.reader_netCDF_CF_generic import Reader
     
     # Create readers
-    if type(datasets) == list:
-        reader = [Reader(ds, standard_name_mapping=std_names) for ds in datasets]
-    else:
-        reader = Reader(datasets, standard_name_mapping=std_names)
+    with stage('readers'):
+        if type(datasets) == list:
+            reader = [Reader(ds, standard_name_mapping=std_names) for ds in datasets]
+        else:
+            reader = Reader(datasets, standard_name_mapping=std_names)
         
     # Prepare start and end times
     start_t = prepare_time(start_t, reader, 'start')
     end_t = prepare_time(end_t, reader, 'end')
     
+    if time_step == 'auto':
+        readers = reader if type(reader) == list else [reader]
+        dss = datasets if type(datasets) == list else [datasets]
+        if time_step_output is None:
+            time_step_output = OUTPUT_INTERVAL
+        time_step = auto_time_step(readers, dss, std_names, model.__name__, wdf, configurations, time_step_output,
+                                   start_t, end_t)
+        if end_t < start_t:
+            time_step = -time_step
+    
+    m = str(model).split('.')[-1][:-2]
+    t_strt = start_t.strftime("%Y-%m-%d_%H%M")
+    # checkpoints of one run: same model, release, seeding, settings and output name
+    settings = dict(start_position=start_position, end_t=end_t, num=num, rad=rad, ship=ship, wdf=wdf,
+                    orientation=orientation, forcings=forcings, seed_type=seed_type, time_step=time_step,
+                    duration=duration, configurations=configurations, file_name=file_name, oil_type=oil_type,
+                    shpfile=shpfile, prerun=prerun, extend=extend, time_step_output=time_step_output,
+                    export_variables=export_variables)
+    run_key = f'{m}_{t_strt}_{run_hash(settings)}'
     if file_name == None:
-        m = str(model).split('.')[-1][:-2]
         t_now = dt.datetime.now().strftime("%Y-%m-%d_%H%M")
-        t_strt = start_t.strftime("%Y-%m-%d_%H%M")
         file_name = f'{m}_{t_strt}_{t_now}.nc'
     
+    if extend is not None and export_variables is not None:
+        missing = [var for var in element_variables(model) if var not in export_variables]
+        if missing:
+            logging.warning(f'Exporting element properties {missing} as well, they are needed to extend the output.')
+            export_variables = export_variables + missing
+
     # Make correct OUTPUT dir (abs/rel path) depending on where the code is running
     output_dir = resolve_path("OUTPUT")
       
@@ -178,9 +425,25 @@ def simulation(lw_obj=1, model='OceanDrift', start_position=None, start_t=None,
         shpfile=shpfile,
         time_step=time_step,
         num=num,
-        rad=rad
+        rad=rad,
+        time_step_output=time_step_output,
+        export_variables=export_variables,
+        complevel=complevel,
+        chunksizes=chunksizes,
+        landmask=landmask,
+        progress_interval=progress_interval
     )
     
+    if extend is not None:
+        # continue the existing trajectory with the new forcing, instead of re-running from release
+        if not os.path.exists(extend):
+            extend = os.path.join(output_dir, extend)
+        if prerun:
+            logging.warning('Prerun is ignored when extending an existing output.')
+        return run_checkpointed(checkpoint, resume, run_key, configurations=configurations,
+                                start_position=None, start_t=start_t, end_t=end_t, reader=reader,
+                                file_name=extend, state=extend_start(extend, model), **constant_params)
+    
     if prerun:
         logging.info('Prerun started.')
         cfgs = _transform_forcings(configurations,
@@ -198,6 +461,12 @@ def simulation(lw_obj=1, model='OceanDrift', start_position=None, start_t=None,
         else:
             logging.warning('Prerun didnot complete successfully, fallback to original values')
             
+    if checkpoint is not None:
+        return run_checkpointed(checkpoint, resume, run_key, configurations=configurations,
+                                start_position=start_position, start_t=start_t, end_t=end_t,
+                                reader=reader, file_name=file_name, **constant_params)
+    elif resume:
+        logging.warning('Resume requested, but checkpointing is not enabled. Running from release.')
 
     o = run_sim(configurations=configurations, start_position=start_position,
                start_t=start_t, end_t=end_t, reader=reader, file_name=file_name, 
@@ -2,7 +2,9 @@ import json
 import pandas as pd
 import numpy as np
 import os
+import re
 import logging
+from general_tools import resolve_path
 
 logging.basicConfig(
     level=logging.INFO,
@@ -12,14 +14,26 @@ logging.basicConfig(
 SIMULATION_KEYS = ['lw_obj', 'model', 'start_position', 'start_t', 'end_t',
                   'num', 'rad', 'ship', 'wdf', 'orientation', 'seed_type',
                   'time_step', 'configurations', 'file_name', 'backtracking',
-                  'shpfile', 'oil_type', 'duration', 'prerun', 'forcings', ]
+                  'shpfile', 'oil_type', 'duration', 'prerun', 'forcings', 'checkpoint',
+                  'extend', 'time_step_output', 'export_variables', 'complevel', 'chunksizes',
+                  'landmask', 'progress_interval']
 DATASET_KEYS = ['start_t', 'end_t', 'border', 'folder', 'concatenation',
                 'copernicus', 'user', 'pword']
-SETTINGS = ['vocabulary','selection','allow_empty_ds', 'postprocessing']
+SETTINGS = ['vocabulary','selection','allow_empty_ds', 'postprocessing', 'cache', 'profile', 'cluster_by']
 REQUIRED_KEYS = ['model','start_position', 'start_t', 'end_t']
 VOC = ["Copernicus", "ECMWF", "Copernicus_edited"]
 CHECK = True
-PROCESSINGS = ['POC', 'Triangle', 'Picture']
+PROCESSINGS = ['POC', 'POC_series', 'Triangle', 'Picture', 'Tracks']
+VECTOR_FORMATS = ['GeoJSON', 'FlatGeobuf', 'GeoParquet']
+TRACKS_FORMATS = ['parquet', 'zarr']
+POC_GRID_KEYS = ['bins', 'cell_size', 'rule', 'max_bins']
+POC_GRID_RULES = ['fd', 'silverman']
+PICTURE_KEYS = ['renderer', 'max_vertices']
+PICTURE_RENDERERS = ['fast', 'opendrift']
+ENSEMBLE_KEYS = ['name', 'border', 'weight']
+PARALLEL_KEYS = ['workers', 'timeout']
+PROFILERS = ['cprofile', 'tracemalloc', 'sampling']
+CLUSTER_MODES = ['names', 'variables']
 
 # Help functions
 def verify_border(border):
@@ -180,6 +194,9 @@ def check_time_settings(flag, file, sim_vars, data_vars):
     time_step = file.get("time_step")
     
     if start and end:
+        if time_step == 'auto':
+            # derived from forcing resolution and velocities in simulation
+            sim_vars['time_step'] = time_step
         if bt:
             if start < end:
                 flag = False
@@ -200,6 +217,17 @@ def check_time_settings(flag, file, sim_vars, data_vars):
         sim_vars['duration'] = pd.to_timedelta(dur)
     except Exception as e:
         logging.warning(f"Ivalid or missing duration: {dur}. Raised exception : {e}")
+    
+    cp = file.get('checkpoint')
+    if cp is not None:
+        try:
+            cp = pd.to_timedelta(cp)
+            if cp > pd.Timedelta(0):
+                sim_vars['checkpoint'] = cp
+            else:
+                logging.warning(f"Checkpoint interval must be positive: {cp}. Checkpointing disabled.")
+        except Exception as e:
+            logging.warning(f"Invalid checkpoint interval: {cp}. Checkpointing disabled. Raised exception : {e}")
         
         
     if flag:
@@ -207,6 +235,98 @@ def check_time_settings(flag, file, sim_vars, data_vars):
     return flag, sim_vars, data_vars
 
 
+# Output settings. Independent of the model time step, invalid values fall back to
+# OpenDrift defaults: every time step, all variables, complevel 6, no chunking.
+def check_output_settings(flag, file, sim_vars):
+    if not flag:
+        return flag, sim_vars
+    time_step = sim_vars.get('time_step', 3600)
+    # automatic time step is rounded to a divisor of the output interval later
+    time_step = 1 if time_step == 'auto' else abs(time_step)
+    rules = {
+        "time_step_output": {
+            "valid": lambda v: isinstance(v, int) and v != 0 and abs(v) % time_step == 0,
+            "error": "Invalid time_step_output: {}. Must be a non-zero multiple of time_step " + f"({time_step} s). Storing every time step.",
+        },
+        "export_variables": {
+            "valid": lambda v: isinstance(v, list) and all(isinstance(x, str) for x in v),
+            "error": "Invalid export_variables: {}. Must be a list of variable names. Exporting all variables.",
+        },
+        "complevel": {
+            "valid": lambda v: isinstance(v, int) and 0 <= v <= 9,
+            "error": "Invalid complevel: {}. Must be integer in [0, 9]. Using default 6.",
+        },
+        "chunksizes": {
+            "valid": lambda v: isinstance(v, dict) and len(v) > 0 and \
+                all(k in ['trajectory', 'time'] and isinstance(n, int) and n > 0 for k, n in v.items()),
+            "error": "Invalid chunksizes: {}. Must be dictionary with positive integer 'trajectory' and/or 'time'. Not chunking.",
+        },
+        "progress_interval": {
+            "valid": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool) and v >= 0,
+            "error": "Invalid progress_interval: {}. Must be seconds >= 0. Using default 60.",
+        },
+    }
+    for key, rule in rules.items():
+        val = file.get(key)
+        if val is None:
+            continue
+        if rule["valid"](val):
+            sim_vars[key] = abs(val) if key == 'time_step_output' else val
+        else:
+            logging.warning(rule["error"].format(val))
+    return flag, sim_vars
+
+# Domain landmask: True or {"resolution": degrees}. Rasterized over the data border.
+def check_landmask_settings(flag, file, sim_vars, data_vars):
+    val = file.get('landmask')
+    if not flag or val is None or val is False:
+        return flag, sim_vars
+    
+    # prepare_dataset default border
+    landmask = {'border': data_vars.get('border', [54, 62, 13, 30])}
+    options = val if isinstance(val, dict) else {}
+    if not isinstance(val, (dict, bool)):
+        logging.warning(f"Invalid landmask settings: {val}. Must be True or a dictionary. Using defaults.")
+    res = options.get('resolution')
+    if res is not None:
+        if isinstance(res, (int, float)) and not isinstance(res, bool) and 0 < res <= 0.1:
+            landmask['resolution'] = res
+        else:
+            logging.warning(f"Invalid landmask resolution: {res}. Must be degrees in (0, 0.1]. Using default.")
+    sim_vars['landmask'] = landmask
+    logging.info(f"Domain landmask enabled: {landmask}")
+    return flag, sim_vars
+
+# Extend mode. Existing output must be readable; its last time step becomes the new start time,
+# so that data selection and validation only need the newer forcing.
+def check_extend_settings(flag, file, sim_vars, data_vars):
+    ext = file.get('extend')
+    if not flag or ext is None:
+        return flag, sim_vars, data_vars
+    
+    if not isinstance(ext, str):
+        logging.error(f"Invalid extend: {ext}. Must be a path to an existing output file.")
+        return False, sim_vars, data_vars
+    path = ext if os.path.isfile(ext) else os.path.join(resolve_path("OUTPUT"), ext)
+    try:
+        import xarray as xr
+        with xr.open_dataset(path) as ds:
+            last = pd.Timestamp(ds.time.values[-1])
+    except Exception as e:
+        logging.error(f"Unable to read output file to extend: {path}. Raised exception : {e}")
+        return False, sim_vars, data_vars
+    
+    end = pd.to_datetime(sim_vars['end_t'])
+    if (end <= last and not file.get('backtracking')) or (end >= last and file.get('backtracking')):
+        logging.error(f"Output {path} already reaches end time {end} (last time step {last}).")
+        return False, sim_vars, data_vars
+    
+    sim_vars['extend'] = path
+    sim_vars['start_t'] = str(last)
+    data_vars['start_t'] = str(last)
+    logging.info(f"Extend settings verified, continuing {path} from {last}")
+    return flag, sim_vars, data_vars
+
 # Position settings. Will drop off if invalid position. Accept them if everythin is ok.
 def check_position_settings(flag, file, sim_vars):
     if not flag:
@@ -331,6 +451,12 @@ def check_logic_vars(flag, set_vars, file):
             set_vars[key] = val
         else:
             logging.warning(rule["error"].format(val))
+    
+    cluster_by = file.get('cluster_by', 'names')
+    if cluster_by in CLUSTER_MODES:
+        set_vars['cluster_by'] = cluster_by
+    else:
+        logging.warning(f"Invalid cluster_by: {cluster_by}. Must be one of {CLUSTER_MODES}. Using default: names")
     if flag:
         logging.info('Logic variables verified, success !')
                         
@@ -343,10 +469,34 @@ def check_post_processing(flag, set_vars, file):
     val = file.get('postprocessing', False)
     
     if isinstance(val, dict):
+        grid = val.pop('poc_grid', None)
+        picture = val.pop('picture', None)
+        ensemble = val.pop('ensemble', None)
+        parallel = val.pop('parallel', None)
+        vector_format = val.pop('vector_format', None)
+        tracks_format = val.pop('tracks_format', None)
         # Validate that all values are boolean
         if all(isinstance(v, bool) for v in val.values()) and \
             all(k in PROCESSINGS for k in val.keys()):
             set_vars['postprocessing'] = val
+            if grid is not None:
+                val['poc_grid'] = check_poc_grid(grid)
+            if picture is not None:
+                val['picture'] = check_picture(picture)
+            if ensemble is not None:
+                val['ensemble'] = check_ensemble(ensemble)
+            if parallel is not None:
+                val['parallel'] = check_parallel(parallel)
+            if vector_format is not None:
+                if vector_format in VECTOR_FORMATS:
+                    val['vector_format'] = vector_format
+                else:
+                    logging.warning(f"Invalid vector_format: {vector_format}. Using GeoJSON.")
+            if tracks_format is not None:
+                if tracks_format in TRACKS_FORMATS:
+                    val['tracks_format'] = tracks_format
+                else:
+                    logging.warning(f"Invalid tracks_format: {tracks_format}. Using parquet.")
         else:
             logging.warning(f"Invalid postprocessing values: {val}. All values must be boolean.")
             set_vars['postprocessing'] = False
@@ -355,6 +505,160 @@ def check_post_processing(flag, set_vars, file):
     
     return set_vars
 
+# POC grid: {"bins": n} in degrees, {"cell_size": metres} or {"rule": "fd"|"silverman", "max_bins": n}
+def check_poc_grid(grid):
+    if not isinstance(grid, dict) or not all(k in POC_GRID_KEYS for k in grid):
+        logging.warning(f"Invalid poc_grid {grid}. Using default 10x10 grid.")
+        return None
+    checked = {}
+    for key in ['bins', 'max_bins']:
+        if key in grid:
+            if isinstance(grid[key], int) and not isinstance(grid[key], bool) and grid[key] > 0:
+                checked[key] = grid[key]
+            else:
+                logging.warning(f"Invalid poc_grid {key}: {grid[key]}. Ignoring.")
+    if 'cell_size' in grid:
+        if isinstance(grid['cell_size'], (int, float)) and not isinstance(grid['cell_size'], bool) \
+            and grid['cell_size'] > 0:
+            checked['cell_size'] = float(grid['cell_size'])
+        else:
+            logging.warning(f"Invalid poc_grid cell_size: {grid['cell_size']}. Using automatic cell size.")
+            checked['rule'] = 'fd'
+    if 'rule' in grid:
+        if grid['rule'] in POC_GRID_RULES:
+            checked['rule'] = grid['rule']
+        else:
+            logging.warning(f"Invalid poc_grid rule: {grid['rule']}. Using 'fd'.")
+            checked['rule'] = 'fd'
+    return checked or None
+
+# Picture: {"renderer": "fast"|"opendrift", "max_vertices": n}
+def check_picture(picture):
+    if not isinstance(picture, dict) or not all(k in PICTURE_KEYS for k in picture):
+        logging.warning(f"Invalid picture settings {picture}. Using defaults.")
+        return None
+    checked = {}
+    if 'renderer' in picture:
+        if picture['renderer'] in PICTURE_RENDERERS:
+            checked['renderer'] = picture['renderer']
+        else:
+            logging.warning(f"Invalid picture renderer: {picture['renderer']}. Using 'fast'.")
+    if 'max_vertices' in picture:
+        value = picture['max_vertices']
+        if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+            checked['max_vertices'] = value
+        else:
+            logging.warning(f"Invalid picture max_vertices: {value}. Using default.")
+    return checked or None
+
+# Ensemble POC: {"name": str, "border": [min_lat, max_lat, min_lon, max_lon], "weight": float}
+def check_ensemble(ensemble):
+    if isinstance(ensemble, dict) and 'reset' in ensemble:
+        # a kept config value would restart the ensemble on every run
+        logging.warning("Ensemble reset is not a config setting, ignored. Use 'python main.py --reset-ensemble <name>'.")
+        ensemble = {k: v for k, v in ensemble.items() if k != 'reset'}
+    if not isinstance(ensemble, dict) or not all(k in ENSEMBLE_KEYS for k in ensemble):
+        logging.warning(f"Invalid ensemble settings {ensemble}. Ensemble disabled.")
+        return None
+    name = ensemble.get('name')
+    if not isinstance(name, str) or not re.fullmatch(r'[\w.-]+', name):
+        logging.warning(f"Invalid ensemble name: {name}. Ensemble disabled.")
+        return None
+    checked = {'name': name}
+    if 'border' in ensemble:
+        if verify_border(ensemble['border']):
+            checked['border'] = ensemble['border']
+        else:
+            logging.warning(f"Invalid ensemble border: {ensemble['border']}. Using the first member extent.")
+    if 'weight' in ensemble:
+        weight = ensemble['weight']
+        if isinstance(weight, (int, float)) and not isinstance(weight, bool) and weight > 0:
+            checked['weight'] = float(weight)
+        else:
+            logging.warning(f"Invalid ensemble weight: {weight}. Using 1.")
+    return checked
+
+# Parallel products: {"workers": n, "timeout": seconds}
+def check_parallel(parallel):
+    if not isinstance(parallel, dict) or not all(k in PARALLEL_KEYS for k in parallel):
+        logging.warning(f"Invalid parallel settings {parallel}. Using defaults.")
+        return None
+    checked = {}
+    for key in PARALLEL_KEYS:
+        if key not in parallel:
+            continue
+        value = parallel[key]
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+            checked[key] = int(value) if key == 'workers' else float(value)
+        else:
+            logging.warning(f"Invalid parallel {key}: {value}. Using default.")
+    return checked or None
+
+# Result cache. Disabled unless given, invalid options fall back to defaults.
+def check_cache_settings(flag, set_vars, file):
+    val = file.get('cache')
+    if not flag or val is None or val is False:
+        return set_vars
+    
+    rules = {
+        "retention": {
+            "valid": lambda v: pd.to_timedelta(v) > pd.Timedelta(0),
+            "error": "Invalid cache retention: {}. Must be a positive duration, e.g. '7days'. Using default.",
+        },
+        "max_entries": {
+            "valid": lambda v: isinstance(v, int) and v > 0,
+            "error": "Invalid cache max_entries: {}. Must be a positive integer. Using default.",
+        },
+        "fingerprint": {
+            "valid": lambda v: v in ['stat', 'content'],
+            "error": "Invalid cache fingerprint: {}. Must be 'stat' or 'content'. Using default.",
+        },
+        "purge": {
+            "valid": lambda v: isinstance(v, bool),
+            "error": "Invalid cache purge flag: {}. Must be True or False. Using default.",
+        },
+    }
+    cache = {}
+    options = val if isinstance(val, dict) else {}
+    if not isinstance(val, (dict, bool)):
+        logging.warning(f"Invalid cache settings: {val}. Must be True or a dictionary. Using defaults.")
+    for key, rule in rules.items():
+        v = options.get(key)
+        if v is None:
+            continue
+        try:
+            valid = rule["valid"](v)
+        except Exception:
+            valid = False
+        if valid:
+            cache[key] = v
+        else:
+            logging.warning(rule["error"].format(v))
+    set_vars['cache'] = cache
+    logging.info('Cache settings verified.')
+    return set_vars
+
+# Profiling: profiler name for the default stages or {"stage": "profiler"}. Invalid entries are dropped.
+def check_profile_settings(flag, set_vars, file):
+    val = file.get('profile')
+    if not flag or val is None:
+        return set_vars
+    
+    if isinstance(val, str) and val in PROFILERS:
+        set_vars['profile'] = val
+    elif isinstance(val, dict):
+        profile = {}
+        for stage, profiler in val.items():
+            if profiler in PROFILERS:
+                profile[stage] = profiler
+            else:
+                logging.warning(f"Invalid profiler for stage {stage}: {profiler}. Must be one of {PROFILERS}.")
+        if profile:
+            set_vars['profile'] = profile
+    else:
+        logging.warning(f"Invalid profile settings: {val}. Must be one of {PROFILERS} or a dictionary. Profiling disabled.")
+    return set_vars
+
 def verify_config_file(file_path):
     sim_vars = dict()
     data_vars = dict()
@@ -372,8 +676,11 @@ def verify_config_file(file_path):
         # parse the flag on each step, to avoid unncecary checkups if something failed
         flag, sim_vars = check_position_settings(flag, config, sim_vars)
         flag, sim_vars, data_vars = check_time_settings(flag, config, sim_vars, data_vars)
+        flag, sim_vars, data_vars = check_extend_settings(flag, config, sim_vars, data_vars)
+        flag, sim_vars = check_output_settings(flag, config, sim_vars)
         flag, sim_vars  = check_seed_settings(flag, config, sim_vars)           # if incorrect, fall back to defaults, do not raise an error. Flag just for skipping. 
         data_vars = check_data_settings(flag, config, data_vars)          # simulation can run with empty [] dataset, that will not raise an error
+        flag, sim_vars = check_landmask_settings(flag, config, sim_vars, data_vars)
         if flag:
             match config['model']:
                 case 'OceanDrift':
@@ -421,7 +728,7 @@ def verify_config_file(file_path):
                 sim_vars['forcing_flag'] = False
                 try:
                     np.asarray(forcings, dtype=float)
-                    if abs(forcings[1]) <=15 and abs(forcings[1]) <=50:
+                    if abs(forcings[1]) <=50 and abs(forcings[3]) <=15:
                         sim_vars['forcings'] = forcings
                         sim_vars['forcing_flag'] = True
                         logging.info('Forcings added.')
@@ -441,6 +748,8 @@ def verify_config_file(file_path):
             
         flag, set_vars = check_logic_vars(flag, set_vars, config)
         set_vars = check_post_processing(flag, set_vars, config)
+        set_vars = check_cache_settings(flag, set_vars, config)
+        set_vars = check_profile_settings(flag, set_vars, config)
         
     else:
         logging.error('Missing required keys in the configuration file.')
@@ -453,5 +762,6 @@ def verify_config_file(file_path):
         logging.info(f"Configurations used for data preparation: \n {json.dumps(data_vars, indent=2)}")
         sim_vars_copy = sim_vars.copy()
         sim_vars_copy['duration'] = str(sim_vars_copy.get('duration',None))
+        sim_vars_copy['checkpoint'] = str(sim_vars_copy.get('checkpoint',None))
         logging.info(f"Configurations used for simulation: \n {json.dumps(sim_vars_copy, indent=2)}")
     return flag, sim_vars, data_vars, set_vars
\ No newline at end of file
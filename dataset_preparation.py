@@ -4,6 +4,7 @@ import logging
 import xarray as xr
 import zoneinfo
 from general_tools import prepare_time
+from instrumentation import stage
 
 REQ_VARS_WAVE = ['VTM02', 'VHM0_WW', 'VHM0', 'VTM01_SW1', 'VMDR_SW1',
                  'VTPK', 'VSDX', 'VMDR_WW', 'VSDY', 'VHM0_SW1', 'VTM01_WW']
@@ -26,6 +27,12 @@ def cut_dataset(dataset, t0, t1):
     
     return dataset
  
+# Copernicus Marine dataset, lazily loaded
+def _open_copernicus(**kwargs):
+    import copernicusmarine
+    with stage('copernicus', kwargs['dataset_id']):
+        return copernicusmarine.open_dataset(**kwargs)
+
 def _open_concatenate_datasets(fp=None, file=None, wind_bool = False, ecmwf = [],
                   wind = [], netcdf = [], start_t=None, end_t=None):
     '''
@@ -42,28 +49,29 @@ def _open_concatenate_datasets(fp=None, file=None, wind_bool = False, ecmwf = []
         return wind_bool, ecmwf, wind, netcdf 
     
     if os.path.isfile(full_path):
-        if file.endswith('.grib'):
-            with xr.open_dataset(full_path, engine='cfgrib') as ds:
-                ds = ds.assign_coords(time=ds['time'] + ds['step'])
-                ds = ds.swap_dims({'step': 'time'})
-                ds = cut_dataset(ds, start_t, end_t)
-                if ds.sizes.get("time", 1) > 0 and len(ds.data_vars) > 0:
-                    ecmwf.append(ds)
-                if 'u10' in ds.data_vars:
-                    wind.append(xr.Dataset({'u10' : ds['u10'],
-                                        'v10': ds['v10']}))
-                    wind_bool = True
+        with stage('open', full_path):
+            if file.endswith('.grib'):
+                with xr.open_dataset(full_path, engine='cfgrib') as ds:
+                    ds = ds.assign_coords(time=ds['time'] + ds['step'])
+                    ds = ds.swap_dims({'step': 'time'})
+                    ds = cut_dataset(ds, start_t, end_t)
+                    if ds.sizes.get("time", 1) > 0 and len(ds.data_vars) > 0:
+                        ecmwf.append(ds)
+                    if 'u10' in ds.data_vars:
+                        wind.append(xr.Dataset({'u10' : ds['u10'],
+                                            'v10': ds['v10']}))
+                        wind_bool = True
  
-            logging.info(f'Readed GRIB file {full_path}')
-        elif file.endswith('.nc'):
-            with xr.open_dataset(full_path, engine='netcdf4') as ds:   
-                ds = cut_dataset(ds, start_t, end_t)
-                if ds.sizes.get("time", 1) > 0 and len(ds.data_vars) > 0:
-                    netcdf.append(ds)
+                logging.info(f'Readed GRIB file {full_path}')
+            elif file.endswith('.nc'):
+                with xr.open_dataset(full_path, engine='netcdf4') as ds:   
+                    ds = cut_dataset(ds, start_t, end_t)
+                    if ds.sizes.get("time", 1) > 0 and len(ds.data_vars) > 0:
+                        netcdf.append(ds)
 
-            logging.info(f'Readed NetCDF file {full_path}')
-        else:
-            logging.warning(f'Unknow file type {file}. Only .grib and .nc are currently supported.')
+                logging.info(f'Readed NetCDF file {full_path}')
+            else:
+                logging.warning(f'Unknow file type {file}. Only .grib and .nc are currently supported.')
     else:
         logging.error(f'Given file {file} is not valid. provide a single file.')
     return wind_bool, ecmwf, wind, netcdf 
@@ -121,27 +129,26 @@ def prepare_dataset(start_t, end_t, border = [54, 62, 13, 30],
             ds_ecmwf, ds_netcdf, ds_wind, wind = _read_folder(folder, wind, start_t, end_t)
             
     if copernicus:
-        import copernicusmarine
         if user is None or pword is None:
             logging.error('No login credentials provided.')
         else:
             try:
-                ds_1 = copernicusmarine.open_dataset(dataset_id='cmems_mod_bal_phy_anfc_PT1H-i', chunk_size_limit=0,
-                                                    username=user, password = pword,
-                                                    minimum_latitude=border[0], maximum_latitude=border[1],
-                                                    minimum_longitude=border[2], maximum_longitude=border[3],
-                                                    minimum_depth=0.5016462206840515, maximum_depth=0.5016462206840515,
-                                                    start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
-                                                    end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
+                ds_1 = _open_copernicus(dataset_id='cmems_mod_bal_phy_anfc_PT1H-i', chunk_size_limit=0,
+                                       username=user, password = pword,
+                                       minimum_latitude=border[0], maximum_latitude=border[1],
+                                       minimum_longitude=border[2], maximum_longitude=border[3],
+                                       minimum_depth=0.5016462206840515, maximum_depth=0.5016462206840515,
+                                       start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
+                                       end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
                 ds_copernicus.append(ds_1)
                 ds_1.close()
                 
-                ds_2 = copernicusmarine.open_dataset(dataset_id='cmems_mod_bal_wav_anfc_PT1H-i', chunk_size_limit=0,
-                                                    username = user,  password = pword,
-                                                    minimum_latitude=border[0], maximum_latitude=border[1],
-                                                    minimum_longitude=border[2], maximum_longitude=border[3],
-                                                    start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
-                                                    end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
+                ds_2 = _open_copernicus(dataset_id='cmems_mod_bal_wav_anfc_PT1H-i', chunk_size_limit=0,
+                                       username = user,  password = pword,
+                                       minimum_latitude=border[0], maximum_latitude=border[1],
+                                       minimum_longitude=border[2], maximum_longitude=border[3],
+                                       start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
+                                       end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
                 ds_copernicus.append(ds_2)
                 ds_2.close()
                 
@@ -149,31 +156,31 @@ def prepare_dataset(start_t, end_t, border = [54, 62, 13, 30],
                 logging.warning('No data found in Copernicus Baltic. Searching in copernicus global...')
                 # ds_copernicus = []
                 try:
-                    ds_1 = copernicusmarine.open_dataset(dataset_id='cmems_mod_glo_phy_anfc_0.083deg_PT1H-m', chunk_size_limit=0,
-                                                        username=user, password = pword, 
-                                                        minimum_latitude=border[0], maximum_latitude=border[1],
-                                                        minimum_longitude=border[2], maximum_longitude=border[3],
-                                                        minimum_depth=0.49402499198913574, maximum_depth=0.49402499198913574,
-                                                        start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
-                                                        end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
+                    ds_1 = _open_copernicus(dataset_id='cmems_mod_glo_phy_anfc_0.083deg_PT1H-m', chunk_size_limit=0,
+                                           username=user, password = pword, 
+                                           minimum_latitude=border[0], maximum_latitude=border[1],
+                                           minimum_longitude=border[2], maximum_longitude=border[3],
+                                           minimum_depth=0.49402499198913574, maximum_depth=0.49402499198913574,
+                                           start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
+                                           end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
                     ds_copernicus.append(ds_1)
                     ds_1.close()
 
-                    ds_2 = copernicusmarine.open_dataset(dataset_id='cmems_mod_glo_wav_anfc_0.083deg_PT3H-i', chunk_size_limit=0, 
-                                                        username=user, password = pword,
-                                                        minimum_latitude=border[0], maximum_latitude=border[1],
-                                                        minimum_longitude=border[2], maximum_longitude=border[3],
-                                                        start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
-                                                        end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
+                    ds_2 = _open_copernicus(dataset_id='cmems_mod_glo_wav_anfc_0.083deg_PT3H-i', chunk_size_limit=0, 
+                                           username=user, password = pword,
+                                           minimum_latitude=border[0], maximum_latitude=border[1],
+                                           minimum_longitude=border[2], maximum_longitude=border[3],
+                                           start_datetime=start_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')),
+                                           end_datetime=end_t.replace(tzinfo=zoneinfo.ZoneInfo('UTC')))
                     ds_copernicus.append(ds_2)
                     ds_2.close()
 
                 except:
                     logging.warning('No requested data in Copernicus Global.')
-            ds_3 = copernicusmarine.open_dataset(dataset_id='cmems_mod_bal_wav_anfc_static', chunk_size_limit=0,
-                                                username = user, password = pword,
-                                                minimum_latitude=border[0], maximum_latitude=border[1],
-                                                minimum_longitude=border[2], maximum_longitude=border[3])
+            ds_3 = _open_copernicus(dataset_id='cmems_mod_bal_wav_anfc_static', chunk_size_limit=0,
+                                   username = user, password = pword,
+                                   minimum_latitude=border[0], maximum_latitude=border[1],
+                                   minimum_longitude=border[2], maximum_longitude=border[3])
             ds_copernicus.append(ds_3)
             ds_3.close()
                 
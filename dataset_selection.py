@@ -18,8 +18,8 @@ def check_folder_structure(folder) -> str:
     else:
         return 'mixed'
 
-def return_time_interval(file) -> dict:
-    # Reads metadata and return {path : [t_first, t_last]}
+def return_time_interval(file, variables = None) -> dict:
+    # Reads metadata and return {path : [t_first, t_last]}, data variables are added to `variables` if given
     interval = {}
     file = Path(file)
     
@@ -28,11 +28,15 @@ def return_time_interval(file) -> dict:
             with xr.open_dataset(file) as ds:
                 t0 = ds.time.values + ds.step[0].values
                 t1 = ds.time.values + ds.step[-1].values
+                if variables is not None:
+                    variables[file] = sorted(str(v) for v in ds.data_vars)
             interval[file] = [t0,t1]
         elif file.suffix == '.nc':
             with xr.open_dataset(file) as ds:
                 t0 = ds.time[0].values
                 t1 = ds.time[-1].values
+                if variables is not None:
+                    variables[file] = sorted(str(v) for v in ds.data_vars)
             interval[file] = [t0,t1]
         else:
             logging.error(f'{file.suffix} files are not currently supported.') 
@@ -41,7 +45,7 @@ def return_time_interval(file) -> dict:
     return interval
 
 # Based on folder structure, reads all files (lazy)
-def read_root_directory(root) -> dict:
+def read_root_directory(root, variables = None) -> dict:
     pth = Path(root)
     result = {}
     # checks whetere folder is flat or nested 
@@ -49,11 +53,11 @@ def read_root_directory(root) -> dict:
     # append all files with their intervals
     if struct == 'files':
         for file in pth.iterdir():
-            result.update(return_time_interval(file))
+            result.update(return_time_interval(file, variables))
     elif struct == 'dirs':
         for folder in pth.iterdir():
             for file in folder.iterdir():
-                result.update(return_time_interval(file))
+                result.update(return_time_interval(file, variables))
     else:
         logging.error('Mixed structure files + dirs is unsupported.')    
     return result
@@ -80,7 +84,7 @@ def filter_files_by_time_interval(start_t, end_t, all_paths) -> list:
     return matching_paths
 
 # Switch the root dir to /SELECTED and symlink files to it
-def symlink_selected_files(paths):
+def symlink_selected_files(paths, cluster_by = 'names', variables = None):
     select_dir = resolve_path("SELECTED")
     if paths == []:
         return select_dir
@@ -91,7 +95,7 @@ def symlink_selected_files(paths):
     common = Path(os.path.commonpath(paths))
 
     if any([file.parent.relative_to(common) == Path('') for file in paths]):
-        rel_paths = cluster_files(paths)
+        rel_paths = cluster_files(paths, cluster_by, variables)
     else:
         rel_paths = [p.relative_to(common) for p in paths]
 
@@ -108,17 +112,20 @@ def symlink_selected_files(paths):
 
 # Select files from folder that intersect given time and restructure dataset directory
 # Function reads time metadata of all files, selects matching, makes new directory and symlink files to it  
-def select_dataset(start_t, end_t, folder) -> dict:
+# cluster_by: how a flat folder is split into datasets, by file 'names' or data 'variables'
+def select_dataset(start_t, end_t, folder, cluster_by = 'names') -> dict:
     changes = {}
     start_t = prepare_time(start_t)
     end_t = prepare_time(end_t)
+    # variables are read together with the times, files are opened once
+    variables = {} if cluster_by == 'variables' else None
     # Read all files in folder. Return dict {path:[t_first, t_last], ... }
-    files = read_root_directory(folder)
+    files = read_root_directory(folder, variables)
     # Select files that has overlaping time interval with requested time. Return list [path1, path2, ... ]
     requested = filter_files_by_time_interval(start_t, end_t, files)
     print(requested)
     # Re-root selected files with symlink to new folder 'SELECTED' 
-    new_folder = symlink_selected_files(requested)
+    new_folder = symlink_selected_files(requested, cluster_by, variables)
     changes['folder'] = new_folder
     if check_folder_structure(new_folder) == 'dirs':
             changes['concatenation'] = True
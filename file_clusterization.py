@@ -1,78 +1,78 @@
+import re
+import hashlib
+from collections import Counter
 from pathlib import Path
 
-#File name normalization. Split into words. 
+'''
+    Flat archive clustering: each file is assigned to a subfolder named after its dataset.
+    By names: files with the same word sequence in their name are one dataset, the subfolder is named
+    after a word that only this sequence has. By variables: files with the same data variables are one dataset.
+'''
+CLUSTER_MODES = ['names', 'variables']
+SEPARATORS = re.compile(r'[-_]')
+NON_ALPHA = re.compile(r'[\W\d_]+')
+MAX_FOLDER_NAME = 64
+
+#File name normalization. Split into words.
 def split_name(filepath:str) -> list:
     """
     Split a file name (without extension) into words.
-    Words are separated by non-alphabetic characters like '-' or '_'.
+    Words are separated by '-' or '_', other non-alphabetic characters are dropped.
+    The file is not accessed.
     """
-    filepath = Path(filepath)
-    words = []
-    if filepath.is_file():
-        name_without_suffix = filepath.name.removesuffix(filepath.suffix)
-        current_word = ''
-        for char in name_without_suffix:
-            if char .isalpha():
-                current_word +=char 
-            if char in ['-', '_']:
-                words.append(current_word)
-                current_word  = ''
-        if current_word != '':
-            words.append(current_word)
-    return words 
+    words = [NON_ALPHA.sub('', part) for part in SEPARATORS.split(Path(filepath).stem)]
+    return [word for word in words if word]
 
 # Accept only unique sequences
 def unique_sequences(tokens:list) -> list:
     """
-    Return a list of unique tokens, preserving order.
+    Return a list of unique token sequences, preserving order.
     """
-    seen = set()
-    unique_tokens = []
-
-    for token in tokens:
-        if token not in seen:
-            seen.add(token)
-            unique_tokens.append(token)
-
-    return unique_tokens
+    return list(dict.fromkeys(tuple(t) for t in tokens))
 
 # For each sequence select reprezentative word (one element)
 def find_repr_word(groups:list) -> list:
     """
     For each group of tokens, select a representative word
-    that is unique to that group.
+    that is unique to that group (first one in the group), None if there is none.
     """
     group_sets = [set(g) for g in groups]
-    representatives = []
+    # number of groups each token appears in, a token is unique when it is in one group only
+    counts = Counter(token for g in group_sets for token in g)
+    return [next((token for token in g if counts[token] == 1), None) for g in groups]
 
-    for i, current in enumerate(group_sets):
-        others = set().union(*[g for j, g in enumerate(group_sets) if j != i])
-        unique_tokens = current - others
+def _folder_name(words) -> str:
+    name = '_'.join(words) or 'unnamed'
+    if len(name) > MAX_FOLDER_NAME:
+        name = f"{'_'.join(words[:3])}_{hashlib.sha1(name.encode()).hexdigest()[:8]}"
+    return name
 
-        # pick one representative (arbitrary but unique)
-        representatives.append(next(iter(unique_tokens)) if unique_tokens else None)
-        
-    return representatives
+# Data variables of a dataset file, sorted
+def file_variables(file) -> list:
+    import xarray as xr
+    try:
+        with xr.open_dataset(file) as ds:
+            return sorted(str(v) for v in ds.data_vars)
+    except Exception:
+        return []
 
 # function accepts list o paths to files (or just filenames)
 # returns list of filenames with relative paths (with structurised parent folder)
-def cluster_files(files:list) -> list:
-    # Only keep existing files
-    files = [f for f in files if f.is_file()]
+# cluster_by 'variables' groups by the data variables, given as {path: [variables]} or read from the files
+def cluster_files(files:list, cluster_by:str = 'names', variables:dict = None) -> list:
+    files = [Path(f) for f in files]
     if not files:
         return []
-    
-    name_tokens = [split_name(file) for file in files]
+
+    if cluster_by == 'variables':
+        variables = variables or {}
+        folders = [_folder_name(variables[f] if f in variables else file_variables(f)) for f in files]
+        return [Path(folder) / file.name for folder, file in zip(folders, files)]
+
+    name_tokens = [tuple(split_name(file)) for file in files]
     unique_tokens = unique_sequences(name_tokens)
     representatives = find_repr_word(unique_tokens)
-    
-    clustered_paths = []
-    
-    for file in files:
-        filename = file.name
-        for token in representatives:
-            if token and token in filename:
-                clustered_paths.append(Path(token) / filename)
-                continue
-    
-    return clustered_paths
\ No newline at end of file
+    # sequences without an own word keep the full sequence as folder name
+    folders = {seq: token or _folder_name(seq) for seq, token in zip(unique_tokens, representatives)}
+
+    return [Path(folders[tokens]) / file.name for tokens, file in zip(name_tokens, files)]
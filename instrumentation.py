@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import resource
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+from general_tools import resolve_path
+
+'''
+    Stage instrumentation: wall time, CPU time, peak RSS and bytes read for each pipeline stage and sub-step.
+    A run is recorded between start_recording and finish_recording, stages are nested with `with stage(name):`.
+    Outside of a recorded run stage() does nothing.
+    Results are written as JSON next to the output file (<output>_metrics.json). If the METRICS_PROM
+    environment variable is set, totals per stage are also written there in Prometheus text format
+    (e.g. for the node_exporter textfile collector).
+    All counters are of the whole process: with concurrent jobs (worker_service.py) cpu_s, read_bytes
+    and disk_read_bytes of a stage include the other jobs, and peak_rss_mb is the process peak during the stage.
+'''
+METRICS_SUFFIX = '_metrics.json'
+PROM_PREFIX = 'opendrift'
+PROM_METRICS = [('wall_s', 'stage_wall_seconds', 'Wall time of a pipeline stage'),
+                ('cpu_s', 'stage_cpu_seconds', 'CPU time of the whole process during a pipeline stage'),
+                ('read_bytes', 'stage_read_bytes', 'Bytes read by the whole process during a pipeline stage'),
+                ('peak_rss_mb', 'stage_peak_rss_megabytes', 'Peak resident memory of the whole process during a pipeline stage')]
+
+_recorder = contextvars.ContextVar('recorder', default=None)
+
+# rchar: all bytes read (also from page cache), read_bytes: bytes fetched from storage
+def _io_counters():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _peak_rss_mb() -> float:
+    # kilobytes on Linux, peak of the process lifetime
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _hwm_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _reset_hwm() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# Peak RSS of each open stage. VmHWM is reset when a stage starts, the peak up to then is kept
+# by all open stages (nested ones and those of concurrent jobs) before the reset.
+_peak_lock = threading.Lock()
+_open_peaks = {}
+
+def _enter_peak():
+    with _peak_lock:
+        hwm = _hwm_mb()
+        if hwm is None or not _reset_hwm():
+            return None
+        for peak in _open_peaks.values():
+            peak['mb'] = max(peak['mb'], hwm)
+        peak = {'mb': _hwm_mb() or 0.0}
+        _open_peaks[id(peak)] = peak
+        return peak
+
+# Process lifetime peak where VmHWM cannot be reset
+def _exit_peak(peak) -> float:
+    if peak is None:
+        return _peak_rss_mb()
+    with _peak_lock:
+        hwm = _hwm_mb() or 0.0
+        _open_peaks.pop(id(peak))
+        for other in _open_peaks.values():
+            other['mb'] = max(other['mb'], hwm)
+        return max(peak['mb'], hwm)
+
+def _sample() -> dict:
+    rchar, disk = _io_counters()
+    return {'wall': time.perf_counter(), 'cpu': time.process_time(), 'rchar': rchar, 'disk': disk}
+
+def start_recording(job):
+    recorder = {'job': job, 'start': _sample(), 'stack': [], 'stages': [], 'output': None,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'profile': {}, 'peak': _enter_peak()}
+    _recorder.set(recorder)
+    return recorder
+
+# {stage: profiler} of the recorded run, see profiling.py
+def set_profile(profile):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder['profile'] = profile
+
+# Output file of the recorded run, the metrics are written next to it
+def set_output(file_name):
+    recorder = _recorder.get()
+    if recorder is not None:
+        recorder['output'] = file_name
+
+@contextmanager
+def stage(name, detail = None):
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    recorder['stack'].append(name)
+    path = '/'.join(recorder['stack'])
+    profiler = recorder['profile'].get(path)
+    peak = _enter_peak()
+    start = _sample()
+    try:
+        if profiler:
+            from profiling import profiled
+            with profiled(profiler, recorder['job'], path):
+                yield
+        else:
+            yield
+    finally:
+        end = _sample()
+        peak_mb = _exit_peak(peak)
+        recorder['stack'].pop()
+        record = {'stage': path, 'start_s': round(start['wall'] - recorder['start']['wall'], 4),
+                  'wall_s': round(end['wall'] - start['wall'], 4),
+                  'cpu_s': round(end['cpu'] - start['cpu'], 4),
+                  'peak_rss_mb': round(peak_mb, 1),
+                  'read_bytes': end['rchar'] - start['rchar'] if start['rchar'] is not None else None,
+                  'disk_read_bytes': end['disk'] - start['disk'] if start['disk'] is not None else None}
+        if detail is not None:
+            record['detail'] = str(detail)
+        recorder['stages'].append(record)
+
+# Stage totals (repeated sub-steps, e.g. file opens, are summed)
+def stage_totals(stages) -> dict:
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record['stage'], {'count': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                    'read_bytes': 0, 'peak_rss_mb': 0.0})
+        total['count'] += 1
+        for key in ['wall_s', 'cpu_s', 'read_bytes']:
+            total[key] += record[key] or 0
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+    return totals
+
+def metrics_path(recorder) -> str:
+    if recorder['output']:
+        return os.path.splitext(recorder['output'])[0] + METRICS_SUFFIX
+    return os.path.join(resolve_path("OUTPUT"), os.path.splitext(recorder['job'])[0] + METRICS_SUFFIX)
+
+def prometheus_text(metrics) -> str:
+    lines = []
+    totals = metrics['totals']
+    for key, name, description in PROM_METRICS:
+        lines += [f'# HELP {PROM_PREFIX}_{name} {description}', f'# TYPE {PROM_PREFIX}_{name} gauge']
+        for path, total in totals.items():
+            lines.append(f'{PROM_PREFIX}_{name}{{job="{metrics["job"]}",stage="{path}"}} {total[key]}')
+    lines += [f'# HELP {PROM_PREFIX}_run_exit_code Exit code of the last run',
+              f'# TYPE {PROM_PREFIX}_run_exit_code gauge',
+              f'{PROM_PREFIX}_run_exit_code{{job="{metrics["job"]}"}} {metrics["code"]}']
+    return '\n'.join(lines) + '\n'
+
+def _write_atomic(path, text):
+    # unique temporary file, concurrent runs may write the same METRICS_PROM file
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '_', suffix='_tmp', dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    # mkstemp creates the file readable by the owner only, collectors may run as another user
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+
+def finish_recording(code) -> dict:
+    recorder = _recorder.get()
+    if recorder is None:
+        return None
+    _recorder.set(None)
+    end = _sample()
+    metrics = {'job': recorder['job'], 'output': recorder['output'], 'code': code,
+               'started': recorder['started'],
+               'wall_s': round(end['wall'] - recorder['start']['wall'], 4),
+               'cpu_s': round(end['cpu'] - recorder['start']['cpu'], 4),
+               'peak_rss_mb': round(_exit_peak(recorder['peak']), 1),
+               'stages': recorder['stages'],
+               'totals': stage_totals(recorder['stages'])}
+    try:
+        path = metrics_path(recorder)
+        _write_atomic(path, json.dumps(metrics, indent=2))
+        logging.info(f'Run metrics saved: {path}')
+        prom = os.getenv('METRICS_PROM')
+        if prom:
+            _write_atomic(prom, prometheus_text(metrics))
+    except OSError as e:
+        logging.warning(f'Unable to write run metrics: {e}')
+    return metrics
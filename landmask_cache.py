@@ -0,0 +1,100 @@
+import os
+import logging
+import numpy as np
+import pyproj
+from functools import lru_cache
+from opendrift.readers.basereader import BaseReader, ContinuousReader
+from opendrift.readers.reader_global_landmask import get_mask
+from general_tools import resolve_path
+
+'''
+    Domain landmask: the GSHHG landmask rasterized once per border and resolution.
+    Stored as .npy in OUTPUT/cache/landmask and memory-mapped, so processes and runs share it.
+    Land checks in the model loop become array lookups instead of global landmask queries.
+'''
+LANDMASK_DIR = os.path.join('cache', 'landmask')
+# degrees, ~550 m in latitude
+RESOLUTION = 0.005
+ROWS_PER_BLOCK = 100
+
+def landmask_path(border, resolution = RESOLUTION) -> str:
+    folder = os.path.join(resolve_path("OUTPUT"), LANDMASK_DIR)
+    os.makedirs(folder, exist_ok=True)
+    name = '_'.join(f'{v:g}' for v in [*border, resolution])
+    return os.path.join(folder, f'landmask_{name}.npy')
+
+# Land at cell centres, rows from min_lat, columns from min_lon
+def rasterize_landmask(border, resolution = RESOLUTION) -> np.ndarray:
+    min_lat, max_lat, min_lon, max_lon = border
+    lon = min_lon + (np.arange(int(np.ceil((max_lon - min_lon) / resolution))) + 0.5) * resolution
+    lat = min_lat + (np.arange(int(np.ceil((max_lat - min_lat) / resolution))) + 0.5) * resolution
+    mask = get_mask()
+    raster = np.empty((lat.size, lon.size), dtype=bool)
+    for start in range(0, lat.size, ROWS_PER_BLOCK):
+        lons, lats = np.meshgrid(lon, lat[start:start + ROWS_PER_BLOCK])
+        raster[start:start + lats.shape[0]] = mask.contains_many(lons.ravel(), lats.ravel()).reshape(lons.shape)
+    return raster
+
+@lru_cache(maxsize=8)
+def load_landmask(border, resolution = RESOLUTION) -> np.ndarray:
+    path = landmask_path(border, resolution)
+    if not os.path.exists(path):
+        logging.info(f'Rasterizing landmask for {list(border)} at {resolution} deg')
+        raster = rasterize_landmask(border, resolution)
+        # unique temporary file, so that processes rasterizing the same domain do not collide
+        tmp = f'{path[:-4]}_{os.getpid()}_tmp.npy'
+        np.save(tmp, raster)
+        os.replace(tmp, path)
+        logging.info(f'Landmask {raster.shape} saved: {path}')
+    return np.load(path, mmap_mode='r')
+
+class Reader(BaseReader, ContinuousReader):
+    '''
+    land_binary_mask from the domain raster. Positions outside the raster
+    are checked with the global landmask, loaded only when needed.
+    '''
+    name = 'domain_landmask'
+    variables = ['land_binary_mask']
+    proj4 = None
+    crs = None
+
+    def __init__(self, raster, border, resolution = RESOLUTION):
+        self.proj4 = '+proj=lonlat +ellps=WGS84'
+        self.crs = pyproj.CRS(self.proj4)
+
+        super(Reader, self).__init__()
+
+        self.z = None
+        self.xmin, self.ymin = -180, -90
+        self.xmax, self.ymax = 180, 90
+
+        self.raster = raster
+        self.min_lat, self.min_lon = border[0], border[2]
+        self.resolution = resolution
+        self.global_mask = None
+
+    def __on_land__(self, x, y):
+        x = np.asarray(self.modulate_longitude(x), dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        row = np.floor((y - self.min_lat) / self.resolution)
+        col = np.floor((x - self.min_lon) / self.resolution)
+        inside = (row >= 0) & (row < self.raster.shape[0]) & (col >= 0) & (col < self.raster.shape[1])
+        land = np.zeros(x.shape, dtype=bool)
+        land[inside] = self.raster[row[inside].astype(int), col[inside].astype(int)]
+        if not inside.all():
+            if self.global_mask is None:
+                self.global_mask = get_mask()
+            land[~inside] = self.global_mask.contains_many(x[~inside], y[~inside])
+        return land
+
+    def get_variables(self, requestedVariables, time=None, x=None, y=None, z=None):
+        self.check_arguments(requestedVariables, time, x, y, z)
+        return {'land_binary_mask': self.__on_land__(x, y)}
+
+# Use the domain landmask instead of the automatic global one
+def attach_landmask(o, border, resolution = RESOLUTION):
+    raster = load_landmask(tuple(border), resolution)
+    o.set_config('general:use_auto_landmask', False)
+    o.add_reader(Reader(raster, border, resolution))
+    logging.info(f'Domain landmask {raster.shape} attached for {list(border)}')
+    return o
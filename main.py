@@ -1,6 +1,6 @@
 from config_verification import verify_config_file
-from case_study_tool import simulation
 from dataset_verification import validate_dataset
+from instrumentation import start_recording, finish_recording, set_output, set_profile, stage
 import sys
 import json 
 import logging
@@ -20,36 +20,81 @@ def resolve_config_path(cfg: str) -> str:
 
     return os.path.join("INPUT", cfg)
 
-def main() -> int:
-    if len(sys.argv) < 2:
-        logging.error("Usage: python main.py <config.json>")
-        return 1
+def run_postprocessing(file_name, post_proc):
+    if not post_proc:
+        return 0, {}
+    try:
+        from post_processing import postprocess_file
+        
+        return 0, postprocess_file(file_name, post_proc)
+    except ImportError as e:
+        logging.error(f'Module post_processing not available: {e}')
+        return 11, {}
+    except Exception as e:
+        logging.exception(f"Postprocessing failed: {e}")
+        return 11, {}
 
-    raw_path = sys.argv[1]
-    
-    input_file = resolve_config_path(raw_path)
+def load_vocabulary(vocab_path = "DATA/VariableMapping.json"):
+    if not os.path.exists(vocab_path):
+        logging.error(f"Vocabulary file missing: {vocab_path}")
+        return 4, None
+
+    try:
+        with open(vocab_path, "r") as f:
+            return 0, json.load(f)
+    except json.JSONDecodeError:
+        logging.error("Vocabulary JSON format error.")
+        return 5, None
+
+# All stages of a run for one config file. Returns the exit code of main().
+# vocabulary_data and prepare (dataset preparation) can be supplied by a long-running caller.
+# Stage metrics are written next to the output file (see instrumentation.py).
+def run_config(input_file, resume = False, postprocess_only = False, vocabulary_data = None, prepare = None) -> int:
     if not os.path.exists(input_file):
         logging.error(f"Config file '{input_file}' does not exist.")
         return 2
 
+    start_recording(os.path.basename(input_file))
+    code = 1
+    try:
+        code = _run_stages(input_file, resume, postprocess_only, vocabulary_data, prepare)
+    finally:
+        finish_recording(code)
+    return code
+
+def _run_stages(input_file, resume, postprocess_only, vocabulary_data, prepare) -> int:
     logging.info("Validating input...")
-    is_valid, sim_vars, data_vars, settings = verify_config_file(input_file)
+    with stage('validation'):
+        is_valid, sim_vars, data_vars, settings = verify_config_file(input_file)
 
     if not is_valid:
         logging.error("Validation failed.")
         return 3
 
-    vocab_path = "DATA/VariableMapping.json"
-    if not os.path.exists(vocab_path):
-        logging.error(f"Vocabulary file missing: {vocab_path}")
-        return 4
+    if settings.get('profile') or os.getenv('PROFILE'):
+        from profiling import active_profile
+        set_profile(active_profile(settings.get('profile')))
 
-    try:
-        with open(vocab_path, "r") as f:
-            vocabulary_data = json.load(f)
-    except json.JSONDecodeError:
-        logging.error("Vocabulary JSON format error.")
-        return 5
+    if vocabulary_data is None:
+        with stage('vocabulary'):
+            code, vocabulary_data = load_vocabulary()
+        if code:
+            return code
+
+    post_proc = settings.get('postprocessing')
+    if postprocess_only:
+        # products of an existing output with the current postprocessing settings
+        from general_tools import resolve_path
+        
+        file_name = sim_vars.get('file_name')
+        if file_name is None or not post_proc:
+            logging.error("--postprocess needs 'file_name' and 'postprocessing' in the config.")
+            return 11
+        if not os.path.exists(file_name):
+            file_name = os.path.join(resolve_path("OUTPUT"), file_name)
+        set_output(file_name)
+        with stage('postprocessing'):
+            return run_postprocessing(file_name, post_proc)[0]
 
     logging.info("Input valid. Preparing datasets...")
     
@@ -66,7 +111,8 @@ def main() -> int:
             from dataset_selection import select_dataset
             
             folder = data_vars.get('folder')
-            data_vars.update(select_dataset(start_t, end_t, folder))
+            with stage('selection'):
+                data_vars.update(select_dataset(start_t, end_t, folder, settings.get('cluster_by', 'names')))
         except ImportError as e:
             logging.error(f'Module dataset_selection not available: {e}')
             return 10
@@ -74,11 +120,38 @@ def main() -> int:
             logging.exception(f'Dataset selection failed: {e}')
             return 10
         logging.info(f'Data is selected. Reading...')
+    
+    '''
+        RESULT CACHE
+    Identical config and forcing files return the existing output
+    '''
+    cache = settings.get('cache')
+    if cache is not None and data_vars.get('copernicus'):
+        # downloaded forcing changes between runs and has no files to fingerprint
+        logging.info('Result cache is not used for Copernicus forcing.')
+        cache = None
+    if cache is not None:
+        try:
+            from result_cache import cache_key, lookup
+            
+            vc = settings.get("vocabulary")
+            with stage('cache_lookup'):
+                key = cache_key(sim_vars, data_vars, settings, vocabulary_data.get(vc), cache.get('fingerprint', 'stat'))
+                hit = lookup(key, cache)
+        except Exception as e:
+            logging.warning(f'Result cache unavailable, running without it: {e}')
+            cache, hit = None, None
+        if hit:
+            logging.info(f"Returning cached result {hit['file_name']} with products {hit['products']}")
+            print("Simulation completed successfully.")
+            return 0
         
     try:
-        from dataset_preparation import prepare_dataset
+        if prepare is None:
+            from dataset_preparation import prepare_dataset as prepare
         
-        ds = prepare_dataset(**data_vars)
+        with stage('preparation'):
+            ds = prepare(**data_vars)
     except ImportError as e:
         logging.error(f'Module dataset_preparation not available: {e}')
         return 6
@@ -94,32 +167,57 @@ def main() -> int:
         return 7
     
     empty = settings.get('allow_empty_ds')
-    if not validate_dataset(ds, start_t, end_t, empty):
+    with stage('dataset_validation'):
+        valid = validate_dataset(ds, start_t, end_t, empty)
+    if not valid:
         logging.error('Dataset time validation failed. ')
         return 8
 
     try:
-        o, file_name = simulation(datasets=ds, std_names=vocabulary_data[vc], **sim_vars)
+        from case_study_tool import simulation
+        
+        with stage('simulation'):
+            o, file_name = simulation(datasets=ds, std_names=vocabulary_data[vc], resume=resume, **sim_vars)
     except Exception as e:
         logging.exception(f"Simulation failed: {e}")
         return 9
     
-    post_proc = settings.get('postprocessing')
-    if post_proc:
-        try:
-            from post_processing import postprocess_trajectory
-            
-            postprocess_trajectory(o, file_name, post_proc)
-        except ImportError as e:
-            logging.error(f'Module dataset_preparation not available: {e}')
-            return 11
-        except Exception as e:
-            logging.exception(f"Postprocessing failed: {e}")
-            return 11
+    # products are made from the output file, the trajectory does not need to stay in memory
+    del o
+    set_output(file_name)
+    with stage('postprocessing'):
+        code, products = run_postprocessing(file_name, post_proc)
+    if code:
+        return code
+    
+    if cache is not None:
+        from result_cache import store
+        with stage('cache_store'):
+            store(key, file_name, products, cache)
 
     print("Simulation completed successfully.")
     return 0
 
+def main() -> int:
+    if len(sys.argv) < 2:
+        logging.error("Usage: python main.py <config.json> [--resume | --postprocess] | --reset-ensemble <name>")
+        return 1
+    if sys.argv[1] == '--reset-ensemble':
+        if len(sys.argv) < 3:
+            logging.error("Usage: python main.py --reset-ensemble <name>")
+            return 1
+        from post_processing import reset_ensemble
+        if not reset_ensemble(sys.argv[2]):
+            logging.warning(f"Ensemble {sys.argv[2]} does not exist.")
+        return 0
+
+    raw_path = sys.argv[1]
+    resume = '--resume' in sys.argv[2:]
+    postprocess_only = '--postprocess' in sys.argv[2:]
+    
+    input_file = resolve_config_path(raw_path)
+    return run_config(input_file, resume, postprocess_only)
+
 
 if __name__ == "__main__":
     exit(main())
\ No newline at end of file
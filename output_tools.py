@@ -0,0 +1,80 @@
+import os
+import types
+import shutil
+import logging
+import opendrift
+import xarray as xr
+from netCDF4 import Dataset
+
+'''
+    Output file encoding: compression level and chunking of the trajectory NetCDF
+'''
+# OpenDrift default when finalising the output file
+COMPLEVEL = 6
+# OpenDrift versions whose io_netcdf.close is mirrored by close_output.
+# Other versions keep their own io_close and the output is rewritten once more afterwards.
+CLOSE_VERSIONS = ['1.14.6']
+
+def output_encoding(result, complevel = COMPLEVEL, chunksizes = None, encoding = None) -> dict:
+    encoding = {k: dict(v) for k, v in (encoding or {}).items()}
+    for varname, var in result.data_vars.items():
+        enc = encoding.setdefault(varname, {})
+        if complevel:
+            enc.update({'zlib': True, 'complevel': complevel})
+        else:
+            enc.update({'zlib': False})
+        if chunksizes and var.dims:
+            enc['chunksizes'] = tuple(min(chunksizes.get(d, result.sizes[d]), result.sizes[d])
+                                      for d in var.dims)
+    return encoding
+
+# Same as opendrift.export.io_netcdf.close of CLOSE_VERSIONS, but with configurable compression and chunking.
+# The final rewrite to fixed dimensions is done anyway, so the encoding costs no extra pass.
+def close_output(self, complevel = COMPLEVEL, chunksizes = None):
+    self.outfile = Dataset(self.outfile_name, 'a')
+    for var in self.result.data_vars:  # Updating variable attributes, if changed during simulation
+        for atn, atv in self.result[var].attrs.items():
+            if atn != '_FillValue':
+                self.outfile[var].setncattr(atn, atv)
+    for atn, atv in self.result.attrs.items():  # Updating global attributes
+        self.outfile.setncattr(atn, atv)
+    self.outfile.sync()
+    self.outfile.close()
+
+    self.result = xr.open_dataset(self.outfile_name)
+    if self.num_elements_scheduled() > 0:
+        logging.info(f'Removing {self.num_elements_scheduled()} unseeded elements already written to file')
+        scheduled = set(self.elements_scheduled.ID)
+        seeded_indices = [n for n in range(self.num_elements_total()) if n not in scheduled]
+        self.result = self.result.isel(trajectory=seeded_indices)
+
+    encoding = output_encoding(self.result, complevel, chunksizes, self._netCDF_encoding)
+    logging.info(f'Writing output with complevel={complevel}, chunksizes={chunksizes}')
+    self.result.to_netcdf(self.outfile_name + '_tmp', unlimited_dims={}, encoding=encoding)
+    self.result.close()
+    shutil.move(self.outfile_name + '_tmp', self.outfile_name)
+    self.result = xr.open_dataset(self.outfile_name)
+
+# Rewrite the file closed by the model's own io_close with the requested encoding
+def recompress_output(self, complevel = COMPLEVEL, chunksizes = None):
+    self.result.close()
+    with xr.open_dataset(self.outfile_name) as result:
+        encoding = output_encoding(result, complevel, chunksizes, self._netCDF_encoding)
+        logging.info(f'Rewriting output with complevel={complevel}, chunksizes={chunksizes}')
+        result.to_netcdf(self.outfile_name + '_tmp', unlimited_dims={}, encoding=encoding)
+    os.replace(self.outfile_name + '_tmp', self.outfile_name)
+    self.result = xr.open_dataset(self.outfile_name)
+
+def set_output_encoding(o, complevel = COMPLEVEL, chunksizes = None):
+    if complevel == COMPLEVEL and not chunksizes:
+        return o
+    if opendrift.__version__ in CLOSE_VERSIONS:
+        o.io_close = types.MethodType(
+            lambda self: close_output(self, complevel, chunksizes), o)
+        return o
+    io_close = o.io_close
+    def close(self):
+        io_close()
+        recompress_output(self, complevel, chunksizes)
+    o.io_close = types.MethodType(close, o)
+    return o
@@ -1,16 +1,101 @@
 import os
 import json
+import fcntl
+import tempfile
+import importlib
 import numpy as np
+import pandas as pd
+import xarray as xr
+import shapely
+import pyproj
 from shapely.ops import unary_union
 import geopandas as gpd
-from shapely.geometry import Point, Polygon
 import logging
+import time
+import traceback
+import multiprocessing as mp
+from functools import lru_cache
+from contextlib import contextmanager
+from netCDF4 import Dataset
 from general_tools import resolve_path
 
 
 '''
     Probability of containtement rectangles
 '''
+# metric POC grid limits
+MIN_CELL_SIZE = 10
+MAX_BINS = 500
+# output time steps read at once for the POC series
+POC_CHUNK = 24
+# trajectory picture: vertex budget, minimum points per line, basemap extent step [deg] and resolution
+MAX_VERTICES = 200000
+LINE_STEPS = 100
+BASEMAP_STEP = 0.5
+BASEMAP_PIXELS = 2000
+# ensemble accumulators: folder in OUTPUT and grid padding around the first member
+ENSEMBLE_DIR = 'ensembles'
+ENSEMBLE_PAD = 1.0
+# seconds each product may take when products run in parallel
+PRODUCT_TIMEOUT = 600
+# seconds between checks of running products
+POLL_INTERVAL = 0.05
+# polygon output formats: extension and GDAL driver (None for GeoParquet)
+VECTOR_FORMATS = {'GeoJSON': ('.geojson', 'GeoJSON'), 'FlatGeobuf': ('.fgb', 'FlatGeobuf'),
+                  'GeoParquet': ('.parquet', None)}
+# integer valued track variables
+INTEGER_VARIABLES = ['status', 'moving', 'origin_marker']
+# authalic Earth radius [m]
+EARTH_RADIUS = 6371007.2
+
+# Level index per POC value, -1 where no level applies (NaN included)
+def _level_indices(values, levels):
+    level_indices = np.full(np.shape(values), -1) # prevent NaN error
+
+    level_indices[values <= levels[0]] = 0
+    for i in range(len(levels) - 1):
+        mask = (values >= levels[i]) & (values < levels[i + 1])
+        level_indices[mask] = i + 1
+    return level_indices
+
+# Outlines of the True cells of a mask as polygons in grid index coordinates (column, row).
+# Cell edges between masked and unmasked cells are polygonized, faces outside the mask are dropped.
+def _polygonize_mask(mask):
+    padded = np.pad(mask, 1)
+    # vertical edges: x = j between columns j-1 and j, from row i to i+1
+    i, j = np.nonzero(padded[1:-1, 1:] != padded[1:-1, :-1])
+    vertical = np.stack([np.column_stack([j, i]), np.column_stack([j, i + 1])], axis=1)
+    # horizontal edges: y = i between rows i-1 and i, from column j to j+1
+    i, j = np.nonzero(padded[1:, 1:-1] != padded[:-1, 1:-1])
+    horizontal = np.stack([np.column_stack([j, i]), np.column_stack([j + 1, i])], axis=1)
+    
+    segments = shapely.linestrings(np.concatenate([vertical, horizontal]).astype(float))
+    faces = shapely.get_parts(shapely.polygonize(segments))
+    points = shapely.get_coordinates(shapely.point_on_surface(faces)).astype(int)
+    inside = mask[points[:, 1], points[:, 0]]
+    # drop collinear vertices of the unit cell edges
+    return shapely.simplify(faces[inside], 0)
+
+def _raster_to_grid(geom, x, y):
+    return shapely.transform(geom, lambda c: np.column_stack([np.interp(c[:, 0], np.arange(len(x)), x),
+                                                              np.interp(c[:, 1], np.arange(len(y)), y)]))
+
+# One multipolygon per level straight from the POC raster, without unioning cell polygons
+def _merge_raster_by_level(raster, levels, level_to_color):
+    level_indices = _level_indices(raster['poc'], levels)
+    
+    # empty cells are not drawn, same as the cell polygons
+    occupied = np.isfinite(raster['poc'])
+    
+    polygons_list = []
+    for i in np.unique(level_indices[occupied]).tolist():
+        faces = _raster_to_grid(_polygonize_mask((level_indices == i) & occupied), raster['x'], raster['y'])
+        polygons_list.append({'geometry': shapely.multipolygons(faces), 'level': i})
+
+    gdf_merged = gpd.GeoDataFrame(polygons_list, geometry='geometry', crs=raster['crs']).to_crs("EPSG:4326")
+    gdf_merged['color'] = gdf_merged['level'].map(level_to_color)
+    return gdf_merged[['geometry', 'color']]
+
 def _merge_polygons_by_level(gdf, colorscale = None):
     
     if not colorscale:
@@ -22,6 +107,10 @@ def _merge_polygons_by_level(gdf, colorscale = None):
     if not levels or not colors:
         return
 
+    level_to_color = {i: colors[i] for i in range(len(levels))}
+    if 'raster' in gdf.attrs:
+        return _merge_raster_by_level(gdf.attrs['raster'], levels, level_to_color)
+
     try:
         values = gdf['poc']
         polygons = gdf['geometry']
@@ -29,15 +118,7 @@ def _merge_polygons_by_level(gdf, colorscale = None):
         logging.error(f'Error occure: {e}')
         return
     
-    level_to_color = {i: colors[i] for i in range(len(levels))}
-    n_levels = len(levels) - 1
-    
-    level_indices = np.full(values.shape, -1) # prevent NaN error
-
-    level_indices[values <= levels[0]] = 0
-    for i in range(n_levels):
-        mask = (values >= levels[i]) & (values < levels[i + 1])
-        level_indices[mask] = i + 1
+    level_indices = _level_indices(values, levels)
     
     polygons_list = []
 
@@ -46,89 +127,528 @@ def _merge_polygons_by_level(gdf, colorscale = None):
         merged = unary_union(lvl)
         polygons_list.append({'geometry': merged, 'level': i})
 
-    gdf_merged = gpd.GeoDataFrame(polygons_list, crs="EPSG:4326")
+    # explicit columns, an empty grid has no levels
+    gdf_merged = gpd.GeoDataFrame(polygons_list, columns=['geometry', 'level'], geometry='geometry', crs="EPSG:4326")
     gdf_merged['color'] = gdf_merged['level'].map(level_to_color)
     gdf_merged = gdf_merged[['geometry', 'color']]
     
     return gdf_merged
 
-def _compute_poc(df):   
-    # calc area of each cell
-    area = df.to_crs(epsg=3857)['geometry'].area
+def _compute_poc(values, area, total_area):   
     # find relative value to cell size
-    dc = df['values'] / area
-    # find absolute value to all are size
-    dg = sum(df['values']) / sum(area)
+    dc = values / area
+    # find absolute value to all are size (empty cells included)
+    dg = sum(values) / total_area
     # calc the quoient relative/absolute
     r = dc/dg 
     return 1 - np.exp(-r)
 
 
+# Non-empty cells of a counted grid as (polygons, counts). Rows of dens are y, columns x.
+def _grid_cells(dens, x, y):
+    i, j = np.nonzero(dens)
+    polygons = shapely.box(x[j], y[i], x[j+1], y[i+1])
+    return polygons, dens[i, j]
+
+# Keep the full POC grid with the cells, empty cells are NaN
+def _attach_raster(gdf, dens, x, y, crs):
+    poc = np.full(dens.shape, np.nan)
+    poc[np.nonzero(dens)] = gdf['poc'].values
+    gdf.attrs['raster'] = {'poc': poc, 'x': x, 'y': y, 'crs': crs}
+    return gdf
+
+# Area [m2] of one cell in each row of a regular lat/lon grid: R^2 * dlon * (sin(lat2) - sin(lat1))
+def _row_areas(min_lat, max_lat, n_rows, dlon):
+    lat = np.radians(np.linspace(min_lat, max_lat, n_rows + 1))
+    return EARTH_RADIUS ** 2 * np.radians(dlon) * np.diff(np.sin(lat))
+
+# Grid without cells, when no element has a position (all deactivated)
+def _empty_poc_grid():
+    logging.warning('No element positions, POC grid is empty.')
+    return gpd.GeoDataFrame({'values': np.array([], dtype=float), 'poc': np.array([], dtype=float)},
+                            geometry=gpd.GeoSeries([], crs="EPSG:4326"))
+
 def _build_poc_grid(lat_t, lon_t, n_bins = 10):
     
+    # deactivated elements have no position
+    valid = np.isfinite(lat_t) & np.isfinite(lon_t)
+    lat_t, lon_t = lat_t[valid], lon_t[valid]
+    if not valid.any():
+        return _empty_poc_grid()
+    
     #define boarder
     max_lat, min_lat = lat_t.max(), lat_t.min()
     max_lon, min_lon = lon_t.max(), lon_t.min()
     
-    # transform trajectory to geograhical Point() objects
-    coords = []
-    for lat, lon in zip(lat_t, lon_t):
-        coords.append(tuple([lat,lon]))
-    points = [Point(xy) for xy in coords]
-    
     # linearspaces for regular grid cells
     lat = np.linspace(min_lat - 0.00001, max_lat+ 0.00001, n_bins+1)
     lon = np.linspace(min_lon- 0.00001, max_lon+ 0.00001, n_bins+1)
     
-    polygons = []
-    dens = []
-    for i in range(n_bins):
-        for j in range(n_bins):
-            # add polygons to plot (on map used XY projection : (lon, lat))
-            cord_lst =  [(lon[j], lat[i]), (lon[j+1], lat[i]), (lon[j+1], lat[i+1]), (lon[j], lat[i+1]), (lon[j], lat[i])]
-            poly = Polygon(cord_lst)
-            polygons.append(poly)
-            
-            # but trajectory (points) are stored as (lat, lon)
-            # calculate how many points each polygons contains 
-            cord_lst_check = [(lat[i], lon[j]), (lat[i], lon[j+1]), (lat[i+1], lon[j+1]),(lat[i+1], lon[j]), (lat[i], lon[j])]
-            poly_check = Polygon(cord_lst_check)
-            dens.append(sum(poly_check.contains(points)))
-
-    # store results in dataframe
-    gdf = gpd.GeoDataFrame({'geometry':polygons, 'values':dens}, crs="EPSG:4326")
-    gdf['poc'] = _compute_poc(gdf)
+    # count points per cell in one pass, rows are latitude and columns longitude
+    dens, _, _ = np.histogram2d(lat_t, lon_t, bins=[lat, lon])
     
-    gdf = gdf[gdf['values'] != 0].reset_index()
+    # polygons only for non-empty cells (on map used XY projection : (lon, lat))
+    polygons, values = _grid_cells(dens, lon, lat)
+    gdf = gpd.GeoDataFrame({'geometry':polygons, 'values':values}, crs="EPSG:4326")
+    
+    # true cell areas on the sphere, same for every cell of a grid row
+    rows = _row_areas(lat[0], lat[-1], n_bins, lon[1] - lon[0])
+    i, _ = np.nonzero(dens)
+    gdf['poc'] = _compute_poc(gdf['values'].values, rows[i], rows.sum() * n_bins)
         
-    return gdf
+    return _attach_raster(gdf, dens, lon, lat, "EPSG:4326")
 
-def export_poc_geojson(traj, file_name, plot_time = None):
-    if plot_time:
-        res = traj.result.sel(time = plot_time)
+# Cell size [m] from particle spread: Freedman-Diaconis histogram rule or Silverman kernel bandwidth
+def _auto_cell_size(x, y, rule = 'fd'):
+    n = len(x)
+    xy = np.column_stack([x, y])
+    if rule == 'silverman':
+        h = 1.06 * xy.std(axis=0) * n ** (-1/5)
     else:
-        res = traj.result.sel(time = traj.result.time[-1])
+        iqr = np.subtract(*np.percentile(xy, [75, 25], axis=0))
+        h = 2 * iqr * n ** (-1/3)
+    h = h[h > 0]
+    return float(h.min()) if len(h) else MIN_CELL_SIZE
+
+# Square cells in Lambert azimuthal equal-area projection centred on the particles
+def _laea_crs(lat_0, lon_0):
+    return pyproj.CRS.from_proj4(f'+proj=laea +lat_0={lat_0} +lon_0={lon_0} +datum=WGS84 +units=m +no_defs')
+
+def _metric_grid(lat_t, lon_t, cell_size = None, rule = 'fd', max_bins = MAX_BINS):
+    crs = _laea_crs(np.median(lat_t), np.median(lon_t))
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    x, y = transformer.transform(lon_t, lat_t)
+    
+    if cell_size is None:
+        cell_size = _auto_cell_size(x, y, rule)
+    # keep the grid size bounded for very spread clouds
+    extent = max(x.max() - x.min(), y.max() - y.min())
+    cell_size = max(cell_size, extent / max_bins, MIN_CELL_SIZE)
+    
+    nx = max(1, int(np.ceil((x.max() - x.min()) / cell_size)))
+    ny = max(1, int(np.ceil((y.max() - y.min()) / cell_size)))
+    grid = {'x': x.min() + cell_size * np.arange(nx + 1),
+            'y': y.min() + cell_size * np.arange(ny + 1),
+            'cell_size': cell_size,
+            'crs': crs}
+    return x, y, grid
+
+def _build_metric_poc_grid(lat_t, lon_t, cell_size = None, rule = 'fd', max_bins = MAX_BINS):
     
-    lats = res.lat.values.flatten()
-    lons = res.lon.values.flatten()
+    valid = np.isfinite(lat_t) & np.isfinite(lon_t)
+    lat_t, lon_t = lat_t[valid], lon_t[valid]
+    if not valid.any():
+        return _empty_poc_grid()
     
-    gdf = _build_poc_grid(lats, lons, 10) # maybe add auto merging n_bins number in the future
+    x, y, grid = _metric_grid(lat_t, lon_t, cell_size, rule, max_bins)
+    logging.info(f"POC grid: {len(grid['x']) - 1}x{len(grid['y']) - 1} cells of {grid['cell_size']:.0f} m")
+    
+    dens, _, _ = np.histogram2d(y, x, bins=[grid['y'], grid['x']])
+    polygons, values = _grid_cells(dens, grid['x'], grid['y'])
+    
+    # equal-area projection: every cell has the same true area
+    area = grid['cell_size'] ** 2
+    gdf = gpd.GeoDataFrame({'geometry':polygons, 'values':values}, crs=grid['crs'])
+    gdf['poc'] = _compute_poc(gdf['values'], area, area * dens.size)
+    
+    return _attach_raster(gdf, dens, grid['x'], grid['y'], grid['crs']).to_crs("EPSG:4326")
+
+# Polygon products next to the output file: GeoJSON, FlatGeobuf or GeoParquet
+def _write_vector(gdf, file_name, suffix, vector_format = 'GeoJSON'):
+    extension, driver = VECTOR_FORMATS[vector_format]
+    file_name = file_name.replace('.nc', suffix + extension)
+    if driver is None:
+        gdf.to_parquet(file_name, compression='zstd')
+    else:
+        gdf.to_file(file_name, driver=driver)
+    return file_name
+
+# Element positions of one output step (last by default) of a trajectory dataset
+def _step_positions(result, plot_time = None):
+    if plot_time:
+        res = result[['lat', 'lon']].sel(time = plot_time)
+    else:
+        res = result[['lat', 'lon']].isel(time = -1)
+    return res.lat.values.flatten(), res.lon.values.flatten()
+
+def _write_poc_geojson(lats, lons, file_name, grid = None, vector_format = 'GeoJSON'):
+    grid = grid or {}
+    if 'cell_size' in grid or 'rule' in grid:
+        gdf = _build_metric_poc_grid(lats, lons, grid.get('cell_size'), grid.get('rule', 'fd'),
+                                     grid.get('max_bins', MAX_BINS))
+    else:
+        gdf = _build_poc_grid(lats, lons, grid.get('bins', 10))
     
     with open('DATA/colorscale.json', 'r') as f:
         data = json.load(f)
         
-    file_name = file_name.replace('.nc', '_poc.geojson')    
     gdf_merged = _merge_polygons_by_level(gdf.copy(), data.get('POC'))
-    gdf_merged.to_file(file_name, driver="GeoJSON")
+    return _write_vector(gdf_merged, file_name, '_poc', vector_format)
+
+def export_poc_geojson(traj, file_name, plot_time = None, grid = None, vector_format = 'GeoJSON'):
+    lats, lons = _step_positions(traj.result, plot_time)
+    return _write_poc_geojson(lats, lons, file_name, grid, vector_format)
+
+"""
+    POC time series
+"""
+# Fixed grid for all output steps: degree grid with spherical row areas, or square cells in
+# Lambert azimuthal equal-area projection centred on the output extent
+def _fixed_poc_grid(lat_range, lon_range, grid, cell_size = None):
+    if cell_size is None:
+        n_bins = grid.get('bins', 10)
+        lat = np.linspace(lat_range[0] - 0.00001, lat_range[1] + 0.00001, n_bins+1)
+        lon = np.linspace(lon_range[0] - 0.00001, lon_range[1] + 0.00001, n_bins+1)
+        rows = _row_areas(lat[0], lat[-1], n_bins, lon[1] - lon[0])
+        area = np.broadcast_to(rows[:, None], (n_bins, n_bins))
+        return {'x': lon, 'y': lat, 'crs': "EPSG:4326", 'transformer': None,
+                'area': area}
+
+    crs = _laea_crs(np.mean(lat_range), np.mean(lon_range))
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    x_min, y_min, x_max, y_max = transformer.transform_bounds(lon_range[0], lat_range[0],
+                                                             lon_range[1], lat_range[1])
+    extent = max(x_max - x_min, y_max - y_min)
+    cell_size = max(cell_size, extent / grid.get('max_bins', MAX_BINS), MIN_CELL_SIZE)
+    nx = max(1, int(np.ceil((x_max - x_min) / cell_size)))
+    ny = max(1, int(np.ceil((y_max - y_min) / cell_size)))
+    logging.info(f"Fixed POC grid: {nx}x{ny} cells of {cell_size:.0f} m")
+    area = np.broadcast_to(cell_size ** 2, (ny, nx))
+    return {'x': x_min + cell_size * np.arange(nx + 1), 'y': y_min + cell_size * np.arange(ny + 1),
+            'crs': crs, 'transformer': transformer, 'area': area}
+
+# Element counts of one output step on a fixed grid, None when no element has a position
+def _count_frame(lat_t, lon_t, fixed):
+    valid = np.isfinite(lat_t) & np.isfinite(lon_t)
+    if not valid.any():
+        return None
+    x, y = lon_t[valid], lat_t[valid]
+    if fixed['transformer'] is not None:
+        x, y = fixed['transformer'].transform(x, y)
+    
+    dens, _, _ = np.histogram2d(y, x, bins=[fixed['y'], fixed['x']])
+    return dens
+
+# POC raster from counts on a fixed grid, None for an empty grid
+def _poc_raster(dens, fixed):
+    occupied = dens > 0
+    if not occupied.any():
+        return None
+    poc = np.full(dens.shape, np.nan)
+    # reference area is the part of the grid covering the particles, as for a single step
+    rows, cols = np.nonzero(occupied.any(axis=1))[0], np.nonzero(occupied.any(axis=0))[0]
+    total_area = fixed['area'][rows[0]:rows[-1]+1, cols[0]:cols[-1]+1].sum()
+    poc[occupied] = _compute_poc(dens[occupied], fixed['area'][occupied], total_area)
+    return {'poc': poc, 'x': fixed['x'], 'y': fixed['y'], 'crs': fixed['crs']}
+
+def _poc_frame(lat_t, lon_t, fixed):
+    dens = _count_frame(lat_t, lon_t, fixed)
+    return None if dens is None else _poc_raster(dens, fixed)
+
+# Position extent of the whole output, from the global attributes or one pass over time chunks
+def _output_extent(ds, chunk):
+    attrs = ['geospatial_lat_min', 'geospatial_lat_max', 'geospatial_lon_min', 'geospatial_lon_max']
+    if all(a in ds.attrs for a in attrs):
+        values = [float(ds.attrs[a]) for a in attrs]
+        return values[:2], values[2:]
+    lat_range, lon_range = [np.inf, -np.inf], [np.inf, -np.inf]
+    for start in range(0, ds.sizes['time'], chunk):
+        part = ds[['lat', 'lon']].isel(time=slice(start, start + chunk)).load()
+        lat_range = [min(lat_range[0], float(part.lat.min())), max(lat_range[1], float(part.lat.max()))]
+        lon_range = [min(lon_range[0], float(part.lon.min())), max(lon_range[1], float(part.lon.max()))]
+    return lat_range, lon_range
+
+# POC raster (time, y, x) of every output step in one NetCDF, in the CRS of the fixed grid.
+# The output file is read in chunks of time steps and every step is written as soon as it is computed,
+# so memory is bounded by one chunk. Steps without element positions are left out.
+def _create_poc_series(path, fixed, colorscale):
+    nc = Dataset(path, 'w')
+    nc.createDimension('time', None)
+    nc.createDimension('y', len(fixed['y']) - 1)
+    nc.createDimension('x', len(fixed['x']) - 1)
+    geographic = fixed['transformer'] is None
+    for name, edges in [('x', fixed['x']), ('y', fixed['y'])]:
+        var = nc.createVariable(name, 'f8', (name,))
+        var[:] = (edges[:-1] + edges[1:]) / 2
+        var.units = ('degrees_east' if name == 'x' else 'degrees_north') if geographic else 'm'
+    time = nc.createVariable('time', 'f8', ('time',))
+    time.units = 'seconds since 1970-01-01 00:00:00'
+    time.standard_name = 'time'
+    poc = nc.createVariable('poc', 'f4', ('time', 'y', 'x'), zlib=True, fill_value=np.float32(np.nan),
+                            chunksizes=(1, len(fixed['y']) - 1, len(fixed['x']) - 1))
+    poc.long_name = 'probability of containment'
+    nc.crs = fixed['crs'] if isinstance(fixed['crs'], str) else fixed['crs'].to_wkt()
+    nc.colorscale = json.dumps(colorscale)
+    return nc
+
+def export_poc_timeseries(file_name, grid = None, chunk = POC_CHUNK):
+    grid = grid or {}
+    with open('DATA/colorscale.json', 'r') as f:
+        colorscale = json.load(f).get('POC')
+    
+    path = file_name.replace('.nc', '_poc_series.nc')
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path)[:-len('.nc')] + '_', suffix='_tmp.nc',
+                               dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    steps = 0
+    try:
+        with xr.open_dataset(file_name) as ds:
+            lat_range, lon_range = _output_extent(ds, chunk)
+            cell_size = grid.get('cell_size')
+            if cell_size is None and 'rule' in grid:
+                # one cell size for all steps, from the spread at the last step
+                last = ds[['lat', 'lon']].isel(time=-1).load()
+                valid = np.isfinite(last.lat.values) & np.isfinite(last.lon.values)
+                _, _, metric = _metric_grid(last.lat.values[valid], last.lon.values[valid], None,
+                                            grid['rule'], grid.get('max_bins', MAX_BINS))
+                cell_size = metric['cell_size']
+            fixed = _fixed_poc_grid(lat_range, lon_range, grid, cell_size)
+            
+            with _create_poc_series(tmp, fixed, colorscale) as nc:
+                for start in range(0, ds.sizes['time'], chunk):
+                    part = ds[['lat', 'lon']].isel(time=slice(start, start + chunk)).load()
+                    for k, time in enumerate(part.time.values):
+                        raster = _poc_frame(part.lat.values[:, k], part.lon.values[:, k], fixed)
+                        if raster is None:
+                            continue
+                        nc['time'][steps] = (time - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+                        nc['poc'][steps] = raster['poc']
+                        steps += 1
+        if not steps:
+            logging.warning(f'No element positions in {file_name}, POC series not written.')
+            return None
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    logging.info(f'POC series with {steps} time steps: {path}')
+    
+    return path
+
+"""
+    POC ensemble
+"""
+# Counts of many runs on one fixed grid, kept in OUTPUT/ensembles/<name>.npz.
+# Every member adds its element fractions at one output step, so members weigh the same
+# whatever their element count, and only one step of one member is in memory at a time.
+def _ensemble_path(name):
+    folder = os.path.join(resolve_path("OUTPUT"), ENSEMBLE_DIR)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f'{name}.npz')
+
+def _load_ensemble(path):
+    with np.load(path, allow_pickle=False) as data:
+        ensemble = {k: data[k] for k in data.files}
+    crs = str(ensemble['crs'])
+    ensemble['crs'] = crs if crs == "EPSG:4326" else pyproj.CRS.from_wkt(crs)
+    ensemble['transformer'] = None if crs == "EPSG:4326" else \
+        pyproj.Transformer.from_crs("EPSG:4326", ensemble['crs'], always_xy=True)
+    ensemble['members'] = list(ensemble['members'])
+    return ensemble
 
-    return
+def _save_ensemble(ensemble, path):
+    crs = ensemble['crs'] if isinstance(ensemble['crs'], str) else ensemble['crs'].to_wkt()
+    # unique temporary file, np.savez keeps names ending with .npz
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path)[:-len('.npz')] + '_', suffix='_tmp.npz',
+                               dir=os.path.dirname(path))
+    os.close(fd)
+    np.savez(tmp, counts=ensemble['counts'], x=ensemble['x'], y=ensemble['y'], area=np.asarray(ensemble['area']),
+             crs=crs, members=np.asarray(ensemble['members'], dtype=str), outside=ensemble['outside'])
+    os.replace(tmp, path)
+
+# Exclusive lock of one ensemble, members of concurrent runs are added one after another
+@contextmanager
+def _ensemble_lock(path):
+    with open(path[:-len('.npz')] + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# Start the ensemble again, the next member fixes a new grid
+def reset_ensemble(name) -> bool:
+    path = _ensemble_path(name)
+    with _ensemble_lock(path):
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+    logging.info(f'Ensemble {name} reset.')
+    return True
+
+# Add one trajectory file to the ensemble. The grid is fixed by the first member:
+# 'border' [min_lat, max_lat, min_lon, max_lon] or the member extent widened by ENSEMBLE_PAD.
+def accumulate_poc(file_name, name, grid = None, border = None, plot_time = None, weight = 1.0):
+    grid = grid or {}
+    path = _ensemble_path(name)
+    with xr.open_dataset(file_name) as ds:
+        lats, lons = _step_positions(ds, plot_time)
+        with _ensemble_lock(path):
+            if not os.path.exists(path):
+                if border is None:
+                    lat_range, lon_range = _output_extent(ds, POC_CHUNK)
+                    pad = max(lat_range[1] - lat_range[0], lon_range[1] - lon_range[0]) * ENSEMBLE_PAD
+                    border = [lat_range[0] - pad, lat_range[1] + pad, lon_range[0] - pad, lon_range[1] + pad]
+                ensemble = _fixed_poc_grid(border[:2], border[2:], grid, grid.get('cell_size'))
+                ensemble.update(counts=np.zeros(ensemble['area'].shape), members=[], outside=0.0)
+            else:
+                ensemble = _load_ensemble(path)
+            return _add_member(ensemble, path, file_name, name, lats, lons, weight)
+
+def _add_member(ensemble, path, file_name, name, lats, lons, weight):
+    member = os.path.realpath(file_name)
+    if member in ensemble['members']:
+        logging.warning(f'{file_name} is already in ensemble {name}, not added again.')
+        return path
+    
+    dens = _count_frame(lats, lons, ensemble)
+    valid = np.count_nonzero(np.isfinite(lats) & np.isfinite(lons))
+    if dens is None:
+        logging.warning(f'No element positions in {file_name}, not added to ensemble {name}.')
+        return path
+    ensemble['counts'] = ensemble['counts'] + weight * dens / valid
+    ensemble['outside'] = ensemble['outside'] + weight * (valid - dens.sum()) / valid
+    ensemble['members'].append(member)
+    if dens.sum() < valid:
+        logging.warning(f'{valid - int(dens.sum())} elements of {file_name} are outside the ensemble grid.')
+    _save_ensemble(ensemble, path)
+    logging.info(f"Added {file_name} to ensemble {name} ({len(ensemble['members'])} members)")
+    return path
+
+# POC GeoJSON of the accumulated counts
+def export_ensemble_poc(name, file_name = None, vector_format = 'GeoJSON'):
+    ensemble = _load_ensemble(_ensemble_path(name))
+    raster = _poc_raster(ensemble['counts'], ensemble)
+    if raster is None:
+        logging.warning(f'Ensemble {name} is empty, POC not written.')
+        return None
+    
+    with open('DATA/colorscale.json', 'r') as f:
+        colorscale = json.load(f).get('POC')
+    levels, colors = colorscale['levels'], colorscale['colors']
+    gdf = _merge_raster_by_level(raster, levels, {i: colors[i] for i in range(len(levels))})
+    
+    file_name = file_name or os.path.join(resolve_path("OUTPUT"), f'{name}.nc')
+    file_name = _write_vector(gdf, file_name, '_poc_ensemble', vector_format)
+    logging.info(f"Ensemble {name} POC from {len(ensemble['members'])} members: {file_name}")
+    return file_name
 
 """
     Plume triangle 
 """
-def export_plume_triangle(traj, file_name):
-    return
+# Convex hull of the element positions of every output step that has any
+def _step_hulls(lon, lat):
+    steps, elements = np.nonzero((np.isfinite(lon) & np.isfinite(lat)).T)
+    _, indices = np.unique(steps, return_inverse=True)
+    points = shapely.multipoints(np.column_stack([lon[elements, steps], lat[elements, steps]]), indices=indices)
+    return shapely.convex_hull(points)
+
+# Triangle from the release point enclosing the given vertices, None if they surround the release
+def _plume_triangle(release, vertices, lat_0):
+    scale = np.cos(np.radians(lat_0))
+    v = (vertices - release) * [scale, 1]
+    v = v[np.hypot(v[:, 0], v[:, 1]) > 0]
+    if not len(v):
+        return None
+    mean = np.arctan2(v[:, 1].sum(), v[:, 0].sum())
+    rel = np.angle(np.exp(1j * (np.arctan2(v[:, 1], v[:, 0]) - mean)))
+    lo, hi = rel.min(), rel.max()
+    if hi - lo >= np.pi * 0.9:
+        return None
+    mid, half = mean + (lo + hi) / 2, (hi - lo) / 2
+    # far side beyond the element furthest along the bisector
+    length = (v @ [np.cos(mid), np.sin(mid)]).max() / np.cos(half)
+    corners = np.array([[np.cos(mean + lo), np.sin(mean + lo)],
+                        [np.cos(mean + hi), np.sin(mean + hi)]]) * length / [scale, 1] + release
+    return shapely.Polygon([release, *corners])
+
+# Release point, envelope (convex hull) of every output step and the plume triangle in one GeoJSON.
+# Output is read in time chunks, only the hulls of the steps are kept.
+def _write_plume(result, file_name, chunk = POC_CHUNK, vector_format = 'GeoJSON'):
+    lat_0 = None
+    first = None
+    times, envelopes = [], []
+    for start in range(0, result.sizes['time'], chunk):
+        part = result[['lat', 'lon']].isel(time=slice(start, start + chunk)).load()
+        lon, lat = part.lon.values, part.lat.values
+        active = (np.isfinite(lon) & np.isfinite(lat)).any(axis=0)
+        if not active.any():
+            continue
+        if lat_0 is None:
+            lat_0 = float(np.nanmean(lat[:, np.argmax(active)]))
+            first = np.full((lon.shape[0], 2), np.nan)
+        # first position of every element is its release position
+        idx = np.argmax(np.isfinite(lon), axis=1)
+        rows = np.arange(lon.shape[0])
+        new = np.isnan(first[:, 0]) & np.isfinite(lon[rows, idx])
+        first[new] = np.column_stack([lon[rows, idx], lat[rows, idx]])[new]
+        
+        times.append(part.time.values[active])
+        envelopes.append(_step_hulls(lon, lat))
+    
+    if lat_0 is None:
+        logging.warning(f'No element positions in {file_name}, plume not written.')
+        return None
+    times, envelopes = np.concatenate(times), np.concatenate(envelopes)
+    release = np.nanmean(first, axis=0)
+    
+    # drift triangle: from the release point to the envelope of the last step
+    triangle = _plume_triangle(release, shapely.get_coordinates(envelopes[-1]), lat_0)
+    if triangle is None:
+        logging.info('Plume surrounds the release point, triangle replaced with the overall hull.')
+        triangle = shapely.convex_hull(shapely.multipoints(shapely.get_coordinates(envelopes)))
+    
+    gdf = gpd.GeoDataFrame({
+        'type': ['release', 'triangle'] + ['hull'] * len(times),
+        'time': [None, None] + [pd.Timestamp(t).isoformat() for t in times],
+        'geometry': [shapely.Point(release), triangle, *envelopes]}, crs="EPSG:4326")
+    
+    return _write_vector(gdf, file_name, '_triangle', vector_format)
+
+def export_plume_triangle(traj, file_name, vector_format = 'GeoJSON'):
+    return _write_plume(traj.result, file_name, vector_format=vector_format)
+
+
+"""
+    Trajectory tables
+"""
+def _track_dtype(var):
+    return np.int16 if var in INTEGER_VARIABLES else np.float32
 
+# Tracks as Parquet (one row per element and output step, inactive rows dropped, one row group
+# per time chunk) or Zarr (same layout as the NetCDF with float32 variables)
+def export_tracks(file_name, tracks_format = 'parquet', chunk = POC_CHUNK):
+    with xr.open_dataset(file_name, chunks={}) as ds:
+        variables = [v for v in ds.data_vars if ds[v].dims == ('trajectory', 'time')]
+        
+        if tracks_format == 'zarr':
+            out = ds[variables].chunk({'trajectory': -1, 'time': chunk})
+            out = out.astype({v: np.float32 for v in variables if ds[v].dtype.kind == 'f'})
+            for var in out.variables.values():
+                var.encoding = {}
+            path = file_name.replace('.nc', '_tracks.zarr')
+            out.to_zarr(path, mode='w', consolidated=False)
+            return path
+        
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        path = file_name.replace('.nc', '_tracks.parquet')
+        writer = None
+        for start in range(0, ds.sizes['time'], chunk):
+            part = ds[variables].isel(time=slice(start, start + chunk)).load()
+            active = np.isfinite(part.lon.values)
+            rows, steps = np.nonzero(active)
+            columns = {'trajectory': part.trajectory.values[rows].astype(np.int32),
+                       'time': part.time.values[steps]}
+            for var in variables:
+                columns[var] = part[var].values[active].astype(_track_dtype(var))
+            table = pa.table(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression='zstd')
+            writer.write_table(table)
+        if writer is not None:
+            writer.close()
+        return path
 
 """
     Trajectory picture
@@ -136,18 +656,252 @@ def export_plume_triangle(traj, file_name):
 def export_traj_picture(traj, file_name, plot_time = None):
     file_name = file_name.replace('.nc', '.png')    
     traj.plot(filename = file_name)
-    return
+    return file_name
+
+# GSHHG land polygons clipped and simplified to the map extent, cached on disk per extent
+@lru_cache(maxsize=8)
+def _coastline(bounds):
+    folder = os.path.join(resolve_path("OUTPUT"), 'cache', 'basemap')
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'coast_{:g}_{:g}_{:g}_{:g}.wkb'.format(*bounds))
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return shapely.from_wkb(f.read())
+    
+    from roaring_landmask import Shapes, LandmaskProvider
+    logging.info(f'Building coastline basemap for {bounds}')
+    parts = shapely.get_parts(shapely.from_wkb(Shapes.wkb(LandmaskProvider.Gshhg)))
+    b = shapely.bounds(parts)
+    parts = parts[(b[:, 0] < bounds[2]) & (b[:, 2] > bounds[0]) & (b[:, 1] < bounds[3]) & (b[:, 3] > bounds[1])]
+    clipped = shapely.clip_by_rect(parts, *bounds)
+    tolerance = (bounds[2] - bounds[0]) / BASEMAP_PIXELS
+    coast = shapely.simplify(shapely.multipolygons(shapely.get_parts(clipped)), tolerance)
+    with open(path + '_tmp', 'wb') as f:
+        f.write(shapely.to_wkb(coast))
+    os.replace(path + '_tmp', path)
+    return coast
+
+# Map extent rounded outward, so nearby runs share the basemap
+def _map_bounds(lon_range, lat_range):
+    pad = max(lon_range[1] - lon_range[0], lat_range[1] - lat_range[0], 0.01) * 0.1
+    lo = np.floor((np.array([lon_range[0], lat_range[0]]) - pad) / BASEMAP_STEP) * BASEMAP_STEP
+    hi = np.ceil((np.array([lon_range[1], lat_range[1]]) + pad) / BASEMAP_STEP) * BASEMAP_STEP
+    return tuple(round(float(v), 4) for v in (lo[0], lo[1], hi[0], hi[1]))
+
+# Evenly spread trajectories and output steps, so that lines have at most max_vertices vertices
+def _decimate(n_traj, n_time, max_vertices = MAX_VERTICES):
+    steps = min(n_time, max(LINE_STEPS, max_vertices // n_traj))
+    lines = max(1, min(n_traj, max_vertices // steps))
+    return (np.unique(np.linspace(0, n_traj - 1, lines).round().astype(int)),
+            np.unique(np.linspace(0, n_time - 1, steps).round().astype(int)))
+
+# Headless trajectory picture from the output file: decimated paths, final positions and cached coastline.
+# Drawing cost depends on max_vertices, not on the number of elements.
+# Position and status of every trajectory at its own last valid step. Deactivated (e.g. stranded)
+# elements have no position after that step. Read in chunks of time steps.
+def _last_positions(ds, chunk = POC_CHUNK):
+    n = ds.sizes['trajectory']
+    lon, lat, status = np.full(n, np.nan), np.full(n, np.nan), np.zeros(n)
+    for start in range(0, ds.sizes['time'], chunk):
+        part = ds[['lon', 'lat', 'status']].isel(time=slice(start, start + chunk)).load()
+        valid = np.isfinite(part.lon.values)
+        rows = np.nonzero(valid.any(axis=1))[0]
+        last = valid.shape[1] - 1 - valid[:, ::-1].argmax(axis=1)
+        lon[rows] = part.lon.values[rows, last[rows]]
+        lat[rows] = part.lat.values[rows, last[rows]]
+        status[rows] = part.status.values[rows, last[rows]]
+    return lon, lat, status
+
+def render_traj_picture(result, file_name, max_vertices = MAX_VERTICES):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection, PolyCollection
+    
+    lat_range, lon_range = _output_extent(result, POC_CHUNK)
+    bounds = _map_bounds(lon_range, lat_range)
+    traj_idx, time_idx = _decimate(result.sizes['trajectory'], result.sizes['time'], max_vertices)
+    paths = result[['lon', 'lat']].isel(trajectory=traj_idx, time=time_idx).load()
+    last_lon, last_lat, last_status = _last_positions(result)
+    final = np.isfinite(last_lon)
+    if final.sum() > max_vertices:
+        final[np.nonzero(final)[0][max_vertices:]] = False
+    
+    aspect = 1 / np.cos(np.radians((bounds[1] + bounds[3]) / 2))
+    ratio = (bounds[3] - bounds[1]) * aspect / (bounds[2] - bounds[0])
+    fig = Figure(figsize=(8, float(np.clip(8 * ratio, 4, 12))), dpi=120, layout='tight')
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.set_facecolor('#dcebf5')
+    
+    coast = shapely.get_exterior_ring(shapely.get_parts(_coastline(bounds)))
+    coords, index = shapely.get_coordinates(coast, return_index=True)
+    rings = np.split(coords, np.nonzero(np.diff(index))[0] + 1) if len(coords) else []
+    ax.add_collection(PolyCollection(rings, facecolor='#d9d2c3', edgecolor='#8c8577', linewidth=0.4))
+    
+    segments = np.stack([paths.lon.values, paths.lat.values], axis=-1)
+    ax.add_collection(LineCollection(segments, colors='#1f4e79', linewidth=0.5, alpha=0.4))
+    stranded = final & (last_status != 0)
+    ax.scatter(last_lon[final & ~stranded], last_lat[final & ~stranded], s=2, c='#1f77b4', label='active')
+    ax.scatter(last_lon[stranded], last_lat[stranded], s=2, c='#d62728', label='stranded')
+    start = np.isfinite(segments[:, :, 0]).argmax(axis=1)
+    release = segments[np.arange(len(segments)), start]
+    ax.scatter(release[:, 0], release[:, 1], s=4, c='#2ca02c', label='release')
+    
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    ax.set_aspect(aspect)
+    ax.set_title(f"{pd.Timestamp(result.time.values[0]):%Y-%m-%d %H:%M} - "
+                 f"{pd.Timestamp(result.time.values[-1]):%Y-%m-%d %H:%M}, "
+                 f"{len(traj_idx)} of {result.sizes['trajectory']} trajectories", fontsize=9)
+    ax.legend(loc='upper right', fontsize=8, markerscale=3)
+    
+    file_name = file_name.replace('.nc', '.png')
+    fig.savefig(file_name)
+    return file_name
+
+# OpenDrift object of the class that wrote the output file
+def _import_output(file_name):
+    with xr.open_dataset(file_name) as ds:
+        module_name = ds.attrs.get('opendrift_module', 'opendrift.models.oceandrift')
+        class_name = ds.attrs.get('opendrift_class', 'OceanDrift')
+    cls = getattr(importlib.import_module(module_name), class_name)
+    traj = cls(loglevel=20)
+    traj.io_import_file(file_name)
+    return traj
 
 """
     main function
 """
+# Products of a finished simulation, made from its output file like postprocess_file
 def postprocess_trajectory(traj, file_name, formats):
-    
-    if formats.get('POC'):
-        export_poc_geojson(traj, file_name)
-    # if formats.get('Triangle'):
-    #     export_plume_triangle(traj, file_name)
-    if formats.get('Picture'):
-        export_traj_picture(traj, file_name)
-        
-    return
\ No newline at end of file
+    return postprocess_file(file_name, formats)
+
+# Products from a finished output file, without the simulation object.
+# The file is opened lazily in time chunks and only the needed steps are read.
+def _file_poc(file_name, formats, chunk):
+    with xr.open_dataset(file_name, chunks={}) as ds:
+        lats, lons = _step_positions(ds)
+    return _write_poc_geojson(lats, lons, file_name, formats.get('poc_grid'), formats.get('vector_format', 'GeoJSON'))
+
+def _file_poc_series(file_name, formats, chunk):
+    return export_poc_timeseries(file_name, formats.get('poc_grid'), chunk)
+
+def _file_triangle(file_name, formats, chunk):
+    with xr.open_dataset(file_name, chunks={}) as ds:
+        return _write_plume(ds, file_name, chunk, formats.get('vector_format', 'GeoJSON'))
+
+def _file_picture(file_name, formats, chunk):
+    picture = formats.get('picture') or {}
+    if picture.get('renderer') == 'opendrift':
+        # OpenDrift plotting needs the model object with the whole trajectory
+        return export_traj_picture(_import_output(file_name), file_name)
+    with xr.open_dataset(file_name, chunks={}) as ds:
+        return render_traj_picture(ds, file_name, picture.get('max_vertices', MAX_VERTICES))
+
+def _file_ensemble(file_name, formats, chunk):
+    ensemble = formats['ensemble']
+    accumulate_poc(file_name, ensemble['name'], formats.get('poc_grid'), ensemble.get('border'),
+                   weight=ensemble.get('weight', 1.0))
+    return export_ensemble_poc(ensemble['name'], vector_format=formats.get('vector_format', 'GeoJSON'))
+
+def _file_tracks(file_name, formats, chunk):
+    return export_tracks(file_name, formats.get('tracks_format', 'parquet'), chunk)
+
+FILE_PRODUCTS = {'POC': _file_poc, 'POC_series': _file_poc_series, 'Triangle': _file_triangle,
+                 'Picture': _file_picture, 'POC_ensemble': _file_ensemble, 'Tracks': _file_tracks}
+
+def _enabled_products(formats):
+    return [p for p in FILE_PRODUCTS if formats.get('ensemble' if p == 'POC_ensemble' else p)]
+
+# Runs in a worker process: product path and its own run time.
+# The start is reported to the parent, which times each product from it.
+def _run_product(product, file_name, formats, chunk):
+    if _started is not None:
+        _started.put((product, time.time()))
+    start = time.perf_counter()
+    path = FILE_PRODUCTS[product](file_name, formats, chunk)
+    return path, time.perf_counter() - start
+
+_started = None
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+def _log_report(report):
+    for product, (status, seconds) in report.items():
+        logging.info(f'Postprocessing {product}: {status} in {seconds:.1f} s')
+
+def _postprocess_serial(file_name, formats, chunk, enabled):
+    products, report = {}, {}
+    for product in enabled:
+        start = time.perf_counter()
+        try:
+            products[product], _ = _run_product(product, file_name, formats, chunk)
+            report[product] = ('done', time.perf_counter() - start)
+        except Exception as e:
+            logging.exception(f'Postprocessing {product} failed: {e}')
+            products[product] = None
+            report[product] = ('failed', time.perf_counter() - start)
+    return products, report
+
+# Every product in a worker process with a timeout, counted from when a worker starts it. A failed or
+# timed out product is None in the result and does not stop the others; hanging workers are terminated.
+def _postprocess_parallel(file_name, formats, chunk, enabled, workers, timeout):
+    products, report = {}, {}
+    # spawn: workers do not inherit open NetCDF/HDF5 handles of the parent
+    ctx = mp.get_context('spawn')
+    started = ctx.Queue()
+    size = min(workers, len(enabled))
+    pool = ctx.Pool(size, initializer=_init_worker, initargs=(started,))
+    pending = {p: pool.apply_async(_run_product, (p, file_name, formats, chunk)) for p in enabled}
+    begins = {}
+    hanging = 0
+    while pending:
+        while not started.empty():
+            product, begin = started.get()
+            begins[product] = begin
+        for product, result in list(pending.items()):
+            if result.ready():
+                del pending[product]
+                try:
+                    products[product], seconds = result.get()
+                    report[product] = ('done', seconds)
+                except Exception as e:
+                    # the worker's traceback is attached as the cause
+                    logging.error(f"Postprocessing {product} failed:\n{''.join(traceback.format_exception(e))}")
+                    products[product] = None
+                    report[product] = ('failed', time.time() - begins.get(product, time.time()))
+            elif product in begins and time.time() - begins[product] > timeout:
+                del pending[product]
+                logging.error(f'Postprocessing {product} did not finish in {timeout} s.')
+                products[product] = None
+                report[product] = ('timeout', time.time() - begins[product])
+                hanging += 1
+        if hanging >= size:
+            # all workers are stuck, the queued products would never start
+            for product in pending:
+                logging.error(f'Postprocessing {product} not started: all workers timed out.')
+                products[product] = None
+                report[product] = ('timeout', 0.0)
+            break
+        time.sleep(POLL_INTERVAL)
+    if hanging:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    return products, report
+
+def postprocess_file(file_name, formats, chunk = POC_CHUNK):
+    enabled = _enabled_products(formats)
+    parallel = formats.get('parallel') or {}
+    workers = parallel.get('workers', min(len(enabled), os.cpu_count() or 1))
+    # a configured timeout is only enforced in worker processes, also for one worker or product
+    if enabled and (workers > 1 and len(enabled) > 1 or 'timeout' in parallel):
+        products, report = _postprocess_parallel(file_name, formats, chunk, enabled, workers,
+                                                 parallel.get('timeout', PRODUCT_TIMEOUT))
+    else:
+        products, report = _postprocess_serial(file_name, formats, chunk, enabled)
+    _log_report(report)
+    return products
@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from general_tools import resolve_path
+
+'''
+    Opt-in profiling of pipeline stages. Switched on per stage with the PROFILE environment variable
+    or the config key "profile", e.g. PROFILE="simulation:cprofile,preparation:tracemalloc",
+    or PROFILE="sampling" for all of PROFILED_STAGES. Profiles are written to OUTPUT/profiles/<job>_<stage>.*
+        cprofile    - .prof (pstats, snakeviz) and .txt with the top functions by cumulative time
+        tracemalloc - .txt with the peak traced memory and the top allocation lines
+        sampling    - .folded stacks (flamegraph.pl, speedscope), sampled every SAMPLE_INTERVAL seconds
+    Stages are the instrumentation stage names, sub-steps included (e.g. "simulation/run").
+'''
+PROFILE_DIR = 'profiles'
+PROFILERS = ['cprofile', 'tracemalloc', 'sampling']
+PROFILED_STAGES = ['selection', 'preparation', 'simulation', 'postprocessing']
+# function names accepted as stage names
+STAGE_ALIASES = {'select_dataset': 'selection', 'prepare_dataset': 'preparation',
+                 'postprocess_trajectory': 'postprocessing', 'postprocess_file': 'postprocessing'}
+SAMPLE_INTERVAL = 0.005
+TOP = 40
+TRACEMALLOC_FRAMES = 25
+
+# {stage: profiler} from "stage:profiler,..." or a single profiler name for all default stages
+def parse_profile(value) -> dict:
+    if not value:
+        return {}
+    if isinstance(value, str):
+        value = value.strip()
+        if value in PROFILERS:
+            return {stage: value for stage in PROFILED_STAGES}
+        items = [item.split(':', 1) for item in value.split(',') if item.strip()]
+        if any(len(item) != 2 for item in items):
+            logging.warning(f'Invalid profile setting: {value}. Must be "stage:profiler,...". Profiling disabled.')
+            return {}
+        value = {stage.strip(): profiler.strip() for stage, profiler in items}
+    profile = {}
+    for stage, profiler in value.items():
+        if profiler not in PROFILERS:
+            logging.warning(f'Unknown profiler {profiler} for stage {stage}. Must be one of {PROFILERS}.')
+            continue
+        profile[STAGE_ALIASES.get(stage, stage)] = profiler
+    return profile
+
+# Config settings with the PROFILE environment variable on top
+def active_profile(settings = None) -> dict:
+    profile = parse_profile(settings)
+    profile.update(parse_profile(os.getenv('PROFILE')))
+    return profile
+
+_local = threading.local()
+
+# Profile path without extension
+def _profile_path(job, stage) -> str:
+    folder = os.path.join(resolve_path("OUTPUT"), PROFILE_DIR)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{os.path.splitext(job)[0]}_{stage.replace('/', '-')}")
+
+@contextmanager
+def _cprofile(path):
+    # only one cProfile per thread, a nested stage is covered by the outer profile
+    if getattr(_local, 'cprofile', False):
+        logging.warning(f'cProfile already running, {path} is not profiled separately')
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _local.cprofile = True
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _local.cprofile = False
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(TOP)
+
+# tracemalloc is process-wide: traced by one job thread at a time, nested stages of that thread
+# share its trace, other jobs are not traced meanwhile
+_trace_lock = threading.Lock()
+_trace = {'owner': None, 'depth': 0, 'started': False}
+
+@contextmanager
+def _tracemalloc(path):
+    with _trace_lock:
+        owner = _trace['owner']
+        if owner not in (None, threading.get_ident()):
+            logging.warning(f'tracemalloc is used by another job, {path} is not traced')
+            owner = False
+        else:
+            if _trace['depth'] == 0:
+                _trace.update(owner=threading.get_ident(), started=not tracemalloc.is_tracing())
+                if _trace['started']:
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+            _trace['depth'] += 1
+            tracemalloc.reset_peak()
+    if owner is False:
+        yield
+        return
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        with _trace_lock:
+            _trace['depth'] -= 1
+            if _trace['depth'] == 0:
+                if _trace['started']:
+                    tracemalloc.stop()
+                _trace.update(owner=None, started=False)
+        with open(path + '.txt', 'w') as f:
+            f.write(f'current {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB\n')
+            for stat in snapshot.statistics('lineno')[:TOP]:
+                f.write(f'{stat}\n')
+
+def _stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+# Stacks of the calling thread, sampled from a background thread
+@contextmanager
+def _sampling(path, interval = SAMPLE_INTERVAL):
+    target = threading.get_ident()
+    stacks = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                stacks[_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+        with open(path + '.folded', 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+PROFILER_FUNCTIONS = {'cprofile': _cprofile, 'tracemalloc': _tracemalloc, 'sampling': _sampling}
+
+@contextmanager
+def profiled(profiler, job, stage):
+    path = _profile_path(job, stage)
+    start = time.perf_counter()
+    with PROFILER_FUNCTIONS[profiler](path):
+        yield
+    logging.info(f'{profiler} profile of {stage} ({time.perf_counter() - start:.1f} s) saved: {path}.*')
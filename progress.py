@@ -0,0 +1,107 @@
+import time
+import types
+import logging
+import contextvars
+import datetime as dt
+from contextlib import contextmanager
+
+'''
+    Simulation progress and throughput. The model's state_to_buffer (called once per calculation step,
+    also writes the output) is wrapped to report, every `interval` seconds and at the end of the run:
+    steps done, active elements, particle-steps per second, estimated time remaining and the time spent
+    in readers (forcing interpolation), in the model update and in output buffering/writing.
+    Reports are logged and passed to the callbacks registered with progress_callbacks().
+'''
+INTERVAL = 60
+# reader time per step this many times above the run average is reported as degraded forcing reads
+DEGRADED_FACTOR = 3
+MIN_STEPS = 5
+
+_callbacks = contextvars.ContextVar('progress_callbacks', default=())
+
+# Callbacks receiving the progress reports of simulations run inside the block (same thread)
+@contextmanager
+def progress_callbacks(*callbacks):
+    token = _callbacks.set(_callbacks.get() + callbacks)
+    try:
+        yield
+    finally:
+        _callbacks.reset(token)
+
+def _seconds(timing, key) -> float:
+    return timing.get(key, dt.timedelta(0)).total_seconds()
+
+def progress_report(o, state, final = False) -> dict:
+    now = time.perf_counter()
+    elapsed = now - state['start']
+    steps = o.expected_steps_calculation
+    done = o.steps_calculation if final else o.steps_calculation + 1
+    readers = _seconds(o.env.timing, 'main loop:readers')
+    update = _seconds(o.timing, 'main loop:updating elements')
+    report = {
+        'label': state['label'],
+        'final': final,
+        'time': str(o.time),
+        'step': done,
+        'steps': steps,
+        'active': int(o.num_elements_active()),
+        'deactivated': int(o.num_elements_deactivated()),
+        'elapsed_s': round(elapsed, 2),
+        'particle_steps_per_s': round(state['particle_steps'] / elapsed, 1) if elapsed > 0 else None,
+        'eta_s': round(elapsed / done * max(steps - done, 0), 1) if done else None,
+        'readers_s': round(readers, 3),
+        'update_s': round(update, 3),
+        'output_s': round(state['output'], 3),
+        'other_s': round(max(elapsed - readers - update - state['output'], 0), 3),
+    }
+    # reader time per step since the last report against the run average
+    interval_steps = done - state['last_step']
+    if interval_steps > 0 and done > MIN_STEPS and not final:
+        recent = (readers - state['last_readers']) / interval_steps
+        average = readers / done
+        report['readers_s_per_step'] = round(recent, 4)
+        report['degraded_readers'] = bool(recent > DEGRADED_FACTOR * average > 0)
+    state.update(last=now, last_step=done, last_readers=readers)
+    return report
+
+def _log_report(report):
+    prefix = f"{report['label']}: " if report['label'] else ''
+    logging.info(f"{prefix}{report['time']} - step {report['step']}/{report['steps']}, "
+                 f"{report['active']} active, {report['particle_steps_per_s']} particle-steps/s, "
+                 f"ETA {report['eta_s']} s | readers {report['readers_s']} s, update {report['update_s']} s, "
+                 f"output {report['output_s']} s, other {report['other_s']} s")
+    if report.get('degraded_readers'):
+        logging.warning(f"{prefix}Forcing reads slowed down: {report['readers_s_per_step']} s per step, "
+                        f"run average {report['readers_s'] / report['step']:.4f} s")
+
+def _emit(report, callbacks):
+    _log_report(report)
+    for callback in callbacks:
+        try:
+            callback(report)
+        except Exception as e:
+            logging.warning(f'Progress callback failed: {e}')
+
+# Wrap the model's state_to_buffer. interval in seconds, 0 reports every step.
+def attach_progress(o, interval = INTERVAL, label = None):
+    callbacks = _callbacks.get()
+    state = {'start': None, 'last': None, 'last_step': 0, 'last_readers': 0.0,
+             'particle_steps': 0, 'output': 0.0, 'label': label}
+    state_to_buffer = o.state_to_buffer
+
+    def tracked(self, final=False):
+        now = time.perf_counter()
+        if state['start'] is None:
+            # main loop started before the first environment request of this step
+            started = self.timers.get('main loop')
+            lag = (dt.datetime.now() - started).total_seconds() if started is not None else 0
+            state['start'] = state['last'] = now - lag
+        if not final:
+            state['particle_steps'] += self.num_elements_active()
+        state_to_buffer(final=final)
+        state['output'] += time.perf_counter() - now
+        if final or time.perf_counter() - state['last'] >= interval:
+            _emit(progress_report(self, state, final), callbacks)
+
+    o.state_to_buffer = types.MethodType(tracked, o)
+    return o
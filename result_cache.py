@@ -0,0 +1,180 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import datetime as dt
+import pandas as pd
+from contextlib import contextmanager
+from general_tools import resolve_path
+
+'''
+    Result cache. Identical configs (same simulation settings, vocabulary and forcing files)
+    return the existing output and products instead of running again.
+    Copernicus runs are not cached, their forcing has no local files to fingerprint.
+'''
+CACHE_DIR = 'cache'
+INDEX_FILE = 'index.json'
+# not affecting the result
+IGNORED_KEYS = ['file_name', 'user', 'pword']
+TIME_KEYS = ['start_t', 'end_t']
+DEFAULTS = {'retention': '7days', 'max_entries': 100, 'fingerprint': 'stat', 'purge': False}
+
+def _index_path() -> str:
+    folder = os.path.join(resolve_path("OUTPUT"), CACHE_DIR)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, INDEX_FILE)
+
+def _read_index() -> dict:
+    path = _index_path()
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        logging.warning(f'Cache index {path} is corrupted. Starting with empty cache.')
+        return {}
+
+def _write_index(index):
+    path = _index_path()
+    # unique temporary file, concurrent jobs do not write into the same one
+    fd, tmp = tempfile.mkstemp(prefix=INDEX_FILE + '_', suffix='_tmp', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp, path)
+
+# Index read-modify-write under an exclusive lock, shared by processes and worker threads
+@contextmanager
+def _locked_index():
+    with open(_index_path() + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            index = _read_index()
+            yield index
+            _write_index(index)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _normalize(variables) -> dict:
+    normalized = {}
+    for key, value in variables.items():
+        if key in IGNORED_KEYS or value is None:
+            continue
+        if key in TIME_KEYS:
+            value = pd.to_datetime(value).isoformat()
+        normalized[key] = value
+    return normalized
+
+def _file_digest(path, block = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Fingerprint of forcing files: real path, size and mtime, or content digest
+def fingerprint_files(folder, mode = 'stat') -> list:
+    if folder is None or not os.path.exists(folder):
+        return []
+    paths = [folder] if os.path.isfile(folder) else \
+            [os.path.join(root, f) for root, _, files in os.walk(folder, followlinks=True) for f in files]
+    fingerprint = []
+    for path in sorted(paths):
+        real = os.path.realpath(path)
+        if mode == 'content':
+            fingerprint.append([real, _file_digest(real)])
+        else:
+            stat = os.stat(real)
+            fingerprint.append([real, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+def cache_key(sim_vars, data_vars, settings, vocabulary, mode = 'stat') -> str:
+    content = {
+        'simulation': _normalize(sim_vars),
+        'data': _normalize(data_vars),
+        'postprocessing': settings.get('postprocessing'),
+        'vocabulary': vocabulary,
+        'forcing': fingerprint_files(data_vars.get('folder'), mode),
+    }
+    raw = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _entry_files(entry) -> list:
+    return [entry['file_name']] + [p for p in entry.get('products', {}).values() if p]
+
+# Size and mtime of the entry files when stored, a later run writing the same file makes the entry stale
+def _file_stats(paths) -> dict:
+    stats = {}
+    for path in paths:
+        stat = os.stat(path)
+        stats[os.path.realpath(path)] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+def _is_current(entry) -> bool:
+    try:
+        return entry.get('files') == _file_stats(_entry_files(entry))
+    except OSError:
+        return False
+
+def _referenced(index) -> set:
+    return {os.path.realpath(p) for entry in index.values() for p in _entry_files(entry)}
+
+# Files still referenced by live entries are kept
+def _remove_files(entry, keep = ()):
+    for path in _entry_files(entry):
+        if not os.path.exists(path) or os.path.realpath(path) in keep:
+            continue
+        # zarr products are folders
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        logging.info(f'Cache: removed {path}')
+
+# Drop expired entries first, then least recently used ones above max_entries
+def evict(index, retention = DEFAULTS['retention'], max_entries = DEFAULTS['max_entries'], purge = False) -> dict:
+    now = dt.datetime.now()
+    limit = pd.to_timedelta(retention)
+    expired = [k for k, e in index.items() if now - dt.datetime.fromisoformat(e['created']) > limit]
+    by_use = sorted((k for k in index if k not in expired), key=lambda k: index[k]['last_used'])
+    expired += by_use[:max(0, len(by_use) - max_entries)]
+
+    entries = [index.pop(key) for key in expired]
+    if purge:
+        keep = _referenced(index)
+        for entry in entries:
+            _remove_files(entry, keep)
+    if expired:
+        logging.info(f'Cache: evicted {len(expired)} entries.')
+    return index
+
+def lookup(key, cache_settings) -> dict:
+    cfg = DEFAULTS | cache_settings
+    with _locked_index() as index:
+        evict(index, cfg['retention'], cfg['max_entries'], cfg['purge'])
+        entry = index.get(key)
+        if entry is not None and not _is_current(entry):
+            logging.warning(f'Cache: files of entry {key[:12]} are missing or were overwritten. Dropping entry.')
+            index.pop(key)
+            entry = None
+        if entry is not None:
+            entry['last_used'] = dt.datetime.now().isoformat()
+            logging.info(f"Cache hit {key[:12]}: {entry['file_name']}")
+    return entry
+
+def store(key, file_name, products, cache_settings):
+    cfg = DEFAULTS | cache_settings
+    with _locked_index() as index:
+        now = dt.datetime.now().isoformat()
+        entry = {'file_name': file_name, 'products': products or {}, 'created': now, 'last_used': now}
+        entry['files'] = _file_stats(_entry_files(entry))
+        # other configs that wrote the same output or products now point to this run's files
+        for other in [k for k, e in index.items() if k != key and _referenced({k: e}) & entry['files'].keys()]:
+            index.pop(other)
+            logging.info(f'Cache: dropped {other[:12]}, its files were overwritten by {key[:12]}')
+        index[key] = entry
+        evict(index, cfg['retention'], cfg['max_entries'], cfg['purge'])
+    logging.info(f'Cache: stored {key[:12]} -> {file_name}')
@@ -0,0 +1,153 @@
+import os
+import glob
+import logging
+import numpy as np
+import pandas as pd
+import xarray as xr
+from netCDF4 import Dataset, num2date, date2num
+from general_tools import resolve_path
+from output_tools import output_encoding, COMPLEVEL
+
+'''
+    Model state: checkpoints, restore and output appending
+'''
+CHECKPOINT_DIR = 'checkpoints'
+# chunks of an appended output file when none are configured, time is its unlimited dimension
+APPEND_CHUNKS = {'trajectory': 10000, 'time': 24}
+
+def checkpoint_folder(run_key) -> str:
+    folder = os.path.join(resolve_path("OUTPUT"), CHECKPOINT_DIR, run_key)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+# Active elements of a finished run as dataset along 'trajectory' (original output index)
+def extract_state(o, trajectories=None) -> xr.Dataset:
+    elements = o.elements
+    ids = np.asarray(elements.ID)
+    if trajectories is not None:
+        # restored runs number elements from 0, map them back to the original output
+        ids = np.asarray(trajectories)[ids]
+    n = len(ids)
+    data = {}
+    for var in elements.variables:
+        if var == 'ID':
+            continue
+        values = np.atleast_1d(getattr(elements, var))
+        data[var] = ('trajectory', np.broadcast_to(values, (n,)).copy())
+    state = xr.Dataset(data, coords={'trajectory': ids})
+    state.attrs['time'] = pd.Timestamp(o.time).isoformat()
+    return state
+
+# Element state at the last (or given) output time of a trajectory dataset
+def state_from_result(result, time=None, active_only=True) -> xr.Dataset:
+    res = result.isel(time=-1) if time is None else result.sel(time=time)
+    if active_only:
+        active = np.isfinite(res.lon.values) & (res.status.values == 0)
+        res = res.isel(trajectory=np.where(active)[0])
+    state = res.drop_vars('time').load()
+    state.attrs = {'time': pd.Timestamp(res.time.values).isoformat()}
+    return state
+
+def restore_state(o, state, oil_type=None):
+    props = {var: state[var].values for var in o.ElementType.variables
+             if var in state.data_vars and var != 'ID'}
+    if hasattr(o, 'set_oiltype'):
+        # OpenOil sets up weathering in seed_elements, which is skipped here
+        o.set_oiltype(oil_type)
+        o.keep_droplet_diameter = False
+    elements = o.ElementType(**props)
+    o.schedule_elements(elements, pd.Timestamp(state.attrs['time']).to_pydatetime())
+    logging.info(f"Restored {state.sizes['trajectory']} elements at {state.attrs['time']}")
+    return o
+
+# Original trajectory index of every element in a run restored from state.
+# Backward runs flip element IDs (lowest IDs are released first).
+def restored_trajectories(state, backwards=False) -> np.ndarray:
+    trajectories = state.trajectory.values
+    return trajectories[::-1] if backwards else trajectories
+
+def save_checkpoint(state, folder, segment, file_name, run_key = None) -> str:
+    state = state.copy()
+    state.attrs.update({'segment': segment, 'file_name': file_name, 'run_key': run_key or ''})
+    path = os.path.join(folder, f'checkpoint_{segment:04d}.nc')
+    # write aside and move, so an interrupted write never hides the previous checkpoint
+    state.to_netcdf(path + '_tmp')
+    os.replace(path + '_tmp', path)
+    logging.info(f"Checkpoint {segment} saved at {state.attrs['time']}: {path}")
+    return path
+
+def latest_checkpoint(folder):
+    checkpoints = sorted(glob.glob(os.path.join(folder, 'checkpoint_*.nc')))
+    if not checkpoints:
+        return None
+    with xr.open_dataset(checkpoints[-1]) as ds:
+        state = ds.load()
+    logging.info(f'Latest checkpoint: {checkpoints[-1]}')
+    return state
+
+def clear_checkpoints(folder):
+    for path in glob.glob(os.path.join(folder, '*.nc')):
+        os.remove(path)
+
+# Time made the unlimited dimension once, so that segments can be appended in place.
+# The file is copied lazily in chunks with its raw (encoded) values.
+def _unlimited_time(file_name, complevel = COMPLEVEL, chunksizes = None):
+    with Dataset(file_name) as nc:
+        if nc.dimensions['time'].isunlimited():
+            return
+    with xr.open_dataset(file_name, mask_and_scale=False, decode_times=False, chunks={}) as base:
+        chunks = APPEND_CHUNKS | (chunksizes or {})
+        encoding = output_encoding(base, complevel, chunks)
+        # the unlimited dimension keeps its chunk length, the output grows into it
+        for varname, var in base.data_vars.items():
+            if 'time' in var.dims:
+                encoding[varname]['chunksizes'] = tuple(chunks['time'] if d == 'time' else
+                                                        min(chunks.get(d, base.sizes[d]), base.sizes[d])
+                                                        for d in var.dims)
+        base.to_netcdf(file_name + '_tmp', unlimited_dims=['time'], encoding=encoding)
+    os.replace(file_name + '_tmp', file_name)
+    logging.info(f'{file_name}: time is now unlimited for appending')
+
+def _times(var, units = None, calendar = 'standard') -> np.ndarray:
+    times = num2date(var[:], var.units, getattr(var, 'calendar', 'standard'))
+    return np.asarray(date2num(times, units or var.units, calendar), dtype=float)
+
+# Append a continuation run to an existing output file, only the segment is read and written.
+# The segment starts at a time step of the output (the restored state): it is written right after
+# that step, so steps left by an interrupted append are overwritten and appending twice is harmless.
+def append_output(file_name, segment_file, trajectories, complevel = COMPLEVEL, chunksizes = None):
+    _unlimited_time(file_name, complevel, chunksizes)
+    with Dataset(file_name, 'a') as base, Dataset(segment_file) as seg:
+        units, calendar = base['time'].units, getattr(base['time'], 'calendar', 'standard')
+        base_time = np.asarray(base['time'][:], dtype=float)
+        seg_time = _times(seg['time'], units, calendar)
+        sign = 1 if seg_time[-1] >= seg_time[0] else -1
+        shared = np.nonzero(np.isclose(base_time, seg_time[0]))[0]
+        if shared.size:
+            start, anchor = shared[-1] + 1, seg_time[0]
+        else:
+            start, anchor = base_time.size, base_time[-1]
+        new = np.nonzero((seg_time - anchor) * sign > 0)[0]
+        if not new.size:
+            logging.warning(f'Nothing to append from {segment_file}, output already covers it.')
+            return file_name
+        end = start + new.size
+        rows = np.asarray(trajectories)[np.asarray(seg['trajectory'][:])]
+        n = base.dimensions['trajectory'].size
+        for name, var in base.variables.items():
+            if var.dimensions != ('trajectory', 'time') or name not in seg.variables:
+                continue
+            block = np.ma.masked_all((n, new.size), dtype=var.dtype)
+            block[rows] = seg[name][:, new[0]:new[-1] + 1]
+            var[:, start:end] = block
+        base['time'][start:end] = seg_time[new]
+        for key in ['time_coverage_end', 'runtime']:
+            if key in seg.ncattrs():
+                base.setncattr(key, seg.getncattr(key))
+        for coord in ['lat', 'lon']:
+            for key, func in [('min', min), ('max', max)]:
+                attr = f'geospatial_{coord}_{key}'
+                if attr in base.ncattrs() and attr in seg.ncattrs():
+                    base.setncattr(attr, func(base.getncattr(attr), seg.getncattr(attr)))
+    logging.info(f'Appended {new.size} time steps from {segment_file} to {file_name}')
+    return file_name
@@ -22,7 +22,8 @@ def test_data_preparation():
         ds = None
     assert ds is not None
 
-def test_simulation():
+def test_simulation(monkeypatch, tmp_path):
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
     sim_vars = {
         "model": "OceanDrift",
         "start_position": [57.5, 23.7],
@@ -37,3 +38,533 @@ def test_simulation():
     o, filename = simulation(datasets=[], **sim_vars)    
     assert o is not None
 
+
+def test_checkpoint_resume(monkeypatch, tmp_path):
+    import os
+    import numpy as np
+    import xarray as xr
+    import case_study_tool
+    from general_tools import resolve_path
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    sim_vars = {
+        "model": "OceanDrift",
+        "start_position": [57.5, 23.7],
+        "start_t": "2024-06-01 00:00:00",
+        "end_t": "2024-06-01 04:00:00",
+        "num": 2,
+        "time_step": 1800,
+        "checkpoint": "1h",
+        "file_name": "test_checkpoint.nc",
+        "configurations": {"environment:fallback:x_sea_water_velocity": 0.2}
+    }
+    # interrupted in the third segment, after two checkpoints
+    run_sim, calls = case_study_tool.run_sim, []
+    def interrupted(**params):
+        calls.append(params['start_t'])
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return run_sim(**params)
+    monkeypatch.setattr(case_study_tool, 'run_sim', interrupted)
+    try:
+        simulation(datasets=[], **sim_vars)
+    except KeyboardInterrupt:
+        pass
+    with xr.open_dataset(os.path.join(resolve_path("OUTPUT"), sim_vars['file_name'])) as ds:
+        assert ds.sizes['time'] == 5
+    
+    o, resumed = simulation(datasets=[], resume=True, **sim_vars)
+    # only the interrupted and the remaining segments run again
+    assert [str(t) for t in calls[3:]] == ['2024-06-01 02:00:00', '2024-06-01 03:00:00']
+    with xr.open_dataset(resumed) as ds:
+        times = ds.time.values
+        assert ds.sizes['time'] == 9 and (np.diff(times) > np.timedelta64(0)).all()
+        # elements keep moving east at the same speed across the interruption
+        steps = np.diff(ds.lon.values, axis=1)
+        assert np.isfinite(steps).all() and np.allclose(steps, steps[:, :1], rtol=0.05)
+    
+    # another config with the same model and start neither resumes nor clears these checkpoints
+    folders = os.listdir(os.path.join(resolve_path("OUTPUT"), 'checkpoints'))
+    o, other = simulation(datasets=[], resume=True, **(sim_vars | {'num': 3, 'file_name': 'test_checkpoint_other.nc'}))
+    with xr.open_dataset(other) as ds:
+        assert other != resumed and ds.sizes['trajectory'] == 3 and ds.sizes['time'] == 9
+    for folder in folders:
+        assert os.listdir(os.path.join(resolve_path("OUTPUT"), 'checkpoints', folder))
+
+def test_extend(monkeypatch, tmp_path):
+    import os
+    import pytest
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    from general_tools import resolve_path
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    sim_vars = {
+        "model": "OceanDrift",
+        "start_position": [57.5, 23.7],
+        "num": 2,
+        "time_step": 1800,
+        "configurations": {"environment:fallback:x_sea_water_velocity": 0.2}
+    }
+    o, filename = simulation(datasets=[], start_t="2024-06-01 00:00:00", end_t="2024-06-01 02:00:00",
+                             file_name="test_extend.nc", **sim_vars)
+    # element properties are exported even if export_variables leaves them out
+    o, extended = simulation(datasets=[], start_t="2024-06-01 02:00:00", end_t="2024-06-01 04:00:00",
+                             extend=filename, prerun=True, export_variables=['z'], **sim_vars)
+    with xr.open_dataset(extended) as ds:
+        assert extended == filename
+        assert (ds.time.values == pd.date_range('2024-06-01', '2024-06-01 04:00', freq='30min').values).all()
+        assert np.isfinite(ds.lon.values).all()
+        assert np.isfinite(ds.wind_drift_factor.values).all()
+    # an output without them can not be extended
+    o, filename = simulation(datasets=[], start_t="2024-06-01 00:00:00", end_t="2024-06-01 02:00:00",
+                             file_name="test_extend_partial.nc", export_variables=['z'], **sim_vars)
+    with pytest.raises(ValueError, match='wind_drift_factor'):
+        simulation(datasets=[], start_t="2024-06-01 02:00:00", end_t="2024-06-01 04:00:00",
+                   extend=filename, **sim_vars)
+    # no checkpoints without checkpoint or resume
+    assert not os.path.exists(os.path.join(resolve_path("OUTPUT"), 'checkpoints', 'test_extend'))
+
+def test_output_encoding(monkeypatch, tmp_path):
+    import numpy as np
+    import xarray as xr
+    import output_tools
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    # the mirrored close of a known OpenDrift version, and the model's own io_close with a rewrite
+    for versions in [output_tools.CLOSE_VERSIONS, []]:
+        monkeypatch.setattr(output_tools, 'CLOSE_VERSIONS', versions)
+        o, filename = simulation(datasets=[], model='OceanDrift', start_position=[57.5, 23.7],
+                                 start_t='2024-06-01 00:00:00', end_t='2024-06-01 04:00:00', num=5,
+                                 time_step=1800, time_step_output=3600, export_variables=['z'],
+                                 complevel=2, chunksizes={'trajectory': 2, 'time': 3}, file_name='test_encoding.nc')
+        with xr.open_dataset(filename) as ds:
+            assert (np.diff(ds.time.values) == np.timedelta64(3600, 's')).all()
+            assert 'z' in ds and 'x_wind' not in ds
+            assert ds.lon.encoding['zlib'] and ds.lon.encoding['complevel'] == 2
+            assert ds.lon.encoding['chunksizes'] == (2, 3)
+
+def test_auto_time_step():
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    from case_study_tool import auto_time_step
+    from opendrift.readers.reader_netCDF_CF_generic import Reader
+    
+    lat = np.arange(56, 59, 0.02)
+    lon = np.arange(21, 25, 0.03)
+    shape = (3, len(lat), len(lon))
+    ds = xr.Dataset({'uo': (('time', 'latitude', 'longitude'), np.full(shape, 0.4, 'f4')),
+                     'vo': (('time', 'latitude', 'longitude'), np.full(shape, 0.3, 'f4'))},
+                    coords={'time': pd.date_range('2024-06-01', periods=3, freq='h'),
+                            'latitude': lat, 'longitude': lon})
+    std_names = {'uo': 'x_sea_water_velocity', 'vo': 'y_sea_water_velocity'}
+    reader = Reader(ds, standard_name_mapping=std_names)
+    # ~1.7 km cells at 59N and 0.5 m/s current allow ~57 min, largest divisor of 1 h is 30 min
+    time_step = auto_time_step([reader], [ds], std_names, 'OceanDrift', 0.02, None, 3600)
+    assert time_step == 1800
+    
+    # only the forcing of the simulation window counts, also when reduced lazily with dask
+    fast = ds.copy(deep=True)
+    fast['uo'][0] = 4.0
+    for forcing in [fast, fast.chunk({'time': 1})]:
+        window = auto_time_step([reader], [forcing], std_names, 'OceanDrift', 0.02, None, 3600,
+                                pd.Timestamp('2024-06-01 01:30'), pd.Timestamp('2024-06-01 02:00'))
+        assert window == 1800
+        assert auto_time_step([reader], [forcing], std_names, 'OceanDrift', 0.02, None, 3600) < 1800
+
+def test_poc_grid():
+    import numpy as np
+    from post_processing import _build_poc_grid
+    
+    rng = np.random.default_rng(0)
+    lat = np.append(rng.normal(57.5, 0.1, 1000), np.nan)
+    lon = np.append(rng.normal(23.7, 0.2, 1000), np.nan)
+    gdf = _build_poc_grid(lat, lon, 20)
+    assert gdf['values'].sum() == 1000
+    assert (gdf['values'] > 0).all()
+    assert ((gdf['poc'] > 0) & (gdf['poc'] < 1)).all()
+    
+    # all elements deactivated: empty grid and product instead of an error
+    lost = np.full(10, np.nan)
+    assert _build_poc_grid(lost, lost).empty
+    
+    from post_processing import _row_areas, EARTH_RADIUS
+    rows = _row_areas(56.0, 58.0, 4, 0.25)
+    expected = EARTH_RADIUS ** 2 * np.radians(0.25) * (np.sin(np.radians(57.0)) - np.sin(np.radians(56.5)))
+    assert abs(rows[1] - expected) < 1e-6 * expected and rows[0] > rows[-1]
+    
+    from post_processing import _build_metric_poc_grid
+    gdf = _build_metric_poc_grid(lat, lon, cell_size=2000)
+    assert gdf['values'].sum() == 1000
+    assert gdf.crs.to_epsg() == 4326
+    auto = _build_metric_poc_grid(lat, lon, rule='silverman', max_bins=50)
+    assert auto['values'].sum() == 1000 and len(auto) <= 50 * 50
+    
+    from post_processing import _merge_polygons_by_level
+    colorscale = {'levels': [0.2, 0.6, 1.0], 'colors': ['#0000ff', '#00ff00', '#ff0000']}
+    merged = _merge_polygons_by_level(gdf.copy(), colorscale)
+    gdf.attrs = {}
+    cells = _merge_polygons_by_level(gdf, colorscale)
+    assert merged.is_valid.all()
+    assert abs(merged.to_crs(3857).area.sum() - cells.to_crs(3857).area.sum()) < 1e-4 * cells.to_crs(3857).area.sum()
+    for empty in [_build_poc_grid(lost, lost), _build_metric_poc_grid(lost, lost, cell_size=2000)]:
+        merged = _merge_polygons_by_level(empty, colorscale)
+        assert merged.empty and list(merged.columns) == ['geometry', 'color']
+
+def test_poc_series(monkeypatch, tmp_path):
+    import numpy as np
+    import xarray as xr
+    from post_processing import export_poc_timeseries
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    sim_vars = {
+        "model": "OceanDrift",
+        "start_position": [57.5, 23.7],
+        "start_t": "2024-06-01 00:00:00",
+        "end_t": "2024-06-01 06:00:00",
+        "num": 200,
+        "rad": 2000,
+        "time_step": 3600,
+        "file_name": "test_poc_series.nc",
+        "configurations": {"environment:fallback:x_sea_water_velocity": 0.2}
+    }
+    o, filename = simulation(datasets=[], **sim_vars)
+    with xr.open_dataset(export_poc_timeseries(filename, {'cell_size': 500}, chunk=3)) as ds:
+        assert ds.sizes['time'] == 7 and ds.poc.dims == ('time', 'y', 'x')
+        assert (np.isfinite(ds.poc.values).sum(axis=(1, 2)) > 0).all()
+
+def test_plume_triangle(tmp_path):
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import geopandas as gpd
+    from post_processing import _write_plume
+    rng = np.random.default_rng(0)
+    lon = 23.7 + np.cumsum(rng.normal(0.01, 0.002, (500, 10)), axis=1)
+    lat = 57.5 + np.cumsum(rng.normal(0.005, 0.001, (500, 10)), axis=1)
+    lon[:50, :3] = np.nan
+    ds = xr.Dataset({'lon': (('trajectory', 'time'), lon), 'lat': (('trajectory', 'time'), lat)},
+                    coords={'time': pd.date_range('2024-06-01', periods=10, freq='h')})
+    gdf = gpd.read_file(_write_plume(ds, str(tmp_path / 'plume.nc'), chunk=4))
+    assert list(gdf['type']) == ['release', 'triangle'] + ['hull'] * 10
+    last = gpd.points_from_xy(lon[:, -1], lat[:, -1])
+    assert gdf.geometry[1].buffer(1e-9).contains(last).all()
+    assert gdf.geometry[11].buffer(1e-9).contains(last).all()
+    # envelopes are the exact hulls of the positions
+    import shapely
+    assert abs(gdf.geometry[11].area - shapely.MultiPoint(np.column_stack([lon[:, -1], lat[:, -1]])).convex_hull.area) < 1e-12
+
+def test_picture_decimation():
+    from post_processing import _decimate
+    traj, time = _decimate(100000, 500, max_vertices=200000)
+    assert len(traj) * len(time) <= 200000
+    assert time[0] == 0 and time[-1] == 499
+    traj, time = _decimate(10, 24)
+    assert len(traj) == 10 and len(time) == 24
+    
+    # stranded elements have no position after stranding, their last valid step is used
+    import numpy as np
+    import xarray as xr
+    from post_processing import _last_positions
+    lon = np.array([[1.0, 2.0, 3.0], [1.0, 2.0, np.nan], [np.nan, np.nan, np.nan]])
+    status = np.array([[0, 0, 0], [0, 1, 1], [0, 0, 0]])
+    ds = xr.Dataset({'lon': (('trajectory', 'time'), lon), 'lat': (('trajectory', 'time'), lon),
+                     'status': (('trajectory', 'time'), status)})
+    last_lon, last_lat, last_status = _last_positions(ds, chunk=2)
+    assert last_lon.tolist()[:2] == [3.0, 2.0] and np.isnan(last_lon[2])
+    assert last_status.tolist() == [0, 1, 0]
+
+def test_poc_ensemble(tmp_path, monkeypatch):
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import geopandas as gpd
+    from post_processing import accumulate_poc, export_ensemble_poc, reset_ensemble
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    rng = np.random.default_rng(0)
+    files = []
+    for i, n in enumerate([200, 800]):
+        lon = 23.7 + 0.02 * i + rng.normal(0, 0.01, (n, 2))
+        lat = 57.5 + rng.normal(0, 0.01, (n, 2))
+        ds = xr.Dataset({'lon': (('trajectory', 'time'), lon), 'lat': (('trajectory', 'time'), lat)},
+                        coords={'time': pd.date_range('2024-06-01', periods=2, freq='h')})
+        files.append(str(tmp_path / f'member_{i}.nc'))
+        ds.to_netcdf(files[-1])
+    border = [57.3, 57.7, 23.5, 24.0]
+    reset_ensemble('test_ensemble')
+    accumulate_poc(files[0], 'test_ensemble', {'cell_size': 500}, border)
+    accumulate_poc(files[1], 'test_ensemble', {'cell_size': 500})
+    path = accumulate_poc(files[1], 'test_ensemble', {'cell_size': 500})
+    with np.load(path) as data:
+        assert len(data['members']) == 2
+        assert abs(data['counts'].sum() - 2) < 1e-9
+    gdf = gpd.read_file(export_ensemble_poc('test_ensemble'))
+    assert list(gdf.columns) == ['color', 'geometry']
+    assert reset_ensemble('test_ensemble') and not reset_ensemble('test_ensemble')
+
+def test_output_formats(tmp_path):
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+    import geopandas as gpd
+    from post_processing import _write_poc_geojson, export_tracks
+    rng = np.random.default_rng(0)
+    lon = 23.7 + rng.normal(0, 0.01, (100, 3))
+    lat = 57.5 + rng.normal(0, 0.01, (100, 3))
+    lon[:10, 0] = np.nan
+    ds = xr.Dataset({'lon': (('trajectory', 'time'), lon), 'lat': (('trajectory', 'time'), lat),
+                     'status': (('trajectory', 'time'), np.zeros((100, 3)))},
+                    coords={'trajectory': np.arange(100), 'time': pd.date_range('2024-06-01', periods=3, freq='h')})
+    file_name = str(tmp_path / 'formats.nc')
+    ds.to_netcdf(file_name)
+    
+    geojson = gpd.read_file(_write_poc_geojson(lat[:, -1], lon[:, -1], file_name))
+    parquet = gpd.read_parquet(_write_poc_geojson(lat[:, -1], lon[:, -1], file_name, vector_format='GeoParquet'))
+    fgb = gpd.read_file(_write_poc_geojson(lat[:, -1], lon[:, -1], file_name, vector_format='FlatGeobuf'))
+    assert len(geojson) == len(parquet) == len(fgb)
+    
+    tracks = pd.read_parquet(export_tracks(file_name, chunk=2))
+    assert len(tracks) == 290 and tracks['lon'].dtype == np.float32
+    with xr.open_zarr(export_tracks(file_name, 'zarr'), consolidated=False) as zarr:
+        assert zarr.lon.dtype == np.float32 and zarr.lon.shape == (100, 3)
+
+def test_postprocess_parallel(tmp_path, caplog):
+    import logging
+    from post_processing import postprocess_file
+    caplog.set_level(logging.ERROR)
+    # a configured timeout runs in a worker process also for one worker, failures log the worker traceback
+    formats = {'POC': True, 'parallel': {'workers': 1, 'timeout': 60}}
+    assert postprocess_file(str(tmp_path / 'missing.nc'), formats) == {'POC': None}
+    assert 'Traceback' in caplog.text and '_file_poc' in caplog.text
+
+def test_result_cache(monkeypatch, tmp_path):
+    import os
+    import json
+    from result_cache import cache_key, lookup, store, _index_path
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    sim_vars = {'start_t': '2024-06-01 00:00', 'end_t': '2024-06-02', 'num': 10, 'file_name': 'a.nc'}
+    settings = {'postprocessing': {'POC': True}}
+    key = cache_key(sim_vars, {'folder': None}, settings, {})
+    assert key == cache_key(sim_vars | {'file_name': 'b.nc'}, {'folder': None}, settings, {})
+    assert key != cache_key(sim_vars | {'num': 20}, {'folder': None}, settings, {})
+    
+    files = []
+    for name in ['a.nc', 'b.nc', 'c.nc']:
+        files.append(str(tmp_path / name))
+        open(files[-1], 'w').close()
+    assert lookup(key, {}) is None
+    store(key, files[0], {'POC': None}, {})
+    assert lookup(key, {})['file_name'] == files[0]
+    # least recently used entries above max_entries are evicted
+    store('b', files[1], {}, {'max_entries': 2})
+    store('c', files[2], {}, {'max_entries': 2})
+    assert lookup(key, {}) is None and lookup('b', {}) is not None
+    # entries with missing files are dropped
+    os.remove(files[2])
+    assert lookup('c', {}) is None
+    with open(_index_path()) as f:
+        assert list(json.load(f)) == ['b']
+    assert not [f for f in os.listdir(os.path.dirname(_index_path())) if f.endswith('_tmp')]
+    
+    # another config writing the same output file replaces the entry, an overwritten file is never a hit
+    store('other', files[1], {}, {})
+    assert lookup('b', {}) is None and lookup('other', {}) is not None
+    with open(files[1], 'w') as f:
+        f.write('rewritten by a run that failed before storing')
+    assert lookup('other', {}) is None
+    # purged entries only remove files no live entry references
+    from result_cache import evict
+    old, new = '2020-01-01T00:00:00', '2100-01-01T00:00:00'
+    index = {'old': {'file_name': files[0], 'products': {'POC': files[1]}, 'created': old, 'last_used': old},
+             'live': {'file_name': files[1], 'products': {}, 'created': new, 'last_used': new}}
+    assert list(evict(index, purge=True)) == ['live']
+    assert not os.path.exists(files[0]) and os.path.exists(files[1])
+
+def test_worker_service(monkeypatch, tmp_path):
+    import json
+    import time
+    import threading
+    import urllib.request
+    import urllib.error
+    from worker_service import WorkerService, make_server, shutdown
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    monkeypatch.setenv('INPUT', str(tmp_path / 'INPUT'))
+    service = WorkerService(workers=1, max_queue=4)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    
+    # invalid configs are rejected with the error report before scheduling
+    with open('INPUT/input_test.json') as f:
+        valid = json.load(f)
+    config = dict(valid, model='Unknown')
+    for body, reports in [(config, 1), ([config, dict(config, start_t='bad')], 2)]:
+        try:
+            urllib.request.urlopen(urllib.request.Request(f'{url}/jobs', data=json.dumps(body).encode(), method='POST'))
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 400
+            report = json.load(e)
+            if reports > 1:
+                assert len(report) == reports and not any(r['valid'] for r in report)
+            else:
+                assert 'Unknown model type: Unknown' in report['errors']
+    
+    # a failing job ends with the main.py exit code
+    future, job_id = service.submit('INPUT/does_not_exist.json')
+    for _ in range(100):
+        job = json.load(urllib.request.urlopen(f"{url}/jobs/{job_id}"))
+        if job['status'] not in ['queued', 'running']:
+            break
+        time.sleep(0.1)
+    assert job['status'] == 'failed' and job['code'] == 2
+    
+    shutdown(service, None)
+    try:
+        urllib.request.urlopen(urllib.request.Request(f'{url}/jobs', data=json.dumps(valid).encode(), method='POST'))
+        assert False
+    except urllib.error.HTTPError as e:
+        assert e.code == 503
+    assert json.load(urllib.request.urlopen(f'{url}/health'))['status'] == 'draining'
+    server.shutdown()
+
+def test_domain_landmask(monkeypatch, tmp_path):
+    import numpy as np
+    from landmask_cache import load_landmask, Reader
+    from opendrift.readers.reader_global_landmask import get_mask
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    border = [57.0, 57.5, 23.5, 24.5]
+    raster = load_landmask(tuple(border), 0.002)
+    assert isinstance(raster, np.memmap) and raster.shape == (250, 500)
+    reader = Reader(raster, border, 0.002)
+    
+    rng = np.random.default_rng(0)
+    # inside the raster and outside of it
+    lon = np.concatenate([rng.uniform(23.5, 24.5, 5000), rng.uniform(20, 23, 500)])
+    lat = np.concatenate([rng.uniform(57.0, 57.5, 5000), rng.uniform(55, 58, 500)])
+    land = reader.get_variables(['land_binary_mask'], x=lon, y=lat)['land_binary_mask']
+    exact = get_mask().contains_many(lon, lat)
+    assert 0 < land.mean() < 1
+    assert np.mean(land[:5000] != exact[:5000]) < 0.02
+    assert np.array_equal(land[5000:], exact[5000:])
+
+def test_instrumentation(tmp_path, monkeypatch):
+    import json
+    from instrumentation import start_recording, finish_recording, set_output, stage, prometheus_text
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    # outside of a recorded run stages are not recorded
+    with stage('ignored'):
+        pass
+    start_recording('job.json')
+    set_output(str(tmp_path / 'run.nc'))
+    with stage('preparation'):
+        for name in ['a.nc', 'b.nc']:
+            with stage('open', name):
+                (tmp_path / 'run.nc').write_bytes(b'0' * 1000)
+                (tmp_path / 'run.nc').read_bytes()
+    metrics = finish_recording(0)
+    assert [s['stage'] for s in metrics['stages']] == ['preparation/open', 'preparation/open', 'preparation']
+    assert metrics['totals']['preparation/open']['count'] == 2
+    assert json.loads((tmp_path / 'run_metrics.json').read_text())['code'] == 0
+    assert 'opendrift_stage_wall_seconds{job="job.json",stage="preparation"}' in prometheus_text(metrics)
+    
+    # peak RSS is measured per stage, a nested stage peak is kept by its parent
+    import numpy as np
+    start_recording('peaks.json')
+    with stage('outer'):
+        with stage('large'):
+            np.ones(2**24).sum()
+    with stage('small'):
+        pass
+    peaks = {s['stage']: s['peak_rss_mb'] for s in finish_recording(0)['stages']}
+    assert peaks['outer'] >= peaks['outer/large'] > peaks['small'] + 100
+
+def test_profiling(monkeypatch, tmp_path):
+    import os
+    from profiling import parse_profile, active_profile
+    from instrumentation import start_recording, finish_recording, set_profile, stage
+    assert parse_profile('cprofile')['simulation'] == 'cprofile'
+    assert parse_profile('prepare_dataset:sampling,simulation/run:unknown') == {'preparation': 'sampling'}
+    monkeypatch.setenv('PROFILE', 'simulation:tracemalloc')
+    assert active_profile({'simulation': 'cprofile', 'selection': 'sampling'}) == \
+        {'simulation': 'tracemalloc', 'selection': 'sampling'}
+    
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    start_recording('profiled.json')
+    set_profile({'work': 'cprofile', 'work/inner': 'cprofile', 'other': 'sampling'})
+    with stage('work'):
+        with stage('inner'):
+            sum(i * i for i in range(100000))
+    with stage('other'):
+        sum(i * i for i in range(100000))
+    finish_recording(0)
+    files = sorted(os.listdir(tmp_path / 'profiles'))
+    assert files == ['profiled_other.folded', 'profiled_work.prof', 'profiled_work.txt']
+    
+    # tracemalloc is process-wide, a second job is not traced while the first one is
+    import threading
+    import tracemalloc
+    from profiling import _tracemalloc
+    def second_job():
+        with _tracemalloc(str(tmp_path / 'second')):
+            pass
+    with _tracemalloc(str(tmp_path / 'first')):
+        second = threading.Thread(target=second_job)
+        second.start()
+        second.join()
+        with _tracemalloc(str(tmp_path / 'nested')):
+            pass
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+    assert os.path.exists(tmp_path / 'first.txt') and os.path.exists(tmp_path / 'nested.txt')
+    assert not os.path.exists(tmp_path / 'second.txt')
+
+def test_progress_reports(monkeypatch, tmp_path):
+    from progress import progress_callbacks
+    monkeypatch.setenv('OUTPUT', str(tmp_path))
+    reports = []
+    with progress_callbacks(reports.append):
+        simulation(datasets=[], model='OceanDrift', start_position=[57.5, 23.7], start_t='2024-06-01 00:00:00',
+                   end_t='2024-06-01 06:00:00', num=10, rad=100, time_step=1800, time_step_output=3600,
+                   file_name='test_progress.nc', progress_interval=0)
+    assert [r['step'] for r in reports] == list(range(1, 13)) + [12]
+    final = reports[-1]
+    assert final['final'] and final['steps'] == 12 and final['eta_s'] == 0
+    assert final['particle_steps_per_s'] > 0 and final['output_s'] > 0
+
+def test_file_clustering():
+    from pathlib import Path
+    from file_clusterization import split_name, cluster_files
+    assert split_name('/missing/BAL-NEMO_PHY-hourly-20240601.nc') == ['BAL', 'NEMO', 'PHY', 'hourly']
+    files = [f'/archive/BAL-NEMO_PHY-hourly-2024060{d}.nc' for d in range(1, 4)]
+    files += [f'/archive/BAL-WAM_WAV-hourly-2024060{d}.nc' for d in range(1, 4)]
+    files += ['/archive/ECMWF_WIND-20240601.grib', '/archive/ECMWF_WIND-extra-20240601.grib']
+    clustered = cluster_files(files)
+    assert [p.parent.name for p in clustered] == ['NEMO'] * 3 + ['WAM'] * 3 + ['ECMWF_WIND', 'extra']
+    variables = {Path(f): ['uo', 'vo'] if 'PHY' in f else ['u10', 'v10'] for f in files}
+    assert {p.parent.name for p in cluster_files(files, 'variables', variables)} == {'uo_vo', 'u10_v10'}
+
+
+def test_bulk_validation(tmp_path):
+    import json
+    from bulk_validation import validate_bulk
+    with open('INPUT/input_test.json') as f:
+        config = json.load(f)
+    configs = [config, dict(config, start_position=[[57.5, 91], [23.7, 24]], start_t='bad'),
+               dict(config, end_t='2024-05-31', num=-1, model='Unknown')]
+    path = tmp_path / 'batch.jsonl'
+    path.write_text('\n'.join(json.dumps(c) for c in configs) + '\n{broken\n')
+    reports = validate_bulk(str(path))
+    assert [r['valid'] for r in reports] == [True, False, False, False]
+    assert reports[1]['errors'] == ['Latitude values must be in [-90, 90].',
+                                    'Invalid start_t: bad. Must be a valid datetime string.']
+    assert reports[2]['errors'] == ['Unknown model type: Unknown', 'Start time must be earlier than end time.']
+    assert reports[2]['warnings'][0].startswith('Invalid num: -1')
+    assert reports[3]['config'] == 'batch.jsonl:4'
+    
+    # prerun forcings [wind direction, wind speed <= 50, current direction, current speed <= 15]
+    from bulk_validation import validate_configs
+    prerun = [dict(config, prerun=True, duration='1h', forcings=f) for f in [[0, 30, 0, 1], [0, 5, 0, 20]]]
+    assert [r['valid'] for r in validate_configs(prerun)] == [True, False]
+    for forcings, valid in [([0, 30, 0, 1], True), ([0, 5, 0, 20], False)]:
+        single = tmp_path / 'prerun.json'
+        single.write_text(json.dumps(dict(config, prerun=True, duration='1h', forcings=forcings)))
+        assert verify_config_file(str(single))[0] is valid
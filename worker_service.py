@@ -0,0 +1,414 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qs
+from main import resolve_config_path, load_vocabulary, run_config
+from general_tools import resolve_path
+from progress import progress_callbacks
+from bulk_validation import validate_configs
+
+'''
+    Worker service: one warm process runs configs through the same stages as main.py.
+    OpenDrift models, the landmask, the vocabulary and opened forcing datasets stay loaded between jobs.
+    Configs come over HTTP (TCP or Unix socket) or from a watched folder. They are validated on submission,
+    invalid ones are rejected with the error report before anything is scheduled.
+    With --workers > 1 every job runs in one of the spawned job processes, each with its own warm resources
+    (netCDF/HDF5 is not thread-safe, so simulations never share a process).
+        python worker_service.py [--port 8080 | --socket /tmp/opendrift.sock] [--watch INPUT/queue]
+                                 [--workers 1] [--max-queue 16]
+    API:
+        POST /jobs                  body is the config JSON, or a JSON list / JSONL of configs (batch)
+        POST /jobs?config=<file>    config file in INPUT, optional &resume=1 or &postprocess=1
+        GET  /jobs, GET /jobs/<id>  job status with the latest simulation progress
+        GET  /health                service status
+        POST /drain                 stop accepting jobs, finish the queued ones and exit (same as SIGTERM)
+'''
+JOBS_DIR = 'jobs'
+WATCH_INTERVAL = 2
+MAX_HISTORY = 1000
+DATASET_CACHE_SIZE = 4
+VOCABULARY_PATH = "DATA/VariableMapping.json"
+
+def _now() -> str:
+    return dt.datetime.now(dt.timezone.utc).isoformat(timespec='seconds')
+
+# Service of a job process and the queue for its progress reports, set by _process_init
+_process_service = None
+_process_progress = None
+
+def _process_init(progress):
+    global _process_service, _process_progress
+    _process_service = WorkerService()
+    _process_progress = progress
+    _process_service.warm_up()
+
+def _process_job(job_id, input_file, resume, postprocess_only):
+    service = _process_service
+    with progress_callbacks(lambda report: _process_progress.put((job_id, report))):
+        return run_config(input_file, resume, postprocess_only,
+                          vocabulary_data=service.vocabulary_data(), prepare=service.prepare)
+
+class WorkerService:
+    # workers > 1: job threads only wait for the job processes
+    def __init__(self, workers = 1, max_queue = 16):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.processes = None
+        if workers > 1:
+            context = multiprocessing.get_context('spawn')
+            self.progress = context.Queue()
+            self.processes = ProcessPoolExecutor(workers, mp_context=context, initializer=_process_init,
+                                                 initargs=(self.progress,))
+            threading.Thread(target=self._collect_progress, daemon=True).start()
+        self.max_queue = max_queue
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.draining = threading.Event()
+        self.vocabulary = (None, None)
+        self.datasets = OrderedDict()
+
+    '''
+        WARM RESOURCES
+    '''
+    # Job processes warm up when they start
+    def warm_up(self):
+        if self.processes is not None:
+            return
+        start = time.perf_counter()
+        from case_study_tool import MODEL_DICT
+        from opendrift.readers.reader_global_landmask import get_mask
+
+        for name in MODEL_DICT:
+            MODEL_DICT[name]
+        get_mask()
+        self.vocabulary_data()
+        logging.info(f'Worker warm in {time.perf_counter() - start:.1f} s')
+
+    # Vocabulary is parsed again only when the file changes
+    def vocabulary_data(self):
+        mtime = os.path.getmtime(VOCABULARY_PATH) if os.path.exists(VOCABULARY_PATH) else None
+        with self.lock:
+            if mtime is None or self.vocabulary[0] != mtime:
+                code, data = load_vocabulary(VOCABULARY_PATH)
+                self.vocabulary = (mtime, data) if not code else (None, None)
+            return self.vocabulary[1]
+
+    # prepare_dataset with opened datasets kept for identical data settings and unchanged forcing files
+    def prepare(self, **data_vars):
+        from dataset_preparation import prepare_dataset
+        from result_cache import fingerprint_files
+
+        if data_vars.get('copernicus') or data_vars.get('folder') is None:
+            return prepare_dataset(**data_vars)
+        key = json.dumps({'data': data_vars, 'forcing': fingerprint_files(data_vars['folder'])},
+                         sort_keys=True, default=str)
+        with self.lock:
+            if key in self.datasets:
+                self.datasets.move_to_end(key)
+                logging.info('Using opened datasets from the worker cache')
+                return self.datasets[key]
+        ds = prepare_dataset(**data_vars)
+        with self.lock:
+            self.datasets[key] = ds
+            while len(self.datasets) > DATASET_CACHE_SIZE:
+                self.datasets.popitem(last=False)
+        return ds
+
+    '''
+        JOBS
+    '''
+    def _pending(self) -> int:
+        return sum(job['status'] in ['queued', 'running'] for job in self.jobs.values())
+
+    # temporary: config file written for this job, removed when it finishes
+    def submit(self, input_file, resume = False, postprocess_only = False, source = 'http', temporary = False):
+        with self.lock:
+            if self.draining.is_set():
+                return None, 'Service is draining'
+            if self._pending() >= self.max_queue:
+                return None, f'Queue is full ({self.max_queue} jobs)'
+            job_id = uuid.uuid4().hex[:12]
+            self.jobs[job_id] = {'id': job_id, 'config': input_file, 'source': source,
+                                 'resume': resume, 'postprocess': postprocess_only, 'temporary': temporary,
+                                 'status': 'queued', 'code': None, 'submitted': _now(),
+                                 'started': None, 'finished': None, 'seconds': None, 'progress': None}
+            finished = [k for k, job in self.jobs.items() if job['status'] in ['succeeded', 'failed']]
+            for k in finished[:max(0, len(self.jobs) - MAX_HISTORY)]:
+                del self.jobs[k]
+            future = self.executor.submit(self._run, job_id)
+        return future, job_id
+
+    # Config given as a dictionary, written to INPUT/jobs for the job
+    def submit_config(self, config, source = 'http'):
+        folder = os.path.join(resolve_path("INPUT"), JOBS_DIR)
+        os.makedirs(folder, exist_ok=True)
+        input_file = os.path.join(folder, f'{uuid.uuid4().hex}.json')
+        with open(input_file, 'w') as f:
+            json.dump(config, f, indent=2)
+        future, job_id = self.submit(input_file, source=source, temporary=True)
+        if future is None:
+            os.remove(input_file)
+        return future, job_id
+
+    # Validate all configs together, submit the valid ones. Report per config with the job id or the rejection.
+    def submit_batch(self, configs, source = 'http'):
+        reports = validate_configs(configs)
+        for config, report in zip(configs, reports):
+            if report['valid']:
+                future, job_id = self.submit_config(config, source)
+                report['job' if future is not None else 'rejected'] = job_id
+        return reports
+
+    def _run(self, job_id):
+        job = self.jobs[job_id]
+        job.update(status='running', started=_now())
+        logging.info(f"Job {job_id} started: {job['config']}")
+        start = time.perf_counter()
+        try:
+            # latest simulation progress report in the job status
+            if self.processes is not None:
+                code = self.processes.submit(_process_job, job_id, job['config'], job['resume'],
+                                             job['postprocess']).result()
+            else:
+                with progress_callbacks(lambda report: job.update(progress=report)):
+                    code = run_config(job['config'], job['resume'], job['postprocess'],
+                                      vocabulary_data=self.vocabulary_data(), prepare=self.prepare)
+        except Exception as e:
+            logging.exception(f'Job {job_id} failed: {e}')
+            code = 1
+        if job['temporary'] and os.path.exists(job['config']):
+            os.remove(job['config'])
+        job.update(status='succeeded' if code == 0 else 'failed', code=code,
+                   finished=_now(), seconds=round(time.perf_counter() - start, 3))
+        logging.info(f"Job {job_id} {job['status']} with code {code} in {job['seconds']} s")
+        return code
+
+    def _collect_progress(self):
+        while True:
+            item = self.progress.get()
+            if item is None:
+                return
+            job_id, report = item
+            with self.lock:
+                if job_id in self.jobs:
+                    self.jobs[job_id]['progress'] = report
+
+    def status(self, job_id = None):
+        with self.lock:
+            if job_id is not None:
+                return dict(self.jobs[job_id]) if job_id in self.jobs else None
+            return [dict(job) for job in self.jobs.values()]
+
+    def health(self) -> dict:
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {'status': 'draining' if self.draining.is_set() else 'ok', 'jobs': counts,
+                'max_queue': self.max_queue, 'cached_datasets': len(self.datasets)}
+
+    # Stop accepting jobs and wait for the queued and running ones
+    def drain(self):
+        with self.lock:
+            self.draining.set()
+        logging.info(f'Draining: waiting for {self._pending()} jobs')
+        self.executor.shutdown(wait=True)
+        if self.processes is not None:
+            self.processes.shutdown(wait=True)
+            self.progress.put(None)
+        logging.info('All jobs finished')
+
+    '''
+        WATCHED FOLDER
+    Configs are moved to <folder>/accepted when taken, and to done/ or failed/ with a status file when finished
+    '''
+    def watch(self, folder, interval = WATCH_INTERVAL):
+        for sub in ['accepted', 'done', 'failed']:
+            os.makedirs(os.path.join(folder, sub), exist_ok=True)
+        while not self.draining.is_set():
+            for name in sorted(os.listdir(folder)):
+                path = os.path.join(folder, name)
+                if not name.endswith('.json') or not os.path.isfile(path):
+                    continue
+                accepted = os.path.join(folder, 'accepted', name)
+                os.replace(path, accepted)
+                report = _validate_file(accepted)
+                if not report['valid']:
+                    self._watch_rejected(folder, accepted, report)
+                    continue
+                future, job_id = self.submit(accepted, source='watch')
+                if future is None:
+                    # queue full or draining, try again later
+                    os.replace(accepted, path)
+                    break
+                future.add_done_callback(lambda f, j=job_id, a=accepted: self._watch_done(folder, j, a))
+            self.draining.wait(interval)
+
+    def _watch_rejected(self, folder, accepted, report):
+        target = os.path.join(folder, 'failed', os.path.basename(accepted))
+        shutil.move(accepted, target)
+        with open(target.replace('.json', '.status.json'), 'w') as f:
+            json.dump({'status': 'rejected', **report}, f, indent=2)
+        logging.warning(f"Rejected {target}: {'; '.join(report['errors'])}")
+
+    def _watch_done(self, folder, job_id, accepted):
+        job = self.status(job_id)
+        target = os.path.join(folder, 'done' if job['status'] == 'succeeded' else 'failed',
+                              f'{job_id}_{os.path.basename(accepted)}')
+        shutil.move(accepted, target)
+        with open(target.replace('.json', '.status.json'), 'w') as f:
+            json.dump(job, f, indent=2)
+
+def _validate_file(path) -> dict:
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        return {'config': path, 'valid': False, 'errors': [f'Unable to read or parse the configuration file: {e}'],
+                'warnings': []}
+    return validate_configs([config], [path])[0]
+
+# Request body: a config, a list of configs or JSONL. Returns (configs, batch).
+def _parse_configs(body):
+    try:
+        data = json.loads(body)
+        return (data, True) if isinstance(data, list) else ([data], False)
+    except json.JSONDecodeError:
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) < 2:
+            raise
+        return [json.loads(line) for line in lines], True
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/health':
+            return self._reply(200, self.service.health())
+        if path == '/jobs':
+            return self._reply(200, self.service.status())
+        if path.startswith('/jobs/'):
+            job = self.service.status(path.split('/')[-1])
+            return self._reply(200, job) if job else self._reply(404, {'error': 'Unknown job'})
+        self._reply(404, {'error': 'Unknown endpoint'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip('/')
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if path == '/drain':
+            threading.Thread(target=shutdown, args=(self.service, self.server), daemon=True).start()
+            return self._reply(202, self.service.health())
+        if path != '/jobs':
+            return self._reply(404, {'error': 'Unknown endpoint'})
+
+        if 'config' in query:
+            input_file = resolve_config_path(query['config'])
+            report = _validate_file(input_file)
+            if not report['valid']:
+                return self._reply(400, {'error': 'Invalid config', **report})
+            future, job_id = self.service.submit(input_file, query.get('resume') == '1',
+                                                 query.get('postprocess') == '1')
+        else:
+            try:
+                configs, batch = _parse_configs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                return self._reply(400, {'error': f'Config is not valid JSON: {e}'})
+            if batch:
+                reports = self.service.submit_batch(configs)
+                return self._reply(202 if any('job' in r for r in reports) else 400, reports)
+            report = validate_configs(configs)[0]
+            if not report['valid']:
+                return self._reply(400, {'error': 'Invalid config', **report})
+            future, job_id = self.service.submit_config(configs[0])
+
+        if future is None:
+            return self._reply(503, {'error': job_id})
+        self._reply(202, self.service.status(job_id))
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} {format % args}')
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, port = 8080, host = '127.0.0.1', socket_path = None):
+    handler = type('ServiceHandler', (Handler,), {'service': service})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+def shutdown(service, server):
+    service.drain()
+    if server is not None:
+        server.shutdown()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='OpenDrift worker service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--socket', default=None, help='Unix socket path instead of TCP')
+    parser.add_argument('--watch', default=None, help='folder with configs to run')
+    parser.add_argument('--no-http', action='store_true', help='only the watched folder')
+    parser.add_argument('--workers', type=int, default=1, help='jobs running at the same time')
+    parser.add_argument('--max-queue', type=int, default=16, help='queued and running jobs')
+    args = parser.parse_args()
+    if args.no_http and not args.watch:
+        logging.error('--no-http needs --watch')
+        return 1
+
+    service = WorkerService(args.workers, args.max_queue)
+    service.warm_up()
+    server = None if args.no_http else make_server(service, args.port, args.host, args.socket)
+
+    def on_signal(signum, frame):
+        logging.info(f'Signal {signum} received')
+        threading.Thread(target=shutdown, args=(service, server), daemon=True).start()
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    if args.watch:
+        watcher = threading.Thread(target=service.watch, args=(args.watch,), daemon=True)
+        watcher.start()
+        logging.info(f'Watching {args.watch}')
+    if server is None:
+        while not service.draining.is_set():
+            service.draining.wait(1)
+        service.executor.shutdown(wait=True)
+    else:
+        logging.info(f"Listening on {args.socket or f'{args.host}:{args.port}'}")
+        server.serve_forever()
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+    logging.info('Worker stopped')
+    return 0
+
+if __name__ == "__main__":
+    exit(main())